@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+"""
+Retrieval scaling benchmark for the RAG backend.
+
+Generates synthetic rag_data.json-shaped corpora (clustered 1536-dim sentence
+embeddings spread over N documents), builds the serving bundle with
+bundle.write_bundle, and measures for every retrieval strategy the
+backend supports:
+  - index load time and peak RSS (each strategy runs in a fresh process)
+  - p50 / p99 / mean query latency of SentenceIndex.search
+  - recall@top_k of the documents returned, against the exact scan
+  - topic recall@top_k: how often the document a query was generated from is
+    returned, the measure the hybrid (dense + BM25) strategy is judged on
+  - bytes of sentence vectors scored per query (float32, int8 or float16)
+  - mean sentences scored at full precision per query
+The embeddings API is replaced by a deterministic local stub, so runs are
+reproducible and offline. Results are written as JSON to compare commits.
+
+Usage (from cv-backend/):
+    python benchmarks/bench_retrieval.py --sentences 1000 10000 100000 --docs 25 250
+    python benchmarks/bench_retrieval.py --output bench_results.json
+    python benchmarks/bench_retrieval.py --strategies exact-bundle hybrid --lexical-weight 0.02 0.05 0.1
+The 1e6-sentence corpus needs about 13 GB of free disk in --workdir.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import numpy as np
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from bundle import write_bundle
+from index import SentenceIndex
+
+# name -> how the index is loaded and searched.
+STRATEGIES = {
+    "exact-json": {"source": "json", "mode": "exact"},
+    "exact-bundle": {"source": "bundle", "mode": "exact"},
+    "ivf": {"source": "bundle", "mode": "ivf"},
+    "int8": {"source": "bundle", "mode": "int8"},
+    "float16": {"source": "bundle", "mode": "float16"},
+    "coarse": {"source": "bundle", "mode": "coarse"},
+    "hybrid": {"source": "bundle", "mode": "exact", "lexical": True},
+}
+APPROXIMATE_MODES = {"ivf", "int8", "float16", "coarse"}
+QUANTIZED_MODES = {"int8", "float16"}
+
+# ----------------------------
+# Synthetic corpus
+# ----------------------------
+def stub_query(text, centers, doc_terms, spread=0.8, term_rate=0.5):
+    """
+    Deterministic stand-in for a user query and the embeddings API: the text
+    hash picks a topic document and the noise, so the same query always gets
+    the same vector. With probability term_rate the query text names one of
+    the topic's distinctive terms (an identifier or library name), otherwise
+    it only has words every document shares. Returns (text, embedding, topic).
+    """
+    seed = int(hashlib.sha256(text.encode("utf8")).hexdigest()[:16], 16)
+    rng = np.random.default_rng(seed)
+    topic = int(rng.integers(len(centers)))
+    embedding = (centers[topic] + spread * rng.standard_normal(centers.shape[1])).astype(np.float32)
+    if rng.random() < term_rate:
+        text = f"Which project code uses {doc_terms[topic][rng.integers(len(doc_terms[topic]))]}?"
+    else:
+        text = "Which project code is this about?"
+    return text, embedding, topic
+
+def document_terms(n_docs):
+    """Distinctive terms of each synthetic document, found in no other."""
+    return [[f"term{d}x{j}" for j in range(3)] for d in range(n_docs)]
+
+def document_sizes(n_sentences, n_docs, rng):
+    """Split n_sentences over n_docs documents of uneven (but non-zero) size."""
+    n_docs = min(n_docs, n_sentences)
+    weights = rng.lognormal(sigma=1.0, size=n_docs)
+    sizes = np.maximum(1, np.floor(weights / weights.sum() * n_sentences)).astype(np.int64)
+    sizes[np.argmax(sizes)] += n_sentences - sizes.sum()
+    return sizes
+
+def make_corpus(workdir, n_sentences, n_docs, dim, ivf_lists, write_json, seed=0, spread=1.0):
+    """
+    Write a synthetic corpus to workdir: the serving bundle (always) and a
+    rag_data.json (when write_json). Sentence vectors are their document's
+    center plus gaussian noise of scale spread (smaller is more clustered).
+    """
+    rng = np.random.default_rng(seed)
+    sizes = document_sizes(n_sentences, n_docs, rng)
+    centers = rng.standard_normal((len(sizes), dim)).astype(np.float32)
+    row_doc = np.repeat(np.arange(len(sizes)), sizes)
+
+    raw_path = os.path.join(workdir, "synthetic_embeddings.npy")
+    raw = np.lib.format.open_memmap(raw_path, mode="w+", dtype=np.float32, shape=(n_sentences, dim))
+    for start in range(0, n_sentences, 65536):
+        docs = row_doc[start : start + 65536]
+        raw[start : start + len(docs)] = centers[docs] + spread * rng.standard_normal((len(docs), dim), dtype=np.float32)
+    raw.flush()
+
+    docs = [{"doc_id": f"synthetic_{d}.txt", "source": "txt" if d % 2 else "json"} for d in range(len(sizes))]
+    doc_terms = document_terms(len(sizes))
+    contents = [f"Synthetic project code document {d} with {size} sentences using {' '.join(doc_terms[d])}."
+                for d, size in enumerate(sizes)]
+    sentences = (f"Synthetic sentence {i} of document {row_doc[i]}." for i in range(n_sentences))
+    doc_offsets = np.concatenate([[0], np.cumsum(sizes)])
+    write_bundle(os.path.join(workdir, "rag_index"), docs, contents, sentences, raw, doc_offsets, ivf_lists,
+                 quantize=sorted(QUANTIZED_MODES), tokens=(content.lower() for content in contents),
+                 doc_embeddings=centers)
+
+    if write_json:
+        with open(os.path.join(workdir, "rag_data.json"), "w", encoding="utf8") as f:
+            f.write("[")
+            for d, doc in enumerate(docs):
+                start, end = doc_offsets[d], doc_offsets[d + 1]
+                f.write(("," if d else "") + json.dumps({
+                    **doc,
+                    "content": contents[d],
+                    "tokens": contents[d].lower().split(),
+                    "embedding": centers[d].tolist(),
+                    "sentence_embeddings": [
+                        {"sentence": f"Synthetic sentence {i} of document {d}.", "embedding": raw[i].tolist()}
+                        for i in range(start, end)
+                    ],
+                }))
+            f.write("]")
+
+    del raw
+    os.remove(raw_path)
+    np.save(os.path.join(workdir, "centers.npy"), centers)
+    with open(os.path.join(workdir, "terms.json"), "w", encoding="utf8") as f:
+        json.dump(doc_terms, f)
+
+# ----------------------------
+# Measurement (runs in a fresh process per strategy)
+# ----------------------------
+def peak_rss_mb():
+    """
+    Peak resident memory of this process. ru_maxrss survives exec(), so it would
+    include the parent that generated the corpus; VmHWM is reset, use it when available.
+    """
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+def percentile_ms(latencies, q):
+    return round(float(np.percentile(latencies, q)) * 1000, 3)
+
+def run_worker(args):
+    strategy = STRATEGIES[args.strategy]
+    centers = np.load(os.path.join(args.corpus, "centers.npy"))
+    with open(os.path.join(args.corpus, "terms.json"), "r", encoding="utf8") as f:
+        doc_terms = json.load(f)
+    queries = [stub_query(f"benchmark query {i}", centers, doc_terms, args.query_spread, args.term_rate)
+               for i in range(args.queries)]
+    lexical_weight = args.lexical_weight if strategy.get("lexical") else 0.0
+
+    start = time.perf_counter()
+    if strategy["source"] == "json":
+        with open(os.path.join(args.corpus, "rag_data.json"), "r", encoding="utf8") as f:
+            index = SentenceIndex.from_documents(json.load(f))
+    else:
+        index = SentenceIndex.from_bundle(os.path.join(args.corpus, "rag_index"))
+    load_seconds = time.perf_counter() - start
+
+    def run(query, mode, stats=None, weight=0.0):
+        text, embedding, _ = query
+        return index.search(embedding, top_k=args.top_k, threshold=args.threshold,
+                            top_n_sentences=3, mode=mode, nprobe=args.nprobe, rescore=args.rescore,
+                            query_text=text, lexical_weight=weight, coarse_docs=args.coarse_docs, stats=stats)
+
+    for query in queries[:3]:
+        run(query, strategy["mode"], weight=lexical_weight)
+    latencies = []
+    results = []
+    scored = []
+    for query in queries:
+        stats = {}
+        start = time.perf_counter()
+        results.append(run(query, strategy["mode"], stats, lexical_weight))
+        latencies.append(time.perf_counter() - start)
+        scored.append(stats.get("sentences_scored", 0))
+
+    memory = index.memory_stats()
+    vector_bytes = memory.get(f"{strategy['mode']}_bytes", memory["float32_bytes"])
+    report = {
+        "strategy": args.strategy,
+        "nprobe": args.nprobe if strategy["mode"] == "ivf" else None,
+        "rescore": args.rescore if strategy["mode"] in QUANTIZED_MODES else None,
+        "coarse_docs": args.coarse_docs if strategy["mode"] == "coarse" else None,
+        "lexical_weight": lexical_weight or None,
+        "load_seconds": round(load_seconds, 4),
+        "vector_mb": round(vector_bytes / 2**20, 2),
+        "vector_saved_mb": round((memory["float32_bytes"] - vector_bytes) / 2**20, 2),
+        "peak_rss_mb": peak_rss_mb(),
+        "p50_ms": percentile_ms(latencies, 50),
+        "p99_ms": percentile_ms(latencies, 99),
+        "mean_ms": round(float(np.mean(latencies)) * 1000, 3),
+        "mean_sentences_scored": round(float(np.mean(scored)), 1),
+        "topic_recall_at_k": round(float(np.mean([
+            f"synthetic_{topic}.txt" in {doc["document_name"] for doc in found}
+            for (_, _, topic), found in zip(queries, results)
+        ])), 4),
+    }
+    if strategy["mode"] in APPROXIMATE_MODES:
+        found = expected = 0
+        for query, approximate in zip(queries, results):
+            exact = {doc["document_name"] for doc in run(query, "exact")}
+            found += len(exact & {doc["document_name"] for doc in approximate})
+            expected += len(exact)
+        report["recall_at_k"] = round(found / expected, 4) if expected else None
+    print(json.dumps(report))
+
+def run_strategy(corpus_dir, strategy, nprobe, lexical_weight, args):
+    command = [
+        sys.executable, os.path.abspath(__file__), "--worker",
+        "--corpus", corpus_dir, "--strategy", strategy, "--nprobe", str(nprobe),
+        "--lexical-weight", str(lexical_weight), "--query-spread", str(args.query_spread),
+        "--term-rate", str(args.term_rate),
+        "--rescore", str(args.rescore), "--coarse-docs", str(args.coarse_docs),
+        "--queries", str(args.queries), "--top-k", str(args.top_k), "--threshold", str(args.threshold),
+    ]
+    completed = subprocess.run(command, capture_output=True, text=True)
+    if completed.returncode != 0:
+        print(completed.stderr, file=sys.stderr)
+        return {"strategy": strategy, "error": completed.stderr.strip().splitlines()[-1:]}
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+# ----------------------------
+# Main Process
+# ----------------------------
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=BACKEND_DIR).stdout.strip() or None
+    except OSError:
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark retrieval strategies on synthetic corpora.")
+    parser.add_argument("--sentences", type=int, nargs="+", default=[1000, 10000, 100000, 1000000])
+    parser.add_argument("--docs", type=int, nargs="+", default=[25, 250])
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--spread", type=float, default=1.0,
+                        help="Noise of sentence vectors around their document center.")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=2)
+    parser.add_argument("--threshold", type=float, default=0.0)
+    parser.add_argument("--strategies", nargs="+", default=list(STRATEGIES), choices=list(STRATEGIES))
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[8, 32],
+                        help="nprobe values measured for the ivf strategy.")
+    parser.add_argument("--rescore", type=int, default=256,
+                        help="Sentences rescored at full precision by the int8/float16 strategies.")
+    parser.add_argument("--coarse-docs", type=int, default=0,
+                        help="Documents considered by the coarse strategy (0: exact bound pruning).")
+    parser.add_argument("--lexical-weight", type=float, nargs="+", default=[0.02, 0.05, 0.1],
+                        help="BM25 weights measured for the hybrid strategy.")
+    parser.add_argument("--query-spread", type=float, default=0.8,
+                        help="Noise of query vectors around their topic document's center.")
+    parser.add_argument("--term-rate", type=float, default=0.5,
+                        help="Fraction of queries naming a distinctive term of their topic document.")
+    parser.add_argument("--json-max-sentences", type=int, default=10000,
+                        help="Larger corpora skip the rag_data.json strategies (the JSON gets huge).")
+    parser.add_argument("--workdir", default=None, help="Where corpora are generated (default: a temp dir).")
+    parser.add_argument("--output", default="bench_results.json")
+    # Internal: measure one strategy in this process.
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--corpus", help=argparse.SUPPRESS)
+    parser.add_argument("--strategy", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        args.nprobe = args.nprobe[0]
+        args.lexical_weight = args.lexical_weight[0]
+        run_worker(args)
+        return
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="bench_retrieval_")
+    results = []
+    try:
+        for n_sentences in args.sentences:
+            for n_docs in args.docs:
+                corpus_dir = os.path.join(workdir, f"corpus_{n_sentences}_{n_docs}")
+                os.makedirs(corpus_dir, exist_ok=True)
+                with_json = n_sentences <= args.json_max_sentences
+                ivf_lists = max(1, int(np.sqrt(n_sentences)))
+                print(f"Generating {n_sentences} sentences over {n_docs} documents...")
+                start = time.perf_counter()
+                make_corpus(corpus_dir, n_sentences, n_docs, args.dim, ivf_lists, with_json, spread=args.spread)
+                build_seconds = round(time.perf_counter() - start, 2)
+
+                for strategy in args.strategies:
+                    if STRATEGIES[strategy]["source"] == "json" and not with_json:
+                        continue
+                    probed = STRATEGIES[strategy]["mode"] == "ivf"
+                    weighted = STRATEGIES[strategy].get("lexical", False)
+                    for nprobe in (args.nprobe if probed else args.nprobe[:1]):
+                        for weight in (args.lexical_weight if weighted else args.lexical_weight[:1]):
+                            report = run_strategy(corpus_dir, strategy, nprobe, weight, args)
+                            report.update({"n_sentences": n_sentences, "n_docs": n_docs,
+                                           "dim": args.dim, "corpus_build_seconds": build_seconds})
+                            print(json.dumps(report))
+                            results.append(report)
+                shutil.rmtree(corpus_dir)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = {
+        "meta": {
+            "commit": git_commit(),
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "queries": args.queries,
+            "top_k": args.top_k,
+            "threshold": args.threshold,
+            "spread": args.spread,
+            "rescore": args.rescore,
+            "coarse_docs": args.coarse_docs,
+            "query_spread": args.query_spread,
+            "term_rate": args.term_rate,
+        },
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf8") as f:
+        json.dump(output, f, indent=2)
+    print(f"Benchmark results saved to {args.output}.")
+
+if __name__ == "__main__":
+    main()
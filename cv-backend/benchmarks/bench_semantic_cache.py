@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Threshold benchmark for the semantic response cache.
+
+Embeds pairs of portfolio questions, some paraphrases that should share a
+cached answer and some near-duplicates that must not ("...use React?" and
+"...use Vue?"), and reports for every SEMANTIC_CACHE_DISTANCE candidate how
+many paraphrases hit and how many wrong answers would be replayed: with the
+embedding distance alone, and with SemanticResponseCache (distance and the
+same content words). Both queries of a pair are assumed to retrieve the same
+documents, the worst case for the cache.
+
+Usage (from cv-backend/, with the embeddings provider of the server):
+    python benchmarks/bench_semantic_cache.py --distances 0.02 0.03 0.05 0.1
+    OPENAI_API_KEY=stub OPENAI_BASE_URL=http://127.0.0.1:8099/v1 python benchmarks/bench_semantic_cache.py
+(the second form uses github_parser/stub_embeddings_server.py, whose
+bag-of-words vectors only exercise the harness).
+"""
+
+import os
+import sys
+import json
+import argparse
+import numpy as np
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from cache import SemanticResponseCache
+from embeddings import EMBEDDING_PROVIDERS, make_embedder
+from index import normalize_vector
+
+# (cached query, new query): the same question asked another way.
+PARAPHRASES = [
+    ("Which projects use React?", "What projects use React?"),
+    ("Tell me about podcastfy", "tell me about Podcastfy."),
+    ("What did you build with Flask?", "What have you built with Flask?"),
+    ("How does the TREC retrieval work?", "how does the TREC retrieval work"),
+    ("What is your favorite project?", "Which project is your favorite?"),
+    ("What languages do you know?", "Which languages do you know?"),
+    ("Do you have experience with Docker?", "Do you have any experience with Docker?"),
+    ("What did you do in INF5190?", "What did you do in the INF5190 course?"),
+]
+# (cached query, new query): a different question whose answer must not be replayed.
+DIFFERENT = [
+    ("Which projects use React?", "Which projects use Vue?"),
+    ("What did you build with Flask?", "What did you build with Django?"),
+    ("Tell me about podcastfy", "Tell me about ainews_podcast"),
+    ("Do you have experience with Docker?", "Do you have experience with Kubernetes?"),
+    ("What did you do in INF5190?", "What did you do in INF8810?"),
+    ("Which projects use Python?", "Which projects don't use Python?"),
+    ("How does the TREC retrieval work?", "How does the TREC evaluation work?"),
+    ("What is your favorite project?", "What is your least favorite project?"),
+]
+
+
+def get_client():
+    from openai import OpenAI
+    return OpenAI()  # OPENAI_API_KEY and OPENAI_BASE_URL from the environment
+
+
+def cache_hits(pairs, vectors, max_distance):
+    """Pairs whose second query hits the answer cached for the first one."""
+    hits = 0
+    for (cached, new), (cached_vector, new_vector) in zip(pairs, vectors):
+        cache = SemanticResponseCache(max_entries=1, max_distance=max_distance)
+        cache.store(cached, cached_vector, ["doc"], ["answer"], version=1)
+        hits += cache.lookup(new, new_vector, ["doc"], version=1) is not None
+    return hits
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--provider", choices=EMBEDDING_PROVIDERS,
+                        default=os.getenv("EMBEDDING_PROVIDER", "openai"))
+    parser.add_argument("--model", default=os.getenv("EMBEDDING_MODEL"),
+                        help="Embedding model (default: the provider's default, as the server).")
+    parser.add_argument("--distances", type=float, nargs="+", default=[0.01, 0.02, 0.03, 0.05, 0.1, 0.2])
+    parser.add_argument("--output", help="Optional JSON file for the results.")
+    args = parser.parse_args()
+
+    embedder = make_embedder(args.provider, args.model, get_client=get_client)
+    pairs = {"paraphrase": PARAPHRASES, "different": DIFFERENT}
+    vectors = {}
+    for kind, kind_pairs in pairs.items():
+        embedded = embedder.embed([query for pair in kind_pairs for query in pair])
+        vectors[kind] = [(embedded[i], embedded[i + 1]) for i in range(0, len(embedded), 2)]
+
+    distances = {
+        kind: [round(float(1.0 - normalize_vector(a) @ normalize_vector(b)), 4) for a, b in kind_vectors]
+        for kind, kind_vectors in vectors.items()
+    }
+    for kind, kind_pairs in pairs.items():
+        for (cached, new), distance in zip(kind_pairs, distances[kind]):
+            print(f"{kind:10s} {distance:.4f}  {cached!r} -> {new!r}")
+
+    results = []
+    for max_distance in args.distances:
+        report = {"max_distance": max_distance}
+        for kind in pairs:
+            report[f"{kind}_hits_distance_only"] = sum(d <= max_distance for d in distances[kind])
+            report[f"{kind}_hits_cache"] = cache_hits(pairs[kind], vectors[kind], max_distance)
+        print(json.dumps(report))
+        results.append(report)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf8") as f:
+            json.dump({"provider": embedder.provider, "model": embedder.model, "distances": distances,
+                       "pairs": {kind: len(kind_pairs) for kind, kind_pairs in pairs.items()},
+                       "results": results}, f, indent=2)
+        print(f"Benchmark results saved to {args.output}.")
+
+
+if __name__ == "__main__":
+    main()
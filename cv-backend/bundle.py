@@ -0,0 +1,344 @@
+"""
+The serving bundle: the sentence index of rag_data.json as memory-mappable
+files in a directory, loaded by SentenceIndex.from_bundle. Written by
+github_parser/prepare_data_rag.py and by the background indexer
+(indexer.py), with the same code so the format has one definition.
+"""
+
+import os
+import json
+import time
+import uuid
+import numpy as np
+
+BUNDLE_MANIFEST = "manifest.json"
+BUNDLE_FORMAT = 1
+# k-means settings for the optional IVF (approximate search) lists.
+IVF_ITERATIONS = 20
+IVF_TRAIN_POINTS_PER_LIST = 256
+
+
+def nearest_centroids(vectors, centroids, batch_size=65536):
+    """Index of the closest centroid (max dot product) for every unit vector."""
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), batch_size):
+        batch = np.asarray(vectors[start : start + batch_size])
+        assignments[start : start + batch_size] = np.argmax(batch @ centroids.T, axis=1)
+    return assignments
+
+
+def train_kmeans(vectors, n_lists, iterations=IVF_ITERATIONS, seed=0):
+    """
+    Spherical k-means on a sample of the normalized embeddings.
+    Returns (n_lists, dim) unit-length float32 centroids.
+    """
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(vectors), n_lists * IVF_TRAIN_POINTS_PER_LIST)
+    sample = np.asarray(vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))])
+    centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = nearest_centroids(sample, centroids)
+        order = np.argsort(assignments, kind="stable")
+        counts = np.bincount(assignments, minlength=n_lists)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        non_empty = counts > 0
+        sums = np.add.reduceat(sample[order], starts[non_empty], axis=0)
+        centroids[non_empty] = sums
+        # Re-seed empty lists with random sample points.
+        n_empty = int((~non_empty).sum())
+        if n_empty:
+            centroids[~non_empty] = sample[rng.choice(len(sample), n_empty, replace=False)]
+        norms = np.linalg.norm(centroids, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        centroids /= norms
+    return centroids.astype(np.float32)
+
+
+def build_ivf_index(embeddings, n_lists):
+    """
+    Partition the sentence embeddings into n_lists inverted lists.
+    Returns (centroids, offsets, ids): rows of list l are ids[offsets[l]:offsets[l + 1]].
+    """
+    n_lists = max(1, min(n_lists, len(embeddings)))
+    centroids = train_kmeans(embeddings, n_lists)
+    assignments = nearest_centroids(embeddings, centroids)
+    ids = np.argsort(assignments, kind="stable").astype(np.int64)
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=n_lists))])
+    return centroids, offsets.astype(np.int64), ids
+
+
+def save_array(bundle_dir, name, array):
+    """Write array to bundle_dir/name atomically (never in place: workers may have it mapped)."""
+    tmp_path = os.path.join(bundle_dir, name + ".tmp")
+    with open(tmp_path, "wb") as f:
+        np.save(f, array)
+    os.replace(tmp_path, os.path.join(bundle_dir, name))
+
+
+def save_strings(bundle_dir, name, strings):
+    """
+    Store strings back to back as UTF-8 in name.bin, with their byte offsets in
+    name-offsets.npy, so the index can memory-map the blob and decode on demand.
+    """
+    offsets = [0]
+    tmp_path = os.path.join(bundle_dir, name + ".bin.tmp")
+    with open(tmp_path, "wb") as f:
+        for text in strings:
+            data = text.encode("utf8")
+            f.write(data)
+            offsets.append(offsets[-1] + len(data))
+    os.replace(tmp_path, os.path.join(bundle_dir, name + ".bin"))
+    save_array(bundle_dir, name + "-offsets.npy", np.asarray(offsets, dtype=np.int64))
+    return {"blob": name + ".bin", "offsets": name + "-offsets.npy"}
+
+
+def save_normalized(bundle_dir, name, embeddings, batch_size=65536):
+    """
+    Write L2-normalized float32 copies of the embedding rows to bundle_dir/name,
+    block by block, so corpora larger than memory can be converted from a memmap.
+    """
+    tmp_path = os.path.join(bundle_dir, name + ".tmp")
+    dim = embeddings.shape[1] if len(embeddings) else 0
+    out = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=(len(embeddings), dim))
+    for start in range(0, len(embeddings), batch_size):
+        block = np.asarray(embeddings[start : start + batch_size], dtype=np.float32)
+        norms = np.linalg.norm(block, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        out[start : start + batch_size] = block / norms
+    out.flush()
+    del out
+    os.replace(tmp_path, os.path.join(bundle_dir, name))
+
+
+def save_quantized(bundle_dir, files, version, normalized, mode, batch_size=65536):
+    """
+    Write the int8 or float16 copy of the normalized embeddings scored first by
+    the quantized retrieval modes. int8 codes are scaled per row:
+    value = code * scale / 127 (must match index.quantize_rows).
+    """
+    name = f"embeddings_{mode}-{version}.npy"
+    tmp_path = os.path.join(bundle_dir, name + ".tmp")
+    dtype = np.int8 if mode == "int8" else np.float16
+    out = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=dtype, shape=normalized.shape)
+    scales = np.ones(len(normalized), dtype=np.float32)
+    for start in range(0, len(normalized), batch_size):
+        block = np.asarray(normalized[start : start + batch_size], dtype=np.float32)
+        if mode == "float16":
+            out[start : start + batch_size] = block.astype(np.float16)
+            continue
+        block_scales = np.abs(block).max(axis=1)
+        block_scales[block_scales == 0] = 1.0
+        out[start : start + batch_size] = np.rint(block / block_scales[:, None] * 127).astype(np.int8)
+        scales[start : start + batch_size] = block_scales
+    out.flush()
+    del out
+    os.replace(tmp_path, os.path.join(bundle_dir, name))
+    files[f"embeddings_{mode}"] = name
+    if mode == "int8":
+        files["embeddings_int8_scales"] = f"embeddings_int8_scales-{version}.npy"
+        save_array(bundle_dir, files["embeddings_int8_scales"], scales)
+
+
+def save_document_bounds(bundle_dir, files, version, normalized, doc_offsets, batch_size=65536):
+    """
+    Write the centroid direction (normalized mean row) and angular radius
+    (largest angle between a row and the centroid) of every document's
+    sentence rows, the bound used by the coarse retrieval mode
+    (must match index.document_bounds).
+    """
+    n_docs = len(doc_offsets) - 1
+    dim = normalized.shape[1]
+    centroids = np.zeros((n_docs, dim), dtype=np.float32)
+    radii = np.full(n_docs, np.pi, dtype=np.float32)
+    for i in range(n_docs):
+        start, end = int(doc_offsets[i]), int(doc_offsets[i + 1])
+        if end <= start:
+            continue
+        total = np.zeros(dim, dtype=np.float64)
+        for block_start in range(start, end, batch_size):
+            total += np.asarray(normalized[block_start : min(end, block_start + batch_size)]).sum(axis=0)
+        norm = np.linalg.norm(total)
+        centroids[i] = total / norm if norm > 0 else total
+        lowest = 1.0
+        for block_start in range(start, end, batch_size):
+            block = np.asarray(normalized[block_start : min(end, block_start + batch_size)], dtype=np.float32)
+            lowest = min(lowest, float((block @ centroids[i]).min()))
+        radii[i] = np.arccos(np.clip(lowest, -1.0, 1.0))
+    files["doc_centroids"] = f"doc_centroids-{version}.npy"
+    files["doc_radii"] = f"doc_radii-{version}.npy"
+    save_array(bundle_dir, files["doc_centroids"], centroids)
+    save_array(bundle_dir, files["doc_radii"], radii)
+
+
+def write_serving_bundle(documents, bundle_dir, ivf_lists=0, quantize=(), model=None):
+    """
+    Write the serving bundle for the documents of rag_data.json (see write_bundle);
+    model is recorded when the documents do not name a single embedding model.
+    documents is iterated several times, one document at a time (a list, or a
+    DocumentStore view); the sentence embeddings are gathered in a memmap on disk.
+    """
+    def indexed():
+        return (doc for doc in documents if doc.get("sentence_embeddings"))
+
+    docs, counts, models, doc_embeddings, dim, pending = [], [], set(), [], 0, []
+    for doc in documents:
+        if not doc.get("sentence_embeddings"):
+            if doc.get("content", "").strip():
+                pending.append(doc["doc_id"])
+            continue
+        docs.append({"doc_id": doc["doc_id"], "source": doc["source"]})
+        counts.append(len(doc["sentence_embeddings"]))
+        dim = dim or len(doc["sentence_embeddings"][0]["embedding"])
+        if doc.get("embedding_model"):
+            models.add(doc["embedding_model"])
+        doc_embeddings.append(np.asarray(doc["embedding"], dtype=np.float32) if doc.get("embedding") else None)
+    doc_offsets = np.cumsum([0] + counts)
+
+    os.makedirs(bundle_dir, exist_ok=True)
+    raw_path = os.path.join(bundle_dir, f"embeddings-raw-{uuid.uuid4().hex[:6]}.npy.tmp")
+    if doc_offsets[-1]:
+        embeddings = np.lib.format.open_memmap(raw_path, mode="w+", dtype=np.float32,
+                                               shape=(int(doc_offsets[-1]), dim))
+        for i, doc in enumerate(indexed()):
+            embeddings[doc_offsets[i] : doc_offsets[i + 1]] = np.asarray(
+                [item["embedding"] for item in doc["sentence_embeddings"]], dtype=np.float32
+            )
+        embeddings.flush()
+    else:
+        embeddings = np.zeros((0, 0), dtype=np.float32)
+    if docs and all(embedding is not None for embedding in doc_embeddings):
+        doc_embeddings = np.stack(doc_embeddings)
+    else:
+        doc_embeddings = None
+    try:
+        return write_bundle(
+            bundle_dir,
+            docs,
+            (doc["content"] for doc in indexed()),
+            (item["sentence"] for doc in indexed() for item in doc["sentence_embeddings"]),
+            embeddings,
+            doc_offsets,
+            ivf_lists,
+            quantize,
+            (" ".join(doc.get("tokens", [])) for doc in indexed()),
+            doc_embeddings,
+            models.pop() if len(models) == 1 else model,
+            pending,
+        )
+    finally:
+        del embeddings
+        if os.path.exists(raw_path):
+            os.remove(raw_path)
+
+
+def write_bundle(bundle_dir, docs, contents, sentences, embeddings, doc_offsets, ivf_lists=0,
+                 quantize=(), tokens=None, doc_embeddings=None, model=None, pending=()):
+    """
+    Write the serving bundle loaded by SentenceIndex.from_bundle (index.py):
+      - embeddings: (n_sentences, dim) float32, L2-normalized, for np.load(mmap_mode="r")
+      - doc_offsets: sentences of doc i are rows doc_offsets[i]:doc_offsets[i + 1]
+      - sentences / contents: UTF-8 blobs with int64 byte offsets
+      - tokens: optional space-joined word tokens of each document, for the BM25 index
+      - doc_centroids / doc_radii: per-document bounds for coarse-to-fine search
+      - doc_embeddings: optional normalized whole-document embeddings
+      - docs.json: doc_id and source of each indexed document
+      - ivf_*: optional k-means inverted lists for approximate search (ivf_lists > 0)
+      - embeddings_int8 / embeddings_float16: optional compact copies (quantize)
+    The manifest lists the pending documents (no embeddings yet), which the
+    background indexer embeds before writing a bundle of its own.
+    Every file name carries the bundle version and manifest.json is replaced last,
+    so a reader always sees one complete version.
+    """
+    os.makedirs(bundle_dir, exist_ok=True)
+    old_manifest = read_manifest(bundle_dir)
+    version = time.strftime("%Y%m%d%H%M%S") + "-" + uuid.uuid4().hex[:6]
+
+    files = {
+        "embeddings": f"embeddings-{version}.npy",
+        "doc_offsets": f"doc_offsets-{version}.npy",
+        "docs": f"docs-{version}.json",
+    }
+    save_normalized(bundle_dir, files["embeddings"], embeddings)
+    save_array(bundle_dir, files["doc_offsets"], np.asarray(doc_offsets, dtype=np.int64))
+    files["sentences"] = save_strings(bundle_dir, f"sentences-{version}", sentences)
+    files["contents"] = save_strings(bundle_dir, f"contents-{version}", contents)
+    if tokens is not None:
+        files["tokens"] = save_strings(bundle_dir, f"tokens-{version}", tokens)
+    with open(os.path.join(bundle_dir, files["docs"]), "w", encoding="utf8") as f:
+        json.dump(docs, f)
+
+    n_sentences = len(embeddings)
+    n_lists = 0
+    if ivf_lists > 0 and n_sentences:
+        print(f"Training IVF index with {ivf_lists} lists...")
+        normalized = np.load(os.path.join(bundle_dir, files["embeddings"]), mmap_mode="r")
+        centroids, list_offsets, list_ids = build_ivf_index(normalized, ivf_lists)
+        n_lists = len(centroids)
+        files["ivf_centroids"] = f"ivf_centroids-{version}.npy"
+        files["ivf_offsets"] = f"ivf_offsets-{version}.npy"
+        files["ivf_ids"] = f"ivf_ids-{version}.npy"
+        save_array(bundle_dir, files["ivf_centroids"], centroids)
+        save_array(bundle_dir, files["ivf_offsets"], list_offsets)
+        save_array(bundle_dir, files["ivf_ids"], list_ids)
+
+    if n_sentences:
+        normalized = np.load(os.path.join(bundle_dir, files["embeddings"]), mmap_mode="r")
+        save_document_bounds(bundle_dir, files, version, normalized, doc_offsets)
+    if doc_embeddings is not None and len(doc_embeddings) == len(docs):
+        files["doc_embeddings"] = f"doc_embeddings-{version}.npy"
+        save_normalized(bundle_dir, files["doc_embeddings"], doc_embeddings)
+
+    if quantize and n_sentences:
+        normalized = np.load(os.path.join(bundle_dir, files["embeddings"]), mmap_mode="r")
+        for mode in quantize:
+            save_quantized(bundle_dir, files, version, normalized, mode)
+
+    manifest = {
+        "format": BUNDLE_FORMAT,
+        "version": version,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "model": model,
+        "dim": int(embeddings.shape[1]) if n_sentences else 0,
+        "n_docs": len(docs),
+        "n_sentences": n_sentences,
+        "ivf_lists": n_lists,
+        "quantized": [mode for mode in quantize if f"embeddings_{mode}" in files],
+        "pending": list(pending),
+        "files": files,
+    }
+    tmp_manifest = os.path.join(bundle_dir, BUNDLE_MANIFEST + ".tmp")
+    with open(tmp_manifest, "w", encoding="utf8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_manifest, os.path.join(bundle_dir, BUNDLE_MANIFEST))
+    remove_stale_bundle_files(bundle_dir, old_manifest, manifest)
+    print(f"Serving bundle {version} written to {bundle_dir} "
+          f"({len(docs)} documents, {n_sentences} sentences).")
+    return manifest
+
+
+def read_manifest(bundle_dir):
+    """Return the current bundle manifest, or None if there is no bundle yet."""
+    path = os.path.join(bundle_dir, BUNDLE_MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf8") as f:
+        return json.load(f)
+
+
+def manifest_file_names(manifest):
+    """Flatten the file names referenced by a manifest."""
+    names = []
+    for entry in manifest.get("files", {}).values():
+        names.extend(entry.values() if isinstance(entry, dict) else [entry])
+    return names
+
+
+def remove_stale_bundle_files(bundle_dir, old_manifest, new_manifest):
+    """Delete the previous version's files (processes that mapped them keep their pages)."""
+    if old_manifest is None:
+        return
+    keep = set(manifest_file_names(new_manifest))
+    for name in manifest_file_names(old_manifest):
+        path = os.path.join(bundle_dir, name)
+        if name not in keep and os.path.exists(path):
+            os.remove(path)
@@ -0,0 +1,231 @@
+import re
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+
+from index import normalize_vector
+from lexical import STOPWORDS
+
+
+def normalize_query(text):
+    """Cache key form of a query: lower-cased with collapsed whitespace."""
+    return " ".join(text.lower().split())
+
+
+def content_words(text):
+    """
+    Words of a normalized query that say what it is about: no stopwords and no
+    plural "s", so "Which projects use React?" and "what project uses react"
+    share them but "Which projects use Vue?" does not.
+    """
+    words = re.findall(r"[\w+#]+", normalize_query(text))
+    return frozenset(w[:-1] if len(w) > 3 and w.endswith("s") else w for w in words if w not in STOPWORDS)
+
+
+class EmbeddingCache:
+    """
+    Bounded in-process cache of query embeddings with LRU eviction and a TTL.
+    When path is set, entries are also written to a local SQLite file, so warm
+    embeddings survive restarts and are shared between gunicorn workers.
+    """
+
+    def __init__(self, max_entries=1024, ttl=86400, path=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self.entries = OrderedDict()  # key -> (expires_at, embedding)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.puts = 0
+        if path:
+            with self.connect() as db:
+                db.execute("PRAGMA journal_mode=WAL")
+                db.execute(
+                    "CREATE TABLE IF NOT EXISTS embeddings "
+                    "(key TEXT PRIMARY KEY, expires_at REAL, vector BLOB)"
+                )
+
+    @contextmanager
+    def connect(self):
+        # One short-lived connection per call: sqlite3 connections are not shared across threads.
+        db = sqlite3.connect(self.path, timeout=5)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def expiry(self):
+        return time.time() + self.ttl if self.ttl else float("inf")
+
+    def get(self, key):
+        """Return the cached embedding (float32 array) for key, or None."""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self.entries[key]
+
+        entry = self.get_from_disk(key, now) if self.path else None
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+        self.remember(key, entry[1], entry[0])
+        return entry[1]
+
+    def get_from_disk(self, key, now):
+        try:
+            with self.connect() as db:
+                row = db.execute(
+                    "SELECT expires_at, vector FROM embeddings WHERE key = ?", (key,)
+                ).fetchone()
+        except sqlite3.Error:
+            return None
+        if row is None or row[0] <= now:
+            return None
+        return row[0], np.frombuffer(row[1], dtype=np.float32)
+
+    def put(self, key, embedding):
+        embedding = np.asarray(embedding, dtype=np.float32)
+        expires_at = self.expiry()
+        self.remember(key, embedding, expires_at)
+        if self.path:
+            try:
+                with self.connect() as db:
+                    db.execute(
+                        "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)",
+                        (key, expires_at, embedding.tobytes()),
+                    )
+                    self.puts += 1
+                    if self.puts % 100 == 0:
+                        db.execute("DELETE FROM embeddings WHERE expires_at <= ?", (time.time(),))
+            except sqlite3.Error:
+                pass  # the disk store is best effort; the in-process cache still works
+
+    def remember(self, key, embedding, expires_at):
+        with self.lock:
+            self.entries[key] = (expires_at, embedding)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+                "disk_path": self.path,
+            }
+
+
+class SemanticResponseCache:
+    """
+    Cache of complete LLM answers keyed by query embedding. A lookup hits when a
+    cached query lies within max_distance (cosine distance) of the new query,
+    retrieved the same documents and has the same content words (embeddings of
+    queries differing in one name, "React" or "Vue", can be very close).
+    Entries live in a fixed slot matrix, so a lookup is one matrix-vector
+    product; the least recently used entry is evicted when the cache is full,
+    and everything is dropped when a lookup sees a new index version. Answers
+    stored for another version than the current one are discarded.
+    """
+
+    def __init__(self, max_entries=256, max_distance=0.03):
+        self.max_entries = max_entries
+        self.max_distance = max_distance
+        self.matrix = None            # (max_entries, dim) unit query embeddings
+        self.slots = OrderedDict()    # slot -> (doc_names, words, chunks), in LRU order
+        self.version = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def check_version(self, version):
+        # Caller holds self.lock.
+        if version != self.version:
+            if self.slots:
+                self.invalidations += 1
+            self.slots.clear()
+            self.version = version
+
+    def lookup(self, query_text, query_embedding, doc_names, version):
+        """Return the cached answer chunks for a near-identical query, or None."""
+        if self.max_entries <= 0:
+            return None
+        query = normalize_vector(query_embedding)
+        key = (tuple(doc_names), content_words(query_text))
+        with self.lock:
+            self.check_version(version)
+            if self.slots and self.matrix is not None and self.matrix.shape[1] == len(query):
+                slots = np.fromiter(self.slots.keys(), dtype=np.int64)
+                scores = self.matrix[slots] @ query
+                for i in np.argsort(-scores):
+                    if scores[i] < 1.0 - self.max_distance:
+                        break
+                    slot = int(slots[i])
+                    if self.slots[slot][:2] == key:
+                        self.slots.move_to_end(slot)
+                        self.hits += 1
+                        return self.slots[slot][2]
+            self.misses += 1
+            return None
+
+    def store(self, query_text, query_embedding, doc_names, chunks, version):
+        """Remember a fully streamed answer, unless the index changed since it was retrieved."""
+        if self.max_entries <= 0:
+            return
+        query = normalize_vector(query_embedding)
+        with self.lock:
+            if self.version is not None and version != self.version:
+                # Started before a reload: it must not wipe the new version's answers.
+                return
+            self.check_version(version)
+            if self.matrix is None or self.matrix.shape[1] != len(query):
+                self.matrix = np.zeros((self.max_entries, len(query)), dtype=np.float32)
+                self.slots.clear()
+            if len(self.slots) < self.max_entries:
+                used = set(self.slots)
+                slot = next(i for i in range(self.max_entries) if i not in used)
+            else:
+                slot, _ = self.slots.popitem(last=False)
+                self.evictions += 1
+            self.matrix[slot] = query
+            self.slots[slot] = (tuple(doc_names), content_words(query_text), list(chunks))
+            self.stores += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.slots),
+                "max_entries": self.max_entries,
+                "max_distance": self.max_distance,
+                "index_version": self.version,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
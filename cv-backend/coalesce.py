@@ -0,0 +1,123 @@
+import time
+import threading
+
+
+class Flight:
+    """
+    One upstream /rag computation shared by identical concurrent requests. The
+    producer publishes a result once retrieval is done, then the answer chunks;
+    every subscriber replays the chunks from the start, so a request joining
+    late still gets the whole answer.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.started = time.monotonic()
+        self.condition = threading.Condition()
+        self.result = None  # set by ready(): retrieval results, headers, timer
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.subscribers = 1
+
+    def ready(self, result):
+        with self.condition:
+            self.result = result
+            self.condition.notify_all()
+
+    def publish(self, chunk):
+        with self.condition:
+            self.chunks.append(chunk)
+            self.condition.notify_all()
+
+    def finish(self, error=None):
+        with self.condition:
+            self.done = True
+            self.error = error
+            self.condition.notify_all()
+
+    def wait_ready(self, timeout):
+        """The producer's result. Raises its error, or TimeoutError after timeout seconds."""
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.result is not None or self.done, timeout):
+                raise TimeoutError(f"No retrieval result within {timeout}s")
+            if self.result is None:
+                raise self.error or RuntimeError("The request finished without a result")
+            return self.result
+
+    def stream(self, timeout):
+        """
+        Answer chunks as they are published. Raises the producer's error, or
+        TimeoutError when no chunk arrives for timeout seconds.
+        """
+        sent = 0
+        while True:
+            with self.condition:
+                if not self.condition.wait_for(lambda: sent < len(self.chunks) or self.done, timeout):
+                    raise TimeoutError(f"No answer chunk within {timeout}s")
+                chunks = self.chunks[sent:]
+                done, error = self.done, self.error
+            sent += len(chunks)
+            yield from chunks
+            if done:
+                if error is not None:
+                    raise error
+                return
+
+
+class SingleFlight:
+    """
+    Coalesces identical in-flight requests. join(key, produce) starts
+    produce(flight) in a background thread for the first request of a key;
+    requests for the same key arriving within window seconds of it join that
+    flight instead of starting their own, and all of them stream its chunks.
+    The producer runs to completion even when its clients disconnect. Flights
+    are per process, so identical requests are merged within a gunicorn worker.
+    """
+
+    def __init__(self, window=2.0, timeout=60.0):
+        self.window = window
+        self.timeout = timeout  # longest wait of a subscriber for the next event
+        self.flights = {}       # key -> running Flight
+        self.lock = threading.Lock()
+        self.flights_started = 0
+        self.requests_merged = 0
+
+    def join(self, key, produce):
+        """Return (flight, joined): the flight serving key, and whether a running one was joined."""
+        now = time.monotonic()
+        with self.lock:
+            flight = self.flights.get(key)
+            if flight is not None and not flight.done and now - flight.started < self.window:
+                flight.subscribers += 1
+                self.requests_merged += 1
+                return flight, True
+            flight = Flight(key)
+            self.flights[key] = flight
+            self.flights_started += 1
+        threading.Thread(target=self.run, args=(flight, produce), name="single-flight", daemon=True).start()
+        return flight, False
+
+    def run(self, flight, produce):
+        error = None
+        try:
+            produce(flight)
+        except Exception as e:
+            error = e
+        finally:
+            with self.lock:
+                if self.flights.get(flight.key) is flight:
+                    del self.flights[flight.key]
+            flight.finish(error)
+
+    def stats(self):
+        with self.lock:
+            requests = self.flights_started + self.requests_merged
+            return {
+                "window": self.window,
+                "timeout": self.timeout,
+                "in_flight": len(self.flights),
+                "flights_started": self.flights_started,
+                "requests_merged": self.requests_merged,
+                "merge_rate": round(self.requests_merged / requests, 4) if requests else 0.0,
+            }
@@ -0,0 +1,218 @@
+"""
+Code-aware chunking of the gitingest dumps (github_parser/dataset/*.txt), and
+the units every document is embedded as: shared by prepare_data_rag.py and the
+background indexer, so a document gets the same chunks whichever path embeds it.
+
+A dump is a "### Directory Structure ###" header followed by one section per
+file:
+
+    ================================================
+    File: path/to/file.py
+    ================================================
+    <file content>
+
+Every file is cut at definition boundaries into chunks of about target_chars
+characters: Python with ast (top-level functions and classes, classes split
+into methods when too long, like parse_python_functions in extracter_old.py),
+Markdown at headings, and other languages at declaration-looking lines near
+the left margin. Each chunk starts with a "File: path" line so the embedding
+and the retrieved text say where the code comes from.
+"""
+
+import os
+import re
+import ast
+
+# ----------------------------
+# Configuration
+# ----------------------------
+TARGET_CHARS = 1500
+SECTION_RULE = re.compile(r"^={10,}\s*$")
+FILE_HEADER = re.compile(r"^File:\s*(.+?)\s*$")
+MARKDOWN_EXTENSIONS = {".md", ".rst", ".txt"}
+PYTHON_EXTENSIONS = {".py", ".pyw"}
+# Declaration-looking lines of C-like, JVM, JS/TS, Go, Rust, Ruby, PHP and SQL code.
+DECLARATION = re.compile(
+    r"^\s{0,4}(?:@\w+|(?:export\s+)?(?:default\s+)?(?:public|private|protected|internal|static|final|"
+    r"abstract|async|override|virtual|inline|extern|pub(?:\(\w+\))?)?\s*"
+    r"(?:function|class|interface|enum|struct|trait|impl|fn|func|def|module|namespace|type|record|"
+    r"const\s+\w+\s*=\s*(?:async\s*)?\(|create\s+(?:table|view|function|procedure|index))\b"
+    r"|(?:public|private|protected)\s+[\w<>\[\], ]+\s+\w+\s*\()",
+    re.IGNORECASE,
+)
+MARKDOWN_HEADING = re.compile(r"^#{1,6}\s")
+
+
+# ----------------------------
+# Sections of a dump
+# ----------------------------
+def split_sections(text):
+    """
+    (header, files) of a gitingest dump: the text before the first file section
+    and a list of (path, content). Text without sections is returned as header.
+    """
+    lines = text.split("\n")
+    header, files = [], []
+    path, body = None, []
+    i = 0
+    while i < len(lines):
+        if (i + 2 < len(lines) and SECTION_RULE.match(lines[i])
+                and FILE_HEADER.match(lines[i + 1]) and SECTION_RULE.match(lines[i + 2])):
+            if path is not None:
+                files.append((path, "\n".join(body).strip("\n")))
+            path, body = FILE_HEADER.match(lines[i + 1]).group(1), []
+            i += 3
+            continue
+        (body if path is not None else header).append(lines[i])
+        i += 1
+    if path is not None:
+        files.append((path, "\n".join(body).strip("\n")))
+    return "\n".join(header).strip(), files
+
+
+# ----------------------------
+# Definition boundaries
+# ----------------------------
+def python_units(code, lines, start=0, end=None, depth=0):
+    """
+    Line ranges (start, end) of the top-level statements of code: every
+    function or class with its decorators is a unit, and the statements
+    between them are grouped. Classes longer than TARGET_CHARS are split into
+    their methods. Raises SyntaxError for code ast cannot parse.
+    """
+    tree = ast.parse(code) if depth == 0 else None
+    body = tree.body if tree is not None else code
+    end = len(lines) if end is None else end
+    units, cursor = [], start
+    for node in body:
+        first = min([node.lineno] + [d.lineno for d in getattr(node, "decorator_list", [])]) - 1
+        last = node.end_lineno
+        if not isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            continue
+        if first > cursor:
+            units.append((cursor, first))
+        size = sum(len(line) + 1 for line in lines[first:last])
+        if isinstance(node, ast.ClassDef) and size > TARGET_CHARS and depth < 2:
+            units.extend(python_units(node.body, lines, first, last, depth + 1))
+        else:
+            units.append((first, last))
+        cursor = last
+    if cursor < end:
+        units.append((cursor, end))
+    return units
+
+
+def heuristic_units(lines, boundary):
+    """Line ranges split before every line matching boundary that follows a blank or closing line."""
+    starts = [0]
+    for i in range(1, len(lines)):
+        previous = lines[i - 1].strip()
+        if boundary.match(lines[i]) and (not previous or previous in ("}", "};", "end", "*/") or
+                                         previous.startswith(("//", "#", "/*", "*", "@"))):
+            # Keep comments and annotations right above a declaration with it.
+            j = i
+            while j > starts[-1] + 1 and lines[j - 1].strip().startswith(("//", "#", "/*", "*", "@")):
+                j -= 1
+            if j > starts[-1]:
+                starts.append(j)
+    return list(zip(starts, starts[1:] + [len(lines)]))
+
+
+def file_units(path, content, lines):
+    extension = os.path.splitext(path)[1].lower()
+    if extension in PYTHON_EXTENSIONS:
+        try:
+            return python_units(content, lines)
+        except (SyntaxError, ValueError, RecursionError):
+            pass
+    if extension in MARKDOWN_EXTENSIONS:
+        return heuristic_units(lines, MARKDOWN_HEADING)
+    return heuristic_units(lines, DECLARATION)
+
+
+# ----------------------------
+# Chunking
+# ----------------------------
+def split_sentences(text):
+    """NLTK sentences of text (imported lazily, punkt downloaded on first use)."""
+    import nltk
+    from nltk.tokenize import sent_tokenize
+    try:
+        sentences = sent_tokenize(text)
+    except LookupError:
+        # Recent NLTK releases load the "punkt_tab" variant of the punkt model.
+        for resource in ("punkt", "punkt_tab"):
+            nltk.download(resource, quiet=True)
+        sentences = sent_tokenize(text)
+    return [sentence for sentence in sentences if sentence.strip()]
+
+
+
+def pack_lines(lines, units, target_chars):
+    """
+    Merge consecutive units into chunks of up to target_chars characters, and
+    cut units longer than twice target_chars at line boundaries (lines longer
+    than target_chars, like minified code, are split across chunks).
+    """
+    chunks, current, size = [], [], 0
+
+    def flush():
+        nonlocal current, size
+        if current and any(line.strip() for line in current):
+            chunks.append("\n".join(current).strip("\n"))
+        current, size = [], 0
+
+    for start, end in units:
+        unit = lines[start:end]
+        unit_size = sum(len(line) + 1 for line in unit)
+        if unit_size > 2 * target_chars:
+            flush()
+            for line in unit:
+                for i in range(0, max(len(line), 1), target_chars):
+                    piece = line[i:i + target_chars]
+                    if size + len(piece) + 1 > target_chars and current:
+                        flush()
+                    current.append(piece)
+                    size += len(piece) + 1
+            flush()
+            continue
+        if size + unit_size > target_chars:
+            flush()
+        current.extend(unit)
+        size += unit_size
+    flush()
+    return chunks
+
+
+def chunk_file(path, content, target_chars=TARGET_CHARS):
+    """Chunks of one file, each prefixed with its "File: path" line."""
+    lines = content.split("\n")
+    return [f"File: {path}\n{chunk}" for chunk in pack_lines(lines, file_units(path, content, lines), target_chars)]
+
+
+def chunk_dump(text, target_chars=TARGET_CHARS):
+    """Chunks of a gitingest dump: its directory structure, then every file cut at definitions."""
+    header, files = split_sections(text)
+    chunks = []
+    if header:
+        header_lines = header.split("\n")
+        chunks.extend(pack_lines(header_lines, [(0, len(header_lines))], target_chars))
+    for path, content in files:
+        if content.strip():
+            chunks.extend(chunk_file(path, content, target_chars))
+    return chunks
+
+
+def chunking_of(doc, chunker="code"):
+    """How the units of doc are cut: "code" for the code dumps with the code chunker, else "sentences"."""
+    return "code" if chunker == "code" and doc["source"] == "txt" else "sentences"
+
+
+def text_units(doc, chunker="code", target_chars=TARGET_CHARS):
+    """
+    The units of doc that get their own embedding: definition-aligned chunks of
+    the code dumps (chunk_dump), NLTK sentences of everything else.
+    """
+    if chunking_of(doc, chunker) == "code":
+        return chunk_dump(doc["content"], target_chars)
+    return split_sentences(doc["content"])
@@ -0,0 +1,186 @@
+import re
+import json
+import threading
+
+from lexical import STOPWORDS
+
+# Spans longer than this (in characters) are split before packing.
+MAX_SPAN_CHARS = 600
+# Between the spans of a document's packed content.
+SPAN_SEPARATOR = "\n...\n"
+
+_encoding = None
+_encoding_loaded = False
+_encoding_lock = threading.Lock()
+
+
+def get_encoding():
+    """
+    The gpt-4o tiktoken encoding, loaded on first use (tiktoken may download it).
+    Returns None when tiktoken is not installed or the encoding is unavailable.
+    """
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        with _encoding_lock:
+            if not _encoding_loaded:
+                try:
+                    import tiktoken
+                    _encoding = tiktoken.encoding_for_model("gpt-4o")
+                except Exception:
+                    _encoding = None
+                _encoding_loaded = True
+    return _encoding
+
+
+def count_tokens(text):
+    """Number of gpt-4o tokens in text (estimated at ~4 chars/token without tiktoken)."""
+    encoding = get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return (len(text) + 3) // 4
+
+
+def truncate_tokens(text, max_tokens):
+    """The first max_tokens gpt-4o tokens of text (~4 chars/token without tiktoken)."""
+    encoding = get_encoding()
+    if encoding is not None:
+        return encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens])
+    return text[: 4 * max_tokens]
+
+
+def compact_json(value):
+    """JSON without indentation or padding, as sent to the LLM."""
+    return json.dumps(value, separators=(",", ":"), ensure_ascii=False)
+
+
+def terms(text):
+    return {t for t in re.findall(r"[a-z0-9_]+", text.lower()) if len(t) > 2 and t not in STOPWORDS}
+
+
+def split_spans(content):
+    """Split a document into paragraph-sized spans (blank-line separated, capped in length)."""
+    spans = []
+    for paragraph in re.split(r"\n\s*\n", content):
+        paragraph = paragraph.strip()
+        while len(paragraph) > MAX_SPAN_CHARS:
+            cut = paragraph.rfind("\n", 0, MAX_SPAN_CHARS)
+            if cut <= 0:
+                cut = paragraph.rfind(" ", 0, MAX_SPAN_CHARS)
+            if cut <= 0:
+                cut = MAX_SPAN_CHARS
+            spans.append(paragraph[:cut].strip())
+            paragraph = paragraph[cut:].strip()
+        if paragraph:
+            spans.append(paragraph)
+    return spans
+
+
+def pack_context(query, retrieval_results, token_budget):
+    """
+    Fit the retrieval results into token_budget tokens of compact JSON.
+    Top sentences (duplicates across documents dropped) are kept best score
+    first while they fit; the best one of a document that would not fit is cut
+    to the tokens left, so long chunks cannot overflow the budget. The rest of
+    the budget is filled with the document spans that share the most terms
+    with the query and the top sentences, per token, replacing the full
+    document content. Spans are charged what they cost inside the JSON string
+    (escapes and separator included), and the packed context is counted again
+    at the end, dropping the last spans chosen until it fits. Returns
+    (packed_results, stats).
+    """
+    query_terms = terms(query)
+    seen_sentences = set()
+    packed = []
+    sentences = []  # (score, doc position, sentence position, item)
+    candidates = []  # (value, doc position, span position, span, tokens)
+    deduplicated = 0
+
+    for doc_pos, doc in enumerate(retrieval_results):
+        for sentence_pos, item in enumerate(doc["cosine_sentence_score"]):
+            key = " ".join(item["sentence"].split())
+            if key in seen_sentences:
+                deduplicated += 1
+                continue
+            seen_sentences.add(key)
+            sentences.append((item.get("score", 0), doc_pos, sentence_pos, item))
+        packed.append({
+            "document_name": doc["document_name"],
+            "type": doc["type"],
+            "cosine_sentence_score": [],
+            "full_document_content": "",
+        })
+
+    used = count_tokens(compact_json(packed))
+    kept, truncated = {}, 0
+    for score, doc_pos, sentence_pos, item in sorted(sentences, key=lambda s: -s[0]):
+        tokens = count_tokens(compact_json(item)) + 1
+        if used + tokens > token_budget:
+            if doc_pos in kept:
+                continue
+            # JSON escapes can make the cut text cost more than its own tokens: cut again.
+            left, sentence = count_tokens(item["sentence"]), item["sentence"]
+            while used + tokens > token_budget and left > 0:
+                left -= used + tokens - token_budget
+                item = {**item, "sentence": truncate_tokens(sentence, left)}
+                tokens = count_tokens(compact_json(item)) + 1
+            if left <= 0:
+                continue
+            truncated += 1
+        kept.setdefault(doc_pos, []).append((sentence_pos, item))
+        used += tokens
+    for doc_pos, items in kept.items():
+        packed[doc_pos]["cosine_sentence_score"] = [item for _, item in sorted(items, key=lambda i: i[0])]
+
+    for doc_pos, doc in enumerate(retrieval_results):
+        top_sentences = packed[doc_pos]["cosine_sentence_score"]
+        # Text already shown as a top sentence is not repeated in the excerpts.
+        content = doc["full_document_content"]
+        for item in top_sentences:
+            if item["sentence"] in content:
+                content = content.replace(item["sentence"], " ")
+                deduplicated += 1
+        sentence_terms = set().union(*(terms(item["sentence"]) for item in top_sentences))
+        for span_pos, span in enumerate(split_spans(content)):
+            span_terms = terms(span)
+            overlap = 2 * len(span_terms & query_terms) + len(span_terms & sentence_terms)
+            if not overlap:
+                continue
+            tokens = count_tokens(span)
+            candidates.append((overlap / (tokens + 1), doc_pos, span_pos, span, tokens))
+
+    used = count_tokens(compact_json(packed))
+    separator_tokens = count_tokens(compact_json(SPAN_SEPARATOR)) - 2
+    chosen, order = {}, []
+    for value, doc_pos, span_pos, span, tokens in sorted(candidates, key=lambda c: -c[0]):
+        # Without its quotes: JSON escapes (newlines, quotes, backslashes) cost tokens too.
+        cost = count_tokens(compact_json(span)) - 2 + separator_tokens
+        if used + cost > token_budget:
+            continue
+        chosen.setdefault(doc_pos, []).append((span_pos, span))
+        order.append((doc_pos, span_pos, span))
+        used += cost
+
+    for doc_pos in chosen:
+        join_spans(packed[doc_pos], chosen[doc_pos])
+    # Tokens do not add up exactly where spans meet: drop the least valuable until it fits.
+    while order and count_tokens(compact_json(packed)) > token_budget:
+        doc_pos, span_pos, span = order.pop()
+        chosen[doc_pos].remove((span_pos, span))
+        join_spans(packed[doc_pos], chosen[doc_pos])
+
+    stats = {
+        "context_tokens": count_tokens(compact_json(packed)),
+        "context_budget": token_budget,
+        "spans_packed": sum(len(spans) for spans in chosen.values()),
+        "spans_available": len(candidates),
+        "sentences_deduplicated": deduplicated,
+        "sentences_packed": sum(len(items) for items in kept.values()),
+        "sentences_truncated": truncated,
+        "tokenizer": "tiktoken" if get_encoding() is not None else "estimate",
+    }
+    return packed, stats
+
+
+def join_spans(packed_doc, spans):
+    """Set the packed document content to its (span position, span) spans, in document order."""
+    packed_doc["full_document_content"] = SPAN_SEPARATOR.join(span for _, span in sorted(spans))
@@ -0,0 +1,147 @@
+import threading
+
+import numpy as np
+
+# "openai" calls the embeddings API; "local" runs a sentence-transformers model on the CPU.
+EMBEDDING_PROVIDERS = ("openai", "local")
+DEFAULT_MODELS = {
+    "openai": "text-embedding-ada-002",
+    "local": "all-MiniLM-L6-v2",
+}
+# The OpenAI embedding models reject inputs over 8191 (cl100k_base) tokens: longer
+# texts are embedded in pieces of at most MAX_INPUT_TOKENS and averaged.
+MAX_INPUT_TOKENS = 8000
+
+_encoding = None
+_encoding_loaded = False
+_encoding_lock = threading.Lock()
+
+
+class OpenAIEmbedder:
+    """Embeddings from the OpenAI API, one request per list of texts."""
+
+    provider = "openai"
+
+    def __init__(self, model, get_client):
+        self.model = model
+        self.get_client = get_client  # () -> OpenAI client, created lazily by the caller
+
+    def warm(self):
+        self.get_client()
+
+    def embed(self, texts):
+        """Embed a list of texts with one embeddings API call, in input order."""
+        response = self.get_client().embeddings.create(input=texts, model=self.model)
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+
+class LocalEmbedder:
+    """
+    Embeddings from a sentence-transformers model kept in memory. The model is
+    loaded on first use (or by warm()), and texts are encoded in batches of
+    batch_size. Needs the optional sentence-transformers package.
+    """
+
+    provider = "local"
+
+    def __init__(self, model, batch_size=64, device="cpu"):
+        self.model = model
+        self.batch_size = batch_size
+        self.device = device
+        self.encoder = None
+        self.lock = threading.Lock()
+
+    def warm(self):
+        self.get_encoder()
+
+    def get_encoder(self):
+        if self.encoder is None:
+            with self.lock:
+                if self.encoder is None:
+                    try:
+                        from sentence_transformers import SentenceTransformer
+                    except ImportError as e:
+                        raise RuntimeError(
+                            "EMBEDDING_PROVIDER=local needs the sentence-transformers package"
+                        ) from e
+                    self.encoder = SentenceTransformer(self.model, device=self.device)
+        return self.encoder
+
+    def embed(self, texts):
+        """Embed a list of texts in batches, in input order (float32, L2-normalized)."""
+        vectors = self.get_encoder().encode(
+            list(texts), batch_size=self.batch_size, convert_to_numpy=True,
+            normalize_embeddings=True, show_progress_bar=False,
+        )
+        return list(np.asarray(vectors, dtype=np.float32))
+
+
+def make_embedder(provider, model=None, get_client=None, batch_size=64):
+    """Embedder for provider ("openai" or "local"); model defaults to DEFAULT_MODELS[provider]."""
+    if provider not in EMBEDDING_PROVIDERS:
+        raise ValueError(f"Unknown embedding provider {provider!r}, expected one of {EMBEDDING_PROVIDERS}")
+    model = model or DEFAULT_MODELS[provider]
+    if provider == "openai":
+        return OpenAIEmbedder(model, get_client)
+    return LocalEmbedder(model, batch_size=batch_size)
+
+
+def get_encoding():
+    """The cl100k_base tiktoken encoding of the embedding models, or None without tiktoken."""
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        with _encoding_lock:
+            if not _encoding_loaded:
+                try:
+                    import tiktoken
+                    _encoding = tiktoken.get_encoding("cl100k_base")
+                except Exception:
+                    _encoding = None
+                _encoding_loaded = True
+    return _encoding
+
+
+def token_pieces(text, max_tokens=MAX_INPUT_TOKENS):
+    """
+    text cut into consecutive pieces of at most max_tokens tokens, as a list of
+    (piece, tokens). Without tiktoken, tokens are estimated at 2 characters
+    each, a safe bound even for dense code or data.
+    """
+    encoding = get_encoding()
+    if encoding is None:
+        step = 2 * max_tokens
+        return [(text[i : i + step], (len(text[i : i + step]) + 1) // 2)
+                for i in range(0, max(len(text), 1), step)]
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return [(text, len(tokens))]
+    return [(encoding.decode(tokens[i : i + max_tokens]), len(tokens[i : i + max_tokens]))
+            for i in range(0, len(tokens), max_tokens)]
+
+
+def average(embeddings):
+    """Element-wise mean of a list of embeddings, or None when it is empty."""
+    if not embeddings:
+        return None
+    if len(embeddings) == 1:
+        return np.asarray(embeddings[0], dtype=np.float64).tolist()
+    return np.mean(np.asarray(embeddings, dtype=np.float64), axis=0).tolist()
+
+
+def pool_document_embedding(sentences, vectors, chunk_size=1000):
+    """
+    Document embedding pooled from its sentence embeddings instead of embedding
+    the text again: consecutive sentences are grouped into chunks of about
+    chunk_size words, each chunk is the word-count-weighted mean of its
+    sentence vectors (normalized), and the document is the mean of its chunks,
+    like the embedded chunks of prepare_data_rag.py's "embed" mode.
+    """
+    if not len(vectors):
+        return None
+    vectors = np.asarray(vectors, dtype=np.float64)
+    lengths = np.maximum([len(sentence.split()) for sentence in sentences], 1).astype(np.float64)
+    chunk_ids = ((np.cumsum(lengths) - lengths) // chunk_size).astype(np.int64)
+    starts = np.flatnonzero(np.r_[True, chunk_ids[1:] != chunk_ids[:-1]])
+    chunks = np.add.reduceat(vectors * lengths[:, None], starts) / np.add.reduceat(lengths, starts)[:, None]
+    chunks /= np.maximum(np.linalg.norm(chunks, axis=1, keepdims=True), 1e-12)
+    return chunks.mean(axis=0).tolist()
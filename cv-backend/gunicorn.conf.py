@@ -0,0 +1,38 @@
+import os
+
+# Gunicorn settings for the RAG backend (loaded automatically from the working directory).
+bind = ":8080"
+workers = int(os.getenv("GUNICORN_WORKERS", "2"))
+
+# Import the app and load the sentence index once in the master, then fork the
+# workers: they all read the same physical pages of the index, so raising
+# GUNICORN_WORKERS does not multiply its memory. Set GUNICORN_PRELOAD=0 to load
+# the app (and the index) in every worker instead.
+preload_app = os.getenv("GUNICORN_PRELOAD", "1") == "1"
+
+# "gevent" runs each request in a greenlet: while one /rag request waits on the
+# embeddings API or on upstream LLM tokens, the same worker keeps serving other
+# requests, so a single process can hold hundreds of concurrent streams.
+# Set GUNICORN_WORKER_CLASS=sync to get the old one-request-per-worker behaviour.
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gevent")
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "500"))
+
+# With preload_app the app is imported in the master, before the gevent worker
+# would patch the standard library; patch it here, ahead of every other import.
+if preload_app and worker_class == "gevent":
+    from gevent import monkey
+    monkey.patch_all()
+
+# Long LLM streams must not be mistaken for a hung worker.
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+
+def when_ready(server):
+    # Runs in the master after the app was imported and before workers are forked.
+    if server.cfg.preload_app:
+        import main
+        main.preload_index()
+
+def post_worker_init(worker):
+    # Warm the index and clients right after boot instead of on the first request.
+    import main
+    main.start_warmup()
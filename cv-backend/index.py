@@ -0,0 +1,655 @@
+import os
+import json
+import heapq
+import threading
+import numpy as np
+
+from bundle import BUNDLE_MANIFEST, BUNDLE_FORMAT, read_manifest
+from lexical import BM25Index, tokenize
+
+# "exact" scores every sentence; "ivf" only scores the inverted lists closest to the query;
+# "int8" / "float16" score a compact copy of the matrix and rescore a shortlist at full precision;
+# "coarse" scores documents in order of a centroid + radius bound and stops when none can qualify.
+RETRIEVAL_MODES = ("exact", "ivf", "int8", "float16", "coarse")
+QUANTIZED_MODES = ("int8", "float16")
+# Bytes of float32 scratch used when scoring a quantized matrix block by block, and
+# the documents shortlisted per requested document before exact rescoring.
+QUANTIZED_BLOCK_BYTES = 4 << 20
+QUANTIZED_DOC_OVERSAMPLE = 4
+
+
+def normalize_rows(matrix):
+    """L2-normalize every row of a 2-D array (zero rows are left as zeros)."""
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def normalize_vector(vector):
+    """Return the query embedding as a unit-length float32 vector."""
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+class MappedStrings:
+    """
+    Read-only sequence of UTF-8 strings stored back to back in a memory-mapped
+    blob; a string is only decoded when it is accessed.
+    """
+
+    def __init__(self, blob_path, offsets):
+        self.offsets = offsets
+        if os.path.getsize(blob_path):
+            self.blob = np.memmap(blob_path, dtype=np.uint8, mode="r")
+        else:
+            self.blob = np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.blob[self.offsets[i]:self.offsets[i + 1]].tobytes().decode("utf8")
+
+
+def quantize_rows(block, mode):
+    """
+    Compact form of L2-normalized float32 rows: (codes, scales) where int8 codes
+    are scaled per row by scales / 127, and float16 rows need no scale (None).
+    """
+    block = np.asarray(block, dtype=np.float32)
+    if mode == "float16":
+        return block.astype(np.float16), None
+    scales = np.abs(block).max(axis=1) if block.size else np.zeros(len(block), dtype=np.float32)
+    scales[scales == 0] = 1.0
+    codes = np.rint(block / scales[:, None] * 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def block_size(matrix):
+    """Rows per block so that a float32 copy of the block takes QUANTIZED_BLOCK_BYTES."""
+    dim = matrix.shape[1] if matrix.ndim == 2 else 1
+    return max(1, QUANTIZED_BLOCK_BYTES // (4 * max(1, dim)))
+
+
+def read_rows(matrix, rows, matrix_file=None):
+    """
+    matrix[rows] for a few sorted rows. Rows of a memory-mapped matrix are read
+    with pread from matrix_file, the file opened with the mapping: faulting them
+    in would also map the neighbouring pages of every row (fault-around), and
+    the resident set would grow to the whole file. The file is never reopened
+    by name, so an index keeps working after a newer bundle deleted its files.
+    """
+    if not isinstance(matrix, np.memmap) or matrix_file is None:
+        return matrix[rows]
+    row_bytes = matrix.shape[1] * matrix.itemsize
+    out = np.empty((len(rows), matrix.shape[1]), dtype=matrix.dtype)
+    for i, row in enumerate(rows):
+        data = os.pread(matrix_file.fileno(), row_bytes, matrix.offset + int(row) * row_bytes)
+        out[i] = np.frombuffer(data, dtype=matrix.dtype)
+    return out
+
+
+class QuantizedMatrix:
+    """
+    int8 (scalar-quantized) or float16 copy of the sentence matrix. It is 4x
+    or 2x smaller than the float32 matrix; scores are approximate and only
+    used to pick the shortlist that is rescored at full precision.
+    """
+
+    def __init__(self, mode, codes, scales=None):
+        self.mode = mode
+        self.codes = codes    # (n_sentences, dim) int8 or float16
+        self.scales = scales  # (n_sentences,) float32 for int8, else None
+
+    @classmethod
+    def from_matrix(cls, matrix, mode):
+        """Quantize a (possibly memory-mapped) float32 matrix block by block."""
+        dtype = np.int8 if mode == "int8" else np.float16
+        codes = np.empty(matrix.shape, dtype=dtype)
+        scales = np.empty(len(matrix), dtype=np.float32) if mode == "int8" else None
+        block_rows = block_size(matrix)
+        for start in range(0, len(matrix), block_rows):
+            block_codes, block_scales = quantize_rows(matrix[start : start + block_rows], mode)
+            codes[start : start + len(block_codes)] = block_codes
+            if scales is not None:
+                scales[start : start + len(block_codes)] = block_scales
+        return cls(mode, codes, scales)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def score(self, query):
+        """Approximate cosine scores of the (normalized) query against every row."""
+        scores = np.empty(len(self.codes), dtype=np.float32)
+        block_rows = block_size(self.codes)
+        for start in range(0, len(self.codes), block_rows):
+            block = np.asarray(self.codes[start : start + block_rows], dtype=np.float32)
+            scores[start : start + len(block)] = block @ query
+        if self.scales is not None:
+            scores *= self.scales / 127
+        return scores
+
+
+def document_bounds(matrix, doc_offsets):
+    """
+    Centroid direction c (normalized mean row) and angular radius r (largest
+    angle between a row and c) of every document's sentence rows: the rows lie
+    in a cone around c, so for a unit query q at angle a from c, every sentence
+    s of the document has q.s <= cos(max(0, a - r)).
+    """
+    n_docs = len(doc_offsets) - 1
+    dim = matrix.shape[1] if matrix.ndim == 2 else 0
+    centroids = np.zeros((n_docs, dim), dtype=np.float32)
+    radii = np.full(n_docs, np.pi, dtype=np.float32)
+    block_rows = block_size(matrix)
+    for i in range(n_docs):
+        start, end = int(doc_offsets[i]), int(doc_offsets[i + 1])
+        if end <= start:
+            continue
+        total = np.zeros(dim, dtype=np.float64)
+        for block_start in range(start, end, block_rows):
+            total += np.asarray(matrix[block_start : min(end, block_start + block_rows)]).sum(axis=0)
+        centroids[i] = normalize_vector(total)
+        lowest = 1.0
+        for block_start in range(start, end, block_rows):
+            block = np.asarray(matrix[block_start : min(end, block_start + block_rows)], dtype=np.float32)
+            lowest = min(lowest, float((block @ centroids[i]).min()))
+        radii[i] = np.arccos(np.clip(lowest, -1.0, 1.0))
+    return centroids, radii
+
+
+class IVFLists:
+    """
+    Inverted-file partition of the sentence matrix, trained offline with
+    k-means (see build_ivf_index in bundle.py). Rows assigned to
+    list l are ids[offsets[l]:offsets[l + 1]]. Probing more lists raises
+    recall at the cost of scoring more sentences.
+    """
+
+    def __init__(self, centroids, offsets, ids):
+        self.centroids = centroids  # (n_lists, dim) float32, unit rows
+        self.offsets = offsets      # (n_lists + 1,) int64
+        self.ids = ids              # sentence rows grouped by list
+
+    def __len__(self):
+        return len(self.centroids)
+
+    def candidates(self, query, nprobe):
+        """Sorted sentence rows of the nprobe lists closest to the (normalized) query."""
+        nprobe = max(1, min(nprobe, len(self.centroids)))
+        centroid_scores = self.centroids @ query
+        probe = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+        rows = np.concatenate([self.ids[self.offsets[l]:self.offsets[l + 1]] for l in probe])
+        return np.sort(rows)
+
+
+class SentenceIndex:
+    """
+    All sentence embeddings of the corpus stacked into a single pre-normalized
+    float32 matrix. Sentences of the i-th indexed document live in rows
+    doc_offsets[i]:doc_offsets[i + 1], so a query is one matrix-vector product
+    followed by a per-document max reduction.
+    """
+
+    def __init__(self, docs, contents, sentences, matrix, doc_offsets, version=None, ivf=None,
+                 quantized=None, tokens=None, doc_embeddings=None, bounds=None, model=None, pending=None,
+                 matrix_file=None):
+        self.docs = docs                # [{"doc_id", "source"}, ...]
+        self.contents = contents        # full document text, aligned with docs
+        self.sentences = sentences      # sentence text, row-aligned with matrix
+        self.matrix = matrix            # (n_sentences, dim) float32, unit rows
+        self.matrix_file = matrix_file  # open file of a memory-mapped matrix, for read_rows
+        self.doc_offsets = doc_offsets  # (n_docs + 1,) int64
+        self.version = version
+        self.model = model              # embedding model of the sentence vectors, when known
+        self.ivf = ivf                  # IVFLists built offline, or None
+        self.quantized = dict(quantized or {})  # mode -> QuantizedMatrix, built on first use
+        self.tokens = tokens            # stored tokens of each document (list or space-joined), or None
+        self.lexical = None             # BM25Index, built on first use
+        self.doc_embeddings = doc_embeddings  # (n_docs, dim) unit whole-document embeddings, or None
+        self.bounds = bounds            # (centroids, radii) of the documents, built on first use
+        self.pending = pending          # doc_ids of the source still waiting for embeddings, when known
+        self.build_lock = threading.Lock()
+        self.scoring = {}               # mode -> {"queries", "sentences_scored", "documents_scored"}
+        self.scoring_lock = threading.Lock()
+
+    @classmethod
+    def from_documents(cls, documents, version=None):
+        """Build the index from the documents list stored in rag_data.json."""
+        docs = []
+        contents = []
+        sentences = []
+        rows = []
+        offsets = [0]
+        tokens = []
+        doc_embeddings = []
+        models = set()
+        for doc in documents:
+            sentence_embeds = doc.get("sentence_embeddings", [])
+            if not sentence_embeds:
+                continue
+            for item in sentence_embeds:
+                sentences.append(item["sentence"])
+                rows.append(item["embedding"])
+            docs.append({"doc_id": doc["doc_id"], "source": doc["source"]})
+            contents.append(doc["content"])
+            tokens.append(doc.get("tokens"))
+            doc_embeddings.append(doc.get("embedding"))
+            if doc.get("embedding_model"):
+                models.add(doc["embedding_model"])
+            offsets.append(len(sentences))
+
+        if rows:
+            matrix = normalize_rows(np.asarray(rows, dtype=np.float32))
+        else:
+            matrix = np.zeros((0, 0), dtype=np.float32)
+        if doc_embeddings and all(doc_embeddings) and len(doc_embeddings[0]) == matrix.shape[1]:
+            doc_embeddings = normalize_rows(np.asarray(doc_embeddings, dtype=np.float32))
+        else:
+            doc_embeddings = None
+        return cls(docs, contents, sentences, matrix, np.asarray(offsets, dtype=np.int64),
+                   version=version, tokens=tokens, doc_embeddings=doc_embeddings,
+                   model=models.pop() if len(models) == 1 else None)
+
+    @classmethod
+    def from_bundle(cls, bundle_dir):
+        """
+        Open a serving bundle without copying it: the embedding matrix and the
+        text blobs are memory-mapped, so loading takes milliseconds and the
+        pages are shared by every process that maps the same files. Every file
+        is mapped, read or opened here and never again by name, so the index
+        keeps working after a newer bundle deleted them (hot reload).
+        """
+        manifest = read_manifest(bundle_dir)
+        if manifest is None:
+            raise FileNotFoundError(f"No {BUNDLE_MANIFEST} in {bundle_dir}")
+        if manifest.get("format") != BUNDLE_FORMAT:
+            raise ValueError(f"Unsupported bundle format {manifest.get('format')} in {bundle_dir}")
+        files = manifest["files"]
+
+        def path(name):
+            return os.path.join(bundle_dir, name)
+
+        def strings(entry):
+            return MappedStrings(path(entry["blob"]), np.load(path(entry["offsets"]), mmap_mode="r"))
+
+        with open(path(files["docs"]), "r", encoding="utf8") as f:
+            docs = json.load(f)
+        quantized = {}
+        for mode in QUANTIZED_MODES:
+            if f"embeddings_{mode}" in files:
+                scales = files.get(f"embeddings_{mode}_scales")
+                quantized[mode] = QuantizedMatrix(
+                    mode,
+                    np.load(path(files[f"embeddings_{mode}"]), mmap_mode="r"),
+                    np.load(path(scales)) if scales else None,
+                )
+        ivf = None
+        if "ivf_centroids" in files:
+            ivf = IVFLists(
+                np.load(path(files["ivf_centroids"])),
+                np.load(path(files["ivf_offsets"])),
+                np.load(path(files["ivf_ids"]), mmap_mode="r"),
+            )
+        # Opened once with the mapping and kept for the life of the index (see read_rows).
+        matrix_file = open(path(files["embeddings"]), "rb", buffering=0)
+        return cls(
+            docs,
+            strings(files["contents"]),
+            strings(files["sentences"]),
+            np.load(path(files["embeddings"]), mmap_mode="r"),
+            np.load(path(files["doc_offsets"])),
+            version=manifest["version"],
+            model=manifest.get("model"),
+            pending=manifest.get("pending"),
+            ivf=ivf,
+            quantized=quantized,
+            tokens=strings(files["tokens"]) if "tokens" in files else None,
+            doc_embeddings=np.load(path(files["doc_embeddings"])) if "doc_embeddings" in files else None,
+            bounds=(np.load(path(files["doc_centroids"])), np.load(path(files["doc_radii"])))
+            if "doc_centroids" in files else None,
+            matrix_file=matrix_file,
+        )
+
+    def __len__(self):
+        return len(self.sentences)
+
+    def get_quantized(self, mode):
+        """The int8 or float16 copy of the matrix (from the bundle, or quantized now)."""
+        if mode not in self.quantized:
+            with self.build_lock:
+                if mode not in self.quantized:
+                    self.quantized[mode] = QuantizedMatrix.from_matrix(self.matrix, mode)
+        return self.quantized[mode]
+
+    def get_lexical(self):
+        """The BM25 index of the documents, built from their stored tokens on first use."""
+        if self.lexical is None:
+            with self.build_lock:
+                if self.lexical is None:
+                    self.lexical = BM25Index.from_token_lists(
+                        [self.document_tokens(i) for i in range(len(self.docs))]
+                    )
+        return self.lexical
+
+    def get_bounds(self):
+        """(centroids, radii) of the documents, from the bundle or computed now."""
+        if self.bounds is None:
+            with self.build_lock:
+                if self.bounds is None:
+                    self.bounds = document_bounds(self.matrix, self.doc_offsets)
+        return self.bounds
+
+    def record_scoring(self, mode, stats):
+        """Add the sentences and documents one query scored to the per-mode totals."""
+        with self.scoring_lock:
+            totals = self.scoring.setdefault(
+                mode, {"queries": 0, "sentences_scored": 0, "documents_scored": 0}
+            )
+            totals["queries"] += 1
+            totals["sentences_scored"] += stats.get("sentences_scored", 0)
+            totals["documents_scored"] += stats.get("documents_scored", 0)
+
+    def scoring_stats(self):
+        """Per retrieval mode that ran (see search()): queries, and the mean sentences / documents scored per query."""
+        with self.scoring_lock:
+            return {
+                mode: {
+                    **totals,
+                    "mean_sentences_scored": round(totals["sentences_scored"] / totals["queries"], 1),
+                    "mean_fraction_scored": round(
+                        totals["sentences_scored"] / totals["queries"] / max(1, len(self)), 4
+                    ),
+                    "mean_documents_scored": round(totals["documents_scored"] / totals["queries"], 1),
+                }
+                for mode, totals in self.scoring.items()
+            }
+
+    def document_tokens(self, doc_idx):
+        """Tokens of a document: stored by prepare_data_rag.py, or tokenized from its content."""
+        tokens = self.tokens[doc_idx] if self.tokens is not None else None
+        if isinstance(tokens, str):
+            return tokens.split(" ") if tokens else tokenize(self.contents[doc_idx])
+        return tokens if tokens else tokenize(self.contents[doc_idx])
+
+    def memory_stats(self):
+        """
+        Bytes taken by the sentence vectors in each representation, and what the
+        quantized copies save against the float32 matrix and against the float64
+        arrays np.array() makes of the embedding lists in rag_data.json.
+        """
+        n_values = self.matrix.size
+        float32_bytes = n_values * 4
+        stats = {
+            "float64_bytes": n_values * 8,
+            "float32_bytes": float32_bytes,
+            "float32_memory_mapped": isinstance(self.matrix, np.memmap),
+        }
+        for mode in QUANTIZED_MODES:
+            if mode in self.quantized:
+                nbytes = self.quantized[mode].nbytes
+            else:
+                nbytes = n_values * (1 if mode == "int8" else 2) + (len(self) * 4 if mode == "int8" else 0)
+            stats[f"{mode}_bytes"] = nbytes
+            stats[f"{mode}_loaded"] = mode in self.quantized
+            stats[f"{mode}_saved_vs_float32"] = float32_bytes - nbytes
+        return stats
+
+    def score(self, query_embedding):
+        """Cosine similarity of the query against every sentence in the index."""
+        return self.matrix @ normalize_vector(query_embedding)
+
+    def doc_best_scores(self, scores):
+        """Best sentence score of every document (max over its row range)."""
+        return np.maximum.reduceat(scores, self.doc_offsets[:-1])
+
+    def rank_documents(self, doc_best, top_k, threshold):
+        """Indices of the top_k documents whose best score reaches threshold, best first."""
+        candidates = np.flatnonzero(doc_best >= threshold)
+        if len(candidates) > top_k:
+            keep = np.argpartition(-doc_best[candidates], top_k - 1)[:top_k]
+            candidates = candidates[keep]
+        return candidates[np.argsort(-doc_best[candidates], kind="stable")]
+
+    def search(self, query_embedding, top_k=2, threshold=0.5, top_n_sentences=3,
+               mode="exact", nprobe=8, rescore=256, query_text=None, lexical_weight=0.0, prefilter=0,
+               coarse_docs=0, stats=None):
+        """
+        Rank documents by their best sentence score and return the top_k
+        documents above threshold in the retrieval schema. mode="ivf" only
+        scores the nprobe inverted lists nearest to the query (falls back to
+        exact when the bundle has no IVF lists); mode="int8" / "float16" score
+        the quantized matrix and rescore the best rescore sentences exactly;
+        mode="coarse" skips documents whose centroid + radius bound cannot
+        reach threshold or beat the top_k documents found so far, and with
+        coarse_docs > 0 only considers the coarse_docs documents whose
+        whole-document embedding is closest to the query.
+
+        With query_text, documents can also be matched lexically (BM25 over
+        their tokens): lexical_weight adds the normalized BM25 score to the
+        document score, best sentence score + w * BM25 / (the most any
+        document could score for the query's non-stopword terms), so exact
+        term matches (identifiers, library names) rank higher and documents
+        without one keep their dense score; prefilter > 0 only scores the
+        sentences of the prefilter best BM25 documents (all documents when none
+        matches a query term).
+
+        The mode that actually ran ("prefilter" when the prefilter replaced
+        the requested mode, "exact" for ivf without IVF lists) and the
+        sentences and documents scored are written to stats when given, and
+        added to the totals of scoring_stats() under that mode.
+        """
+        if mode not in RETRIEVAL_MODES:
+            raise ValueError(f"Unknown retrieval mode {mode!r}, expected one of {RETRIEVAL_MODES}")
+        if not self.docs or top_k <= 0:
+            return []
+        stats = {} if stats is None else stats
+        lexical = None
+        if query_text and (lexical_weight > 0 or prefilter > 0):
+            lexical = self.get_lexical().normalized_scores(query_text)
+        if prefilter > 0 and lexical is not None and lexical.any():
+            mode = "prefilter"
+            results = self.search_prefiltered(query_embedding, top_k, threshold, top_n_sentences,
+                                              lexical, lexical_weight, prefilter, stats)
+        elif mode == "ivf" and self.ivf is not None:
+            results = self.search_ivf(query_embedding, top_k, threshold, top_n_sentences, nprobe,
+                                      lexical, lexical_weight, stats)
+        elif mode in QUANTIZED_MODES:
+            results = self.search_quantized(query_embedding, top_k, threshold, top_n_sentences,
+                                            mode, rescore, lexical, lexical_weight, stats)
+        elif mode == "coarse":
+            results = self.search_coarse(query_embedding, top_k, threshold, top_n_sentences,
+                                         coarse_docs, lexical, lexical_weight, stats)
+        else:
+            mode = "exact"
+            scores = self.score(query_embedding)
+            results = self.exact_results(scores, top_k, threshold, top_n_sentences,
+                                         lexical, lexical_weight, stats)
+        stats["mode"] = mode
+        self.record_scoring(mode, stats)
+        return results
+
+    def search_batch(self, query_embeddings, top_k=2, threshold=0.5, top_n_sentences=3,
+                     mode="exact", nprobe=8, rescore=256, query_texts=None, lexical_weight=0.0,
+                     prefilter=0, coarse_docs=0):
+        """
+        search() for many queries at once. In exact mode the queries are scored
+        with one matrix-matrix product per block of queries.
+        """
+        if mode not in RETRIEVAL_MODES:
+            raise ValueError(f"Unknown retrieval mode {mode!r}, expected one of {RETRIEVAL_MODES}")
+        query_texts = query_texts or [None] * len(query_embeddings)
+        if mode != "exact" or prefilter > 0 or not self.docs or top_k <= 0:
+            return [self.search(q, top_k, threshold, top_n_sentences, mode, nprobe, rescore,
+                                text, lexical_weight, prefilter, coarse_docs)
+                    for q, text in zip(query_embeddings, query_texts)]
+
+        queries = normalize_rows(np.asarray(query_embeddings, dtype=np.float32))
+        # Bound the (n_sentences, block) score matrix to about 128 MB.
+        block = max(1, (32 << 20) // max(1, len(self)))
+        results = []
+        for start in range(0, len(queries), block):
+            scores = self.matrix @ queries[start : start + block].T
+            for column in range(scores.shape[1]):
+                text = query_texts[start + column]
+                lexical = None
+                if text and lexical_weight > 0:
+                    lexical = self.get_lexical().normalized_scores(text)
+                stats = {}
+                results.append(self.exact_results(
+                    np.ascontiguousarray(scores[:, column]), top_k, threshold, top_n_sentences,
+                    lexical, lexical_weight, stats,
+                ))
+                self.record_scoring(mode, stats)
+        return results
+
+    def fuse(self, doc_best, lexical, lexical_weight):
+        """Add the weighted, normalized BM25 score to the best sentence score of each document."""
+        if lexical is None or lexical_weight <= 0:
+            return doc_best
+        return doc_best + lexical_weight * lexical  # unscored documents stay at -inf
+
+    def exact_results(self, scores, top_k, threshold, top_n_sentences, lexical=None, lexical_weight=0.0,
+                      stats=None):
+        """Retrieval results from the scores of every sentence in the index."""
+        if stats is not None:
+            stats.update(sentences_scored=len(scores), documents_scored=len(self.docs))
+        doc_best = self.fuse(self.doc_best_scores(scores), lexical, lexical_weight)
+        results = []
+        for i in self.rank_documents(doc_best, top_k, threshold):
+            start, end = self.doc_offsets[i], self.doc_offsets[i + 1]
+            results.append(self.result(i, np.arange(start, end), scores[start:end], top_n_sentences))
+        return results
+
+    def search_ivf(self, query_embedding, top_k, threshold, top_n_sentences, nprobe,
+                   lexical=None, lexical_weight=0.0, stats=None):
+        """Approximate search: only sentences in the nprobe closest IVF lists are scored."""
+        query = normalize_vector(query_embedding)
+        rows = self.ivf.candidates(query, nprobe)
+        return self.candidate_results(rows, self.matrix[rows] @ query, top_k, threshold,
+                                      top_n_sentences, lexical, lexical_weight, stats)
+
+    def search_quantized(self, query_embedding, top_k, threshold, top_n_sentences, mode, rescore,
+                         lexical=None, lexical_weight=0.0, stats=None):
+        """
+        Two-pass search: approximate scores from the int8 / float16 matrix pick
+        the QUANTIZED_DOC_OVERSAMPLE * top_k best documents and, split between
+        them, the rescore best sentences, which are rescored against the float32
+        rows. Only those rows of the (memory-mapped) float32 matrix are read (see read_rows).
+        """
+        query = normalize_vector(query_embedding)
+        approximate = self.get_quantized(mode).score(query)
+        doc_best = self.fuse(self.doc_best_scores(approximate), lexical, lexical_weight)
+        docs = self.rank_documents(doc_best, QUANTIZED_DOC_OVERSAMPLE * top_k, -np.inf)
+        per_doc = max(top_n_sentences, -(-rescore // max(1, len(docs))))
+        shortlist = []
+        for i in docs:
+            start, end = self.doc_offsets[i], self.doc_offsets[i + 1]
+            if end - start > per_doc:
+                best = np.argpartition(-approximate[start:end], per_doc - 1)[:per_doc]
+                shortlist.append(start + np.sort(best))
+            else:
+                shortlist.append(np.arange(start, end))
+        rows = np.concatenate(shortlist)
+        return self.candidate_results(rows, read_rows(self.matrix, rows, self.matrix_file) @ query,
+                                      top_k, threshold, top_n_sentences, lexical, lexical_weight, stats)
+
+    def search_prefiltered(self, query_embedding, top_k, threshold, top_n_sentences,
+                           lexical, lexical_weight, prefilter, stats=None):
+        """Dense scoring of the sentences of the prefilter documents with the best BM25 scores."""
+        query = normalize_vector(query_embedding)
+        docs = np.sort(self.rank_documents(lexical, prefilter, np.finfo(np.float32).tiny))
+        rows = np.concatenate([np.arange(self.doc_offsets[i], self.doc_offsets[i + 1]) for i in docs])
+        scores = np.concatenate([self.matrix[self.doc_offsets[i]:self.doc_offsets[i + 1]] @ query
+                                 for i in docs])
+        return self.candidate_results(rows, scores, top_k, threshold, top_n_sentences,
+                                      lexical, lexical_weight, stats)
+
+    def search_coarse(self, query_embedding, top_k, threshold, top_n_sentences, coarse_docs,
+                      lexical=None, lexical_weight=0.0, stats=None):
+        """
+        Coarse-to-fine search. Every document gets an upper bound on its
+        sentence scores from its centroid and radius (see document_bounds);
+        documents are scored in
+        decreasing bound order, and scoring stops as soon as the next bound is
+        below threshold or below the top_k-th best document score found so
+        far. With coarse_docs = 0 this returns the same documents as exact
+        search while scoring fewer sentences.
+        """
+        query = normalize_vector(query_embedding)
+        centroids, radii = self.get_bounds()
+        angles = np.arccos(np.clip(centroids @ query, -1.0, 1.0))
+        # The epsilon covers float32 rounding in the bound.
+        bounds = np.cos(np.maximum(0.0, angles - radii)) + 1e-5
+        bounds = self.fuse(bounds, lexical, lexical_weight)
+        docs = np.flatnonzero(bounds >= threshold)
+        if 0 < coarse_docs < len(docs):
+            ranking = self.doc_embeddings @ query if self.doc_embeddings is not None else bounds
+            docs = docs[np.argpartition(-ranking[docs], coarse_docs - 1)[:coarse_docs]]
+        docs = docs[np.argsort(-bounds[docs], kind="stable")]
+
+        best = []  # min-heap of the top_k fused document scores so far
+        rows = []
+        scores = []
+        for i in docs:
+            if len(best) == top_k and bounds[i] < best[0]:
+                break
+            start, end = self.doc_offsets[i], self.doc_offsets[i + 1]
+            doc_scores = self.matrix[start:end] @ query
+            rows.append(np.arange(start, end))
+            scores.append(doc_scores)
+            doc_score = float(doc_scores.max())
+            if lexical is not None and lexical_weight > 0:
+                doc_score += lexical_weight * float(lexical[i])
+            if len(best) < top_k:
+                heapq.heappush(best, doc_score)
+            else:
+                heapq.heappushpop(best, doc_score)
+        if not rows:
+            if stats is not None:
+                stats.update(sentences_scored=0, documents_scored=0)
+            return []
+        rows = np.concatenate(rows)
+        order = np.argsort(rows)
+        return self.candidate_results(rows[order], np.concatenate(scores)[order], top_k, threshold,
+                                      top_n_sentences, lexical, lexical_weight, stats)
+
+    def candidate_results(self, rows, scores, top_k, threshold, top_n_sentences,
+                          lexical=None, lexical_weight=0.0, stats=None):
+        """Retrieval results when only the sorted sentence rows were scored."""
+        doc_of = np.searchsorted(self.doc_offsets, rows, side="right") - 1
+        if stats is not None:
+            stats.update(sentences_scored=len(rows), documents_scored=len(np.unique(doc_of)))
+
+        doc_best = np.full(len(self.docs), -np.inf, dtype=np.float32)
+        np.maximum.at(doc_best, doc_of, scores)
+        doc_best = self.fuse(doc_best, lexical, lexical_weight)
+        results = []
+        for i in self.rank_documents(doc_best, top_k, threshold):
+            in_doc = doc_of == i
+            results.append(self.result(i, rows[in_doc], scores[in_doc], top_n_sentences))
+        return results
+
+    def top_sentences(self, rows, scores, top_n):
+        """Return [(sentence, score), ...] for the top_n scored rows."""
+        n = min(top_n, len(scores))
+        if n <= 0:
+            return []
+        best = np.argpartition(-scores, n - 1)[:n]
+        best = best[np.argsort(-scores[best], kind="stable")]
+        return [(self.sentences[rows[i]], float(scores[i])) for i in best]
+
+    def result(self, doc_idx, rows, scores, top_n_sentences):
+        """Format one document in the retrieval schema used by prepare_prompt()."""
+        doc = self.docs[doc_idx]
+        top_sentences = self.top_sentences(rows, scores, top_n_sentences)
+        return {
+            "document_name": doc["doc_id"],
+            "type": "code" if doc["source"] == "txt" else "project_details",
+            "cosine_sentence_score": [
+                {"score": round(score, 4), "sentence": sent} for sent, score in top_sentences
+            ],
+            "full_document_content": self.contents[doc_idx]
+        }
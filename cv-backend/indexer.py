@@ -0,0 +1,398 @@
+import os
+import sys
+import json
+import time
+import fcntl
+import hashlib
+import logging
+import argparse
+import functools
+import threading
+import subprocess
+
+from bundle import BUNDLE_MANIFEST, read_manifest, write_serving_bundle
+from code_chunker import chunking_of, text_units
+from embeddings import average, pool_document_embedding, token_pieces
+
+logger = logging.getLogger(__name__)
+
+# Inputs and tokens per embeddings API call (the OpenAI limits are 2048 and 300k).
+EMBED_BATCH_SIZE = 256
+EMBED_BATCH_TOKENS = 250000
+# A document whose embedding fails is retried after RETRY_BACKOFF seconds, doubling
+# with every failure, and left alone after MAX_ATTEMPTS until its content changes.
+RETRY_BACKOFF = 900
+MAX_ATTEMPTS = 5
+
+
+def content_hash(text):
+    """Fingerprint of a document's content, stored next to its sentence embeddings."""
+    return hashlib.sha256(text.encode("utf8")).hexdigest()[:16]
+
+
+def is_pending(doc, model):
+    """True when a document's sentence embeddings are missing or stale."""
+    if not doc.get("content", "").strip():
+        return False
+    if not doc.get("sentence_embeddings"):
+        return True
+    if doc.get("content_hash") and doc["content_hash"] != content_hash(doc["content"]):
+        return True
+    return bool(doc.get("embedding_model")) and doc["embedding_model"] != model
+
+
+def embed_document(doc, embed_texts, model):
+    """
+    Embed the text units of doc (code chunks or sentences, as prepare_data_rag.py
+    cuts them by default) in batched calls and store them with its content hash,
+    chunking and model. Units over the model's input limit are embedded in
+    token_pieces and averaged, like prepare_data_rag.py does with its word
+    pieces. The document embedding is pooled from the sentence embeddings:
+    the bundle only keeps whole-document embeddings (coarse_docs
+    preselection) when every document has one.
+    """
+    sentences = text_units(doc)
+    pieces = [token_pieces(sentence) for sentence in sentences]
+    vectors = []
+    batch, batch_tokens = [], 0
+    calls = 0
+    for sentence_pieces in pieces:
+        for piece, tokens in sentence_pieces:
+            if batch and (len(batch) >= EMBED_BATCH_SIZE or batch_tokens + tokens > EMBED_BATCH_TOKENS):
+                vectors.extend(embed_texts(batch))
+                batch, batch_tokens = [], 0
+                calls += 1
+            batch.append(piece)
+            batch_tokens += tokens
+    if batch:
+        vectors.extend(embed_texts(batch))
+        calls += 1
+    embeddings, start = [], 0
+    for sentence_pieces in pieces:
+        embeddings.append(average(vectors[start : start + len(sentence_pieces)]))
+        start += len(sentence_pieces)
+    doc["sentence_embeddings"] = [
+        {"sentence": sentence, "embedding": list(map(float, embedding))}
+        for sentence, embedding in zip(sentences, embeddings)
+    ]
+    doc["embedding"] = pool_document_embedding(sentences, embeddings)
+    doc["content_hash"] = content_hash(doc["content"])
+    doc["chunking"] = chunking_of(doc)
+    doc["embedding_model"] = model
+    return len(sentences), calls
+
+
+def index_file(source_file, embed_texts, model, bundle_dir=None):
+    """
+    One indexing pass over source_file: embed its pending documents, rewrite
+    it atomically, and write a new serving bundle to bundle_dir when one is
+    served and is missing documents or older than source_file. Documents that
+    failed before are skipped until their retry time (see record_failure) or,
+    once given up, until their content changes. Runs in the child process
+    started by BackgroundIndexer (python indexer.py), holding the lock file so
+    passes never overlap. Returns the pass statistics.
+    """
+    stats = {"busy": False, "documents_indexed": 0, "documents_failed": 0, "documents_skipped": 0,
+             "sentences_embedded": 0, "api_calls": 0, "bundle": None, "errors": []}
+    with open(source_file + ".lock", "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            stats["busy"] = True  # another worker's pass is running
+            return stats
+        with open(source_file, "r", encoding="utf8") as f:
+            documents = json.load(f)
+        previous = read_failures(source_file)["documents"]
+        failures = {}
+        now = time.time()
+        for doc in documents:
+            if not is_pending(doc, model):
+                continue
+            failure = previous.get(doc["doc_id"])
+            if failure is not None and failure["content_hash"] != content_hash(doc["content"]):
+                failure = None  # the content changed: a fresh start
+            if failure is not None and (failure["retry_at"] is None or failure["retry_at"] > now):
+                failures[doc["doc_id"]] = failure
+                stats["documents_skipped"] += 1
+                continue
+            try:
+                sentences, calls = embed_document(doc, embed_texts, model)
+            except Exception as e:
+                logger.exception("Embedding document %s failed", doc["doc_id"])
+                failures[doc["doc_id"]] = record_failure(failure, doc, e, now)
+                stats["documents_failed"] += 1
+                stats["errors"].append(f"{doc['doc_id']}: {e}"[:500])
+                continue
+            stats["documents_indexed"] += 1
+            stats["sentences_embedded"] += sentences
+            stats["api_calls"] += calls
+        if stats["documents_indexed"]:
+            tmp_path = source_file + ".tmp"
+            with open(tmp_path, "w", encoding="utf8") as f:
+                json.dump(documents, f, indent=2)
+            os.replace(tmp_path, source_file)
+        write_failures(source_file, failures)
+        pending = [doc["doc_id"] for doc in documents
+                   if doc.get("content", "").strip() and not doc.get("sentence_embeddings")]
+        if bundle_dir is not None and (stats["documents_indexed"]
+                                       or bundle_outdated(bundle_dir, source_file, pending)):
+            # Same IVF lists and quantized copies as the bundle it replaces.
+            manifest = read_manifest(bundle_dir) or {}
+            stats["bundle"] = write_serving_bundle(documents, bundle_dir, manifest.get("ivf_lists", 0),
+                                                   manifest.get("quantized", ()), model)["version"]
+    return stats
+
+
+def record_failure(failure, doc, error, now):
+    """The failure record of doc after one more failed attempt (failure: its previous record, or None)."""
+    attempts = failure["attempts"] + 1 if failure is not None else 1
+    return {
+        "content_hash": content_hash(doc["content"]),
+        "attempts": attempts,
+        "retry_at": now + RETRY_BACKOFF * 2 ** (attempts - 1) if attempts < MAX_ATTEMPTS else None,
+        "error": str(error)[:500],
+    }
+
+
+def failures_path(source_file):
+    return source_file + ".failures.json"
+
+
+def read_failures(source_file):
+    """
+    The failed documents of source_file, {"source_mtime_ns", "documents": {doc_id:
+    {"content_hash", "attempts", "retry_at", "error"}}}, written by the last pass.
+    """
+    try:
+        with open(failures_path(source_file), "r", encoding="utf8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {"source_mtime_ns": None, "documents": {}}
+
+
+def write_failures(source_file, failures):
+    """Replace the failure record, stamped with the mtime of source_file it describes."""
+    record = {"source_mtime_ns": os.stat(source_file).st_mtime_ns, "documents": failures}
+    tmp_path = failures_path(source_file) + ".tmp"
+    with open(tmp_path, "w", encoding="utf8") as f:
+        json.dump(record, f, indent=2)
+    os.replace(tmp_path, failures_path(source_file))
+
+
+def retry_due(source_file, pending):
+    """
+    Whether an indexing pass could embed one of the pending doc_ids, checked
+    from the small failure record only: a document never failed or its retry
+    time has come. A source_file changed since the record was written may hold
+    new content for any of them.
+    """
+    record = read_failures(source_file)
+    try:
+        if record["source_mtime_ns"] != os.stat(source_file).st_mtime_ns:
+            return bool(pending)
+    except FileNotFoundError:
+        return False
+    now = time.time()
+    for doc_id in pending:
+        failure = record["documents"].get(doc_id)
+        if failure is None or (failure["retry_at"] is not None and failure["retry_at"] <= now):
+            return True
+    return False
+
+
+def bundle_outdated(bundle_dir, source_file, pending):
+    """True when the bundle is missing, older than source_file or lists other pending documents."""
+    manifest = read_manifest(bundle_dir)
+    if manifest is None or manifest.get("pending") != pending:
+        return True
+    return os.stat(source_file).st_mtime_ns > os.stat(os.path.join(bundle_dir, BUNDLE_MANIFEST)).st_mtime_ns
+
+
+def bundle_needs_indexing(bundle_dir, source_file):
+    """
+    Cheap staleness check of a served bundle (no parsing of source_file): its
+    manifest lists documents still pending that are due a retry (retry_due), or
+    source_file was written after it.
+    """
+    manifest_path = os.path.join(bundle_dir, BUNDLE_MANIFEST)
+    try:
+        source_mtime = os.stat(source_file).st_mtime_ns
+        manifest_mtime = os.stat(manifest_path).st_mtime_ns
+        with open(manifest_path, "r", encoding="utf8") as f:
+            pending = json.load(f).get("pending")
+    except (FileNotFoundError, ValueError):
+        return False
+    return source_mtime > manifest_mtime or bool(pending) and retry_due(source_file, pending)
+
+
+class BackgroundIndexer(threading.Thread):
+    """
+    Keeps the prepared data file (and the serving bundle built from it) up to
+    date with documents whose sentence embeddings are missing or stale. Every
+    interval seconds, or sooner when wake() is called, a pass calls refresh()
+    and then needs_indexing(), both cheap: neither parses the file. Only when
+    something is stale does it run index_file() in a child process (python
+    indexer.py), so the multi-GB parse and the embedding calls never run on a
+    worker's request loop, and the lock file lets a single worker's child do
+    the work. Workers pick the result up through their BundleWatcher (or
+    refresh() without a bundle).
+    """
+
+    def __init__(self, source_file, model, needs_indexing, refresh=None, bundle_dir=None, interval=300):
+        super().__init__(name="background-indexer", daemon=True)
+        self.source_file = source_file
+        self.model = model
+        self.needs_indexing = needs_indexing  # () -> True when the file has documents to embed
+        self.refresh = refresh                # () -> None, reloads the live index if the file changed
+        self.bundle_dir = bundle_dir          # rebuilt by the child pass when a bundle is served
+        self.interval = interval
+        self.wakeup = threading.Event()
+        self.runs = 0
+        self.passes = 0
+        self.documents_indexed = 0
+        self.sentences_embedded = 0
+        self.api_calls = 0
+        self.last_run = None
+        self.last_pass = None
+        self.last_error = None
+
+    def wake(self):
+        self.wakeup.set()
+
+    def run(self):
+        while True:
+            try:
+                self.index_once()
+                self.last_error = None
+            except Exception as e:
+                logger.exception("Background indexing failed")
+                self.last_error = str(e)
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+
+    def index_once(self):
+        """One pass. Returns the statistics of the child pass, or None when nothing was stale."""
+        self.runs += 1
+        self.last_run = time.strftime("%Y-%m-%dT%H:%M:%S")
+        if self.refresh is not None:
+            self.refresh()
+        if not os.path.exists(self.source_file) or not self.needs_indexing():
+            return None
+        command = [sys.executable, os.path.abspath(__file__), self.source_file, "--model", self.model]
+        if self.bundle_dir is not None:
+            command += ["--bundle-dir", self.bundle_dir]
+        started = time.perf_counter()
+        result = subprocess.run(command, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(f"Indexing pass failed ({result.returncode}): {result.stderr.strip()[-2000:]}")
+        stats = json.loads(result.stdout.strip().splitlines()[-1])
+        if stats["busy"]:
+            return stats
+        self.passes += 1
+        self.documents_indexed += stats["documents_indexed"]
+        self.sentences_embedded += stats["sentences_embedded"]
+        self.api_calls += stats["api_calls"]
+        self.last_pass = {**stats, "seconds": round(time.perf_counter() - started, 3)}
+        logger.warning("Indexing pass: %s", self.last_pass)
+        if self.refresh is not None:
+            self.refresh()
+        return stats
+
+    def stats(self):
+        return {
+            "source_file": self.source_file,
+            "bundle_dir": self.bundle_dir,
+            "interval": self.interval,
+            "runs": self.runs,
+            "passes": self.passes,
+            "last_run": self.last_run,
+            "last_pass": self.last_pass,
+            "last_error": self.last_error,
+            "documents_indexed": self.documents_indexed,
+            "sentences_embedded": self.sentences_embedded,
+            "api_calls": self.api_calls,
+        }
+
+
+class BundleWatcher(threading.Thread):
+    """
+    Polls the manifest of the serving bundle every interval seconds and calls
+    on_change() when the file was replaced. prepare_data_rag.py writes the
+    manifest last, so the version it names is complete by then. on_change
+    returns True when it swapped in a new index; a failed reload is retried on
+    the next poll.
+    """
+
+    def __init__(self, manifest_path, on_change, interval=10):
+        super().__init__(name="bundle-watcher", daemon=True)
+        self.manifest_path = manifest_path
+        self.on_change = on_change
+        self.interval = interval
+        self.manifest_mtime = None
+        self.checks = 0
+        self.reloads = 0
+        self.last_reload = None
+        self.last_error = None
+
+    def run(self):
+        while True:
+            try:
+                self.check_once()
+                self.last_error = None
+            except Exception as e:
+                logger.exception("Reloading the serving bundle failed")
+                self.last_error = str(e)
+            time.sleep(self.interval)
+
+    def check_once(self):
+        """Reload when the manifest changed since the last poll. Returns True after a swap."""
+        self.checks += 1
+        try:
+            mtime = os.stat(self.manifest_path).st_mtime_ns
+        except FileNotFoundError:
+            return False
+        if mtime == self.manifest_mtime:
+            return False
+        swapped = self.on_change()
+        self.manifest_mtime = mtime
+        if swapped:
+            self.reloads += 1
+            self.last_reload = time.strftime("%Y-%m-%dT%H:%M:%S")
+        return swapped
+
+    def stats(self):
+        return {
+            "manifest": self.manifest_path,
+            "interval": self.interval,
+            "checks": self.checks,
+            "reloads": self.reloads,
+            "last_reload": self.last_reload,
+            "last_error": self.last_error,
+        }
+
+
+def main():
+    """Entry point of the child process of BackgroundIndexer (embedder settings from the environment)."""
+    parser = argparse.ArgumentParser(description="Embed the pending documents of the prepared data file.")
+    parser.add_argument("source_file")
+    parser.add_argument("--model", default=None)
+    parser.add_argument("--bundle-dir", default=None,
+                        help="Also write a new version of this serving bundle.")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    from embeddings import make_embedder
+    provider = os.getenv("EMBEDDING_PROVIDER", "openai")
+
+    @functools.lru_cache(maxsize=None)
+    def get_client():
+        from openai import OpenAI
+        return OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+    embedder = make_embedder(provider, args.model or os.getenv("EMBEDDING_MODEL"), get_client=get_client,
+                             batch_size=int(os.getenv("EMBED_BATCH_SIZE", "64")))
+    stats = index_file(args.source_file, embedder.embed, embedder.model, args.bundle_dir)
+    print(json.dumps(stats))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+import re
+import threading
+from collections import Counter
+
+import numpy as np
+
+# Okapi BM25 parameters: term frequency saturation and document length normalization.
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Characters stripped from the ends of tokens, and the separators inside identifiers.
+TOKEN_PUNCTUATION = ".,;:!?'\"()[]{}<>`"
+IDENTIFIER_SEPARATORS = re.compile(r"[._/\-:]+")
+# Query words that say nothing about which document is meant; they are not scored.
+STOPWORDS = frozenset("""
+a about above after again all also am an and any are as at be because been being both but by can
+could did do does doing done during each either else ever few for from had has have having he her
+here hers him his how i if in into is it its just me might more most much must my no nor not of off
+on once only or other our ours out over own please same she should show so some such tell than that
+the their theirs them then there these they this those through to too under until up very was we
+were what when where which while who whom whose why will with would you your yours yourself
+""".split())
+
+_tokenizer = None
+_tokenizer_lock = threading.Lock()
+
+
+def tokenize(text):
+    """
+    Tokens of text as prepare_data_rag.py stores them (word_tokenize(text.lower())),
+    using NLTK's word tokenizer directly so no punkt sentence model is needed.
+    """
+    global _tokenizer
+    if _tokenizer is None:
+        with _tokenizer_lock:
+            if _tokenizer is None:
+                from nltk.tokenize import NLTKWordTokenizer
+                _tokenizer = NLTKWordTokenizer()
+    return _tokenizer.tokenize(text.lower())
+
+
+def lexical_terms(tokens):
+    """
+    Index terms of a token list: every token with a letter or digit, plus the
+    parts of identifiers such as np.linalg.norm or get_query_embedding, so a
+    query for "reduceat" or "get_index" matches either form.
+    """
+    terms = []
+    for token in tokens:
+        token = token.strip(TOKEN_PUNCTUATION)
+        if not any(c.isalnum() for c in token):
+            continue
+        terms.append(token)
+        parts = [part for part in IDENTIFIER_SEPARATORS.split(token) if part]
+        if len(parts) > 1:
+            terms.extend(parts)
+    return terms
+
+
+class BM25Index:
+    """
+    Inverted index over the documents of the sentence index (same order), scored
+    with Okapi BM25 (stopwords of the query are ignored). Postings are numpy
+    arrays, so scoring a query touches only the documents that contain one of
+    its terms.
+    """
+
+    def __init__(self, postings, doc_lengths):
+        self.postings = postings        # term -> (doc indices int32, term frequencies float32)
+        self.doc_lengths = doc_lengths  # (n_docs,) float32, in terms
+        self.avg_length = float(doc_lengths.mean()) if len(doc_lengths) else 0.0
+
+    @classmethod
+    def from_token_lists(cls, token_lists):
+        """Build the index from one token list per document."""
+        doc_terms = {}
+        doc_lengths = np.zeros(len(token_lists), dtype=np.float32)
+        for i, tokens in enumerate(token_lists):
+            terms = lexical_terms(tokens)
+            doc_lengths[i] = len(terms)
+            for term, count in Counter(terms).items():
+                docs, counts = doc_terms.setdefault(term, ([], []))
+                docs.append(i)
+                counts.append(count)
+        postings = {
+            term: (np.asarray(docs, dtype=np.int32), np.asarray(counts, dtype=np.float32))
+            for term, (docs, counts) in doc_terms.items()
+        }
+        return cls(postings, doc_lengths)
+
+    def __len__(self):
+        return len(self.doc_lengths)
+
+    def score(self, query):
+        """BM25 score of every document for the query text."""
+        scores = np.zeros(len(self.doc_lengths), dtype=np.float32)
+        if not len(self.doc_lengths) or not self.avg_length:
+            return scores
+        n_docs = len(self.doc_lengths)
+        for term in self.query_terms(query):
+            posting = self.postings.get(term)
+            if posting is None:
+                continue
+            docs, counts = posting
+            idf = np.log(1 + (n_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lengths[docs] / self.avg_length)
+            scores[docs] += idf * counts * (BM25_K1 + 1) / (counts + norm)
+        return scores
+
+    def query_terms(self, query):
+        """Distinct index terms of the query, without stopwords."""
+        return {term for term in lexical_terms(tokenize(query)) if term not in STOPWORDS}
+
+    def idf(self, term):
+        """BM25 idf of term; a term no document contains gets the idf of a term in none."""
+        n_docs = len(self.doc_lengths)
+        df = len(self.postings[term][0]) if term in self.postings else 0
+        return np.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+
+    def normalized_scores(self, query):
+        """
+        BM25 scores divided by the most any document could score for the query
+        (every term, idf * (k1 + 1)), in [0, 1]. Unlike dividing by the best
+        score, this is absolute: a document only matching common or few query
+        terms stays low, and a query whose rare terms match nothing boosts no
+        document much.
+        """
+        scores = self.score(query)
+        bound = sum(self.idf(term) for term in self.query_terms(query)) * (BM25_K1 + 1)
+        return scores / bound if bound > 0 else scores
@@ -1,128 +1,443 @@
+import time
+STARTUP_STARTED = time.perf_counter()
+
+import gc
 import json
-import numpy as np
-from nltk.tokenize import sent_tokenize
+import logging
 import os
-from flask import Flask, request, Response
+import threading
+from flask import Flask, request, Response, jsonify
 from dotenv import load_dotenv
 from flask_cors import CORS
-from flasgger import Swagger
 
-# Import the new OpenAI client interface.
-from openai import OpenAI
+from bundle import BUNDLE_MANIFEST, read_manifest
+from index import SentenceIndex, RETRIEVAL_MODES, QUANTIZED_MODES
+from cache import EmbeddingCache, SemanticResponseCache, normalize_query
+from context_packer import pack_context, compact_json, count_tokens
+from metrics import registry, StageTimer, COUNT_BUCKETS
+from indexer import BackgroundIndexer, BundleWatcher, bundle_needs_indexing, is_pending, retry_due
+from embeddings import make_embedder, DEFAULT_MODELS
+from coalesce import SingleFlight
+
+# Durations of the startup phases, logged once the worker is warm.
+startup_timer = StageTimer()
+startup_timer.record("imports", time.perf_counter() - STARTUP_STARTED)
 
 # Load environment variables from .env file.
 load_dotenv()
 
 app = Flask(__name__)
-swagger = Swagger(app)
 CORS(app)
 
+# Under gunicorn, app.logger has no level of its own and inherits the root logger's
+# WARNING, dropping the reload, warm-up and prompt info messages: log through
+# gunicorn's error log at its --log-level instead.
+gunicorn_logger = logging.getLogger("gunicorn.error")
+if gunicorn_logger.handlers:
+    app.logger.handlers = gunicorn_logger.handlers
+    app.logger.setLevel(gunicorn_logger.level)
+
 # Set your OpenAI API key.
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 if not OPENAI_API_KEY:
     raise ValueError("OPENAI_API_KEY environment variable not set")
 
-# Create an OpenAI client instance.
-client = OpenAI(api_key=OPENAI_API_KEY)
+# The OpenAI client (a slow import) is created on first use or by the warm-up thread.
+client = None
+client_lock = threading.Lock()
+
+# Query (and background indexing) embeddings: "openai" calls the API, "local" keeps a
+# sentence-transformers model warm in every worker and encodes in batches of
+# EMBED_BATCH_SIZE on the CPU. The index must be built with the same model
+# (prepare_data_rag.py --embedding-provider).
+EMBEDDING_PROVIDER = os.getenv("EMBEDDING_PROVIDER", "openai")
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL") or DEFAULT_MODELS.get(EMBEDDING_PROVIDER)
+
+# "lazy" builds the Swagger UI on the first /apidocs request, "eager" at import, "off" never.
+SWAGGER_MODE = os.getenv("SWAGGER_MODE", "lazy")
+# Startup (imports + index + client + tokenizer) above this is logged as a warning.
+STARTUP_BUDGET_SECONDS = float(os.getenv("STARTUP_BUDGET_SECONDS", "2"))
+
+# Query embeddings cache (LRU + TTL). Set QUERY_CACHE_PATH to a local SQLite file
+# to keep warm entries across restarts and share them between gunicorn workers.
+query_embedding_cache = EmbeddingCache(
+    max_entries=int(os.getenv("QUERY_CACHE_SIZE", "1024")),
+    ttl=float(os.getenv("QUERY_CACHE_TTL", "86400")),
+    path=os.getenv("QUERY_CACHE_PATH"),
+)
+
+# Answers replayed for near-paraphrase queries with the same content words that retrieve
+# the same documents (benchmarks/bench_semantic_cache.py measures SEMANTIC_CACHE_DISTANCE
+# for an embedding model). SEMANTIC_CACHE_SIZE=0 disables it.
+response_cache = SemanticResponseCache(
+    max_entries=int(os.getenv("SEMANTIC_CACHE_SIZE", "256")),
+    max_distance=float(os.getenv("SEMANTIC_CACHE_DISTANCE", "0.03")),
+)
+
+# Identical /rag requests arriving within COALESCE_WINDOW seconds of each other share
+# one upstream embedding, search and completion (0 disables it). A merged request
+# waits at most COALESCE_TIMEOUT seconds for each event of the shared answer.
+flights = SingleFlight(
+    window=float(os.getenv("COALESCE_WINDOW", "2")),
+    timeout=float(os.getenv("COALESCE_TIMEOUT", "60")),
+)
 
 # Path to the prepared data file.
 PREPARED_FILE = "rag_data.json"
-with open(PREPARED_FILE, "r", encoding="utf8") as f:
-    documents = json.load(f)
+# Serving bundle written by prepare_data_rag.py; preferred over PREPARED_FILE when present.
+INDEX_BUNDLE_DIR = os.getenv("INDEX_BUNDLE_DIR", "rag_index")
 
-def cosine_similarity(a, b):
-    """Compute cosine similarity between two vectors."""
-    dot = np.dot(a, b)
-    norm_a = np.linalg.norm(a)
-    norm_b = np.linalg.norm(b)
-    return dot / (norm_a * norm_b + 1e-8)
+# Default retrieval strategy (see index.RETRIEVAL_MODES), IVF lists probed per query and
+# sentences rescored at full precision by the quantized modes; all can be overridden per request.
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "exact")
+IVF_NPROBE = int(os.getenv("IVF_NPROBE", "8"))
+RESCORE_CANDIDATES = int(os.getenv("RESCORE_CANDIDATES", "256"))
+# Hybrid retrieval: weight of the normalized BM25 score added to the document score (off by
+# default; benchmarks/bench_retrieval.py --strategies hybrid measures the recall of a weight,
+# 0.05-0.1 keeps dense ranking in charge), and the number of best BM25 documents dense
+# scoring is restricted to (0 scores all).
+LEXICAL_WEIGHT = float(os.getenv("LEXICAL_WEIGHT", "0"))
+LEXICAL_PREFILTER = int(os.getenv("LEXICAL_PREFILTER", "0"))
+# Coarse mode: only consider this many documents closest to the query by their
+# whole-document embedding (0 keeps the bound-based pruning exact).
+COARSE_DOCS = int(os.getenv("COARSE_DOCS", "0"))
 
-def get_query_embedding(query):
-    """Compute the query embedding using OpenAI's text-embedding-ada-002."""
-    response = client.embeddings.create(
-         input=query,
-         model="text-embedding-ada-002"
-    )
-    return response.data[0].embedding
-
-def get_relevant_sentences(doc, query_embedding, top_n=3):
-    """
-    From the document's precomputed sentence embeddings, select the top_n sentences 
-    that have the highest cosine similarity with the query embedding.
-    Returns a list of tuples: (sentence, similarity score).
-    """
-    sentence_embeds = doc.get("sentence_embeddings", [])
-    if not sentence_embeds:
-        sentences = sent_tokenize(doc["content"])
-        sentence_embeds = []
-        for sent in sentences:
-            response = client.embeddings.create(
-                input=sent,
-                model="text-embedding-ada-002"
+# Per-stage /rag latency histograms, exposed on /metrics.
+STAGE_HISTOGRAMS = {
+    "query_embedding": registry.histogram(
+        "rag_query_embedding_seconds", "Time spent computing (or fetching) the query embedding."),
+    "search": registry.histogram(
+        "rag_search_seconds", "Time spent in sentence retrieval."),
+    "prepare_prompt": registry.histogram(
+        "rag_prepare_prompt_seconds", "Time spent packing the context and building the prompt."),
+    "first_token": registry.histogram(
+        "rag_time_to_first_token_seconds", "Time from the LLM call to its first streamed token."),
+    "stream": registry.histogram(
+        "rag_stream_duration_seconds", "Duration of the upstream LLM stream."),
+}
+REQUEST_SECONDS = registry.histogram("rag_request_seconds", "Total /rag request duration.")
+TOKENS_STREAMED = registry.histogram(
+    "rag_tokens_streamed", "Tokens (stream chunks) sent per /rag answer.", COUNT_BUCKETS)
+PROMPT_TOKENS = registry.histogram(
+    "rag_prompt_tokens", "Prompt size in tokens per /rag request.", COUNT_BUCKETS + (10000, 25000))
+SENTENCES_SCORED = registry.histogram(
+    "rag_sentences_scored", "Sentences scored at full precision per /rag retrieval.",
+    COUNT_BUCKETS + (10000, 100000, 1000000))
+CACHED_ANSWERS = registry.counter(
+    "rag_cached_answers_total", "/rag answers replayed from the semantic response cache.")
+COALESCED_REQUESTS = registry.counter(
+    "rag_coalesced_requests_total", "/rag requests merged into an identical in-flight request.")
+registry.add_gauges(lambda: {
+    "query_embedding_cache_hits": ("Query embedding cache hits (memory and disk).",
+                                   query_embedding_cache.hits + query_embedding_cache.disk_hits),
+    "query_embedding_cache_misses": ("Query embedding cache misses.", query_embedding_cache.misses),
+    "response_cache_hits": ("Semantic response cache hits.", response_cache.hits),
+    "response_cache_misses": ("Semantic response cache misses.", response_cache.misses),
+    "coalesced_flights_in_progress": ("Distinct /rag requests in flight (each shared by merged requests).",
+                                      len(flights.flights)),
+})
+# /rag requests slower than this are logged with their stage breakdown.
+SLOW_REQUEST_SECONDS = float(os.getenv("SLOW_REQUEST_SECONDS", "5"))
+
+# Token budget for the retrieval context packed into the prompt.
+PROMPT_CONTEXT_TOKENS = int(os.getenv("PROMPT_CONTEXT_TOKENS", "1500"))
+
+# Structured /rag streams (requested with "stream" in the body or the Accept header):
+# a "retrieval" event as soon as search() returns, one "token" event per LLM chunk
+# and a "done" event with the stage timings. Without one, /rag streams plain text.
+STREAM_FORMATS = {"sse": "text/event-stream", "ndjson": "application/x-ndjson"}
+
+# Documents of PREPARED_FILE with missing or stale sentence embeddings are embedded in
+# the background: every INDEXING_INTERVAL seconds each worker checks (without parsing
+# the file) whether the served bundle lists pending documents or is older than
+# PREPARED_FILE, and only then one worker runs an indexing pass in a child process,
+# which writes a new bundle that every worker hot-reloads. Documents whose embedding
+# fails are retried with a doubling backoff, then only once their content changes.
+BACKGROUND_INDEXING = os.getenv("BACKGROUND_INDEXING", "1") == "1"
+INDEXING_INTERVAL = float(os.getenv("INDEXING_INTERVAL", "300"))
+# Every INDEX_RELOAD_INTERVAL seconds each worker checks whether a new serving bundle
+# was written to INDEX_BUNDLE_DIR, builds it off the request path and swaps it in
+# (0 disables hot reload).
+INDEX_RELOAD_INTERVAL = float(os.getenv("INDEX_RELOAD_INTERVAL", "10"))
+
+# The sentence index is loaded on first use, not at import.
+sentence_index = None
+sentence_index_lock = threading.Lock()
+# Process that loaded the live index: the gunicorn master when it was preloaded.
+index_loaded_by = None
+# How long the live index took to load and build, and when it went live.
+index_build_seconds = None
+index_loaded_at = None
+indexer = None
+bundle_watcher = None
+
+def load_index():
+    """
+    Open the memory-mapped serving bundle if one was built, otherwise stack
+    every sentence embedding of rag_data.json into one normalized float32 matrix.
+    """
+    if bundle_served():
+        index = SentenceIndex.from_bundle(INDEX_BUNDLE_DIR)
+    else:
+        index = load_json_index()
+    if index.model and index.model != EMBEDDING_MODEL:
+        app.logger.error(
+            "Index %s was embedded with %s but queries are embedded with %s; "
+            "rebuild it with prepare_data_rag.py or set EMBEDDING_PROVIDER/EMBEDDING_MODEL.",
+            index.version, index.model, EMBEDDING_MODEL,
+        )
+    return index
+
+def bundle_served():
+    return os.path.exists(os.path.join(INDEX_BUNDLE_DIR, BUNDLE_MANIFEST))
+
+def json_index_version():
+    """Version of an index built from PREPARED_FILE as it is on disk now."""
+    return f"{PREPARED_FILE}@{os.stat(PREPARED_FILE).st_mtime_ns}"
+
+def load_json_index():
+    """Index of every sentence embedding of PREPARED_FILE (without a bundle), with its pending documents."""
+    version = json_index_version()
+    with open(PREPARED_FILE, "r", encoding="utf8") as f:
+        documents = json.load(f)
+    index = SentenceIndex.from_documents(documents, version=version)
+    index.pending = [doc["doc_id"] for doc in documents if is_pending(doc, EMBEDDING_MODEL)]
+    return index
+
+def record_index_load(started):
+    """Record who loaded the live index and how long it took (caller holds sentence_index_lock)."""
+    global index_loaded_by, index_build_seconds, index_loaded_at
+    index_loaded_by = os.getpid()
+    index_build_seconds = round(time.perf_counter() - started, 3)
+    index_loaded_at = time.strftime("%Y-%m-%dT%H:%M:%S")
+
+def get_index():
+    """
+    Return the sentence index, loading it (and starting the indexer and the
+    bundle watcher of this worker) on the first call.
+    """
+    global sentence_index
+    if sentence_index is None:
+        with sentence_index_lock:
+            if sentence_index is None:
+                started = time.perf_counter()
+                sentence_index = load_index()
+                record_index_load(started)
+    if BACKGROUND_INDEXING and indexer is None:
+        start_indexer()
+    if INDEX_RELOAD_INTERVAL > 0 and bundle_watcher is None:
+        start_bundle_watcher()
+    return sentence_index
+
+def start_indexer():
+    """Start the background indexer thread of this worker (threads do not survive fork)."""
+    global indexer
+    with sentence_index_lock:
+        if indexer is None:
+            indexer = BackgroundIndexer(
+                PREPARED_FILE, EMBEDDING_MODEL, needs_indexing=needs_indexing,
+                refresh=refresh_json_index, bundle_dir=INDEX_BUNDLE_DIR if bundle_served() else None,
+                interval=INDEXING_INTERVAL,
             )
-            sentence_embeds.append({
-                "sentence": sent,
-                "embedding": response.data[0].embedding
-            })
-    scored_sentences = []
-    for item in sentence_embeds:
-        sent = item["sentence"]
-        emb = np.array(item["embedding"])
-        score = cosine_similarity(query_embedding, emb)
-        scored_sentences.append((sent, score))
-    scored_sentences.sort(key=lambda x: x[1], reverse=True)
-    return scored_sentences[:top_n]
-
-def search(query, top_k=2, threshold=0.5, top_n_sentences=3):
+            indexer.start()
+
+def needs_indexing():
+    """
+    Whether PREPARED_FILE has documents to embed, checked without parsing it:
+    from the served bundle's manifest, or the live index built from the file,
+    leaving out documents that failed and are not due a retry.
+    """
+    if bundle_served():
+        return bundle_needs_indexing(INDEX_BUNDLE_DIR, PREPARED_FILE)
+    pending = sentence_index.pending if sentence_index is not None else None
+    return bool(pending) and retry_due(PREPARED_FILE, pending)
+
+def start_bundle_watcher():
+    """Start the thread that hot-reloads new serving bundles in this worker."""
+    global bundle_watcher
+    with sentence_index_lock:
+        if bundle_watcher is None:
+            bundle_watcher = BundleWatcher(
+                os.path.join(INDEX_BUNDLE_DIR, BUNDLE_MANIFEST), reload_index,
+                interval=INDEX_RELOAD_INTERVAL,
+            )
+            bundle_watcher.start()
+
+def build_search_structures(index):
+    """Build the quantized copy or document bounds used by RETRIEVAL_MODE and the BM25 index."""
+    if RETRIEVAL_MODE in QUANTIZED_MODES:
+        index.get_quantized(RETRIEVAL_MODE)
+    if RETRIEVAL_MODE == "coarse":
+        index.get_bounds()
+    if LEXICAL_WEIGHT > 0 or LEXICAL_PREFILTER > 0:
+        index.get_lexical()
+
+def reload_index():
+    """
+    Swap in the serving bundle when its manifest names a version other than
+    the live index. The new index and its search structures are built in the
+    calling (watcher) thread, then replace the live one atomically; requests
+    already running keep the index object they started with, in every
+    retrieval mode, after its files were deleted (from_bundle maps or opens
+    every file once and never reopens one by name).
+    Returns True when the index was swapped.
+    """
+    global sentence_index
+    manifest = read_manifest(INDEX_BUNDLE_DIR)
+    if manifest is None or (sentence_index is not None and manifest["version"] == sentence_index.version):
+        return False
+    started = time.perf_counter()
+    new_index = load_index()
+    build_search_structures(new_index)
+    with sentence_index_lock:
+        previous, sentence_index = sentence_index, new_index
+        record_index_load(started)
+    app.logger.info("Reloaded index %s (previous %s) in %.3fs",
+                    new_index.version, previous.version if previous else None, index_build_seconds)
+    return True
+
+def preload_index():
+    """
+    Load the index in the gunicorn master before the workers are forked
+    (preload_app, see gunicorn.conf.py), so every worker reads the same
+    physical pages: the bundle files are memory-mapped, and arrays built from
+    rag_data.json are shared copy-on-write. The quantized copy or document
+    bounds used by RETRIEVAL_MODE and the BM25 index are built here too.
+    gc.freeze() moves everything allocated so far out of the collector's
+    reach, so collections in the workers do not write to (and un-share) the
+    pages of these objects.
+    """
+    global sentence_index
+    started = time.perf_counter()
+    with sentence_index_lock:
+        if sentence_index is None:
+            sentence_index = load_index()
+        build_search_structures(sentence_index)
+        record_index_load(started)
+    gc.freeze()
+    app.logger.info("Preloaded index %s (%d sentences) in pid %d",
+                    sentence_index.version, len(sentence_index), index_loaded_by)
+
+def refresh_json_index():
+    """
+    Without a bundle, reload PREPARED_FILE when it is not the file the live
+    index was built from (another worker's indexing pass rewrote it), and swap
+    it in atomically. Requests already running keep the index they started with.
+    With a bundle, the BundleWatcher swaps in the bundles that passes write.
+    """
+    global sentence_index
+    if bundle_served() or sentence_index is None or not os.path.exists(PREPARED_FILE):
+        return False
+    if sentence_index.version == json_index_version():
+        return False
+    started = time.perf_counter()
+    new_index = load_json_index()
+    build_search_structures(new_index)
+    with sentence_index_lock:
+        previous, sentence_index = sentence_index, new_index
+        record_index_load(started)
+    app.logger.warning("Reloaded %s (previous %s) in %.3fs", new_index.version, previous.version,
+                       index_build_seconds)
+    return True
+
+def get_client():
+    """Return the OpenAI client, importing and creating it on the first call."""
+    global client
+    if client is None:
+        with client_lock:
+            if client is None:
+                from openai import OpenAI
+                client = OpenAI(api_key=OPENAI_API_KEY)
+    return client
+
+embedder = make_embedder(EMBEDDING_PROVIDER, EMBEDDING_MODEL, get_client=get_client,
+                         batch_size=int(os.getenv("EMBED_BATCH_SIZE", "64")))
+
+def get_query_embedding(query):
+    """
+    Compute the query embedding with the configured provider (see embed_texts).
+    Repeated queries (after normalization) are served from query_embedding_cache.
+    """
+    return get_query_embeddings([query])[0]
+
+def get_query_embeddings(queries):
+    """
+    Embed several queries with a single embeddings API call.
+    Queries already in query_embedding_cache are not sent again.
+    """
+    keys = [f"{EMBEDDING_MODEL}:{normalize_query(query)}" for query in queries]
+    embeddings = [query_embedding_cache.get(key) for key in keys]
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    if missing:
+        for i, embedding in zip(missing, embed_texts([queries[i] for i in missing])):
+            embeddings[i] = embedding
+            query_embedding_cache.put(keys[i], embedding)
+    return embeddings
+
+def embed_texts(texts):
+    """Embed a list of texts with the configured provider (one API call or batched local inference)."""
+    return embedder.embed(texts)
+
+def search(query, top_k=2, threshold=0.5, top_n_sentences=3, **options):
     """
     Perform a sentence-level search over documents using precomputed sentence embeddings.
     Only include documents where the best sentence exceeds the threshold.
-    Returns a list of results in the retrieval schema.
+    options are the retrieval settings of retrieval_options(): mode selects exact,
+    approximate (IVF), quantized or coarse-to-fine scoring, lexical_weight and
+    prefilter add BM25 matching of the query text. Returns a list of results in
+    the retrieval schema.
     """
     query_embedding = get_query_embedding(query)
-    doc_results = []
-    
-    for doc in documents:
-        sentence_embeds = doc.get("sentence_embeddings", [])
-        if not sentence_embeds:
-            continue
-        
-        scored_sentences = []
-        for item in sentence_embeds:
-            sent = item["sentence"]
-            emb = np.array(item["embedding"])
-            score = cosine_similarity(query_embedding, emb)
-            scored_sentences.append((sent, score))
-        
-        scored_sentences.sort(key=lambda x: x[1], reverse=True)
-        if not scored_sentences:
-            continue
-        
-        best_score = scored_sentences[0][1]
-        if best_score >= threshold:
-            top_sentences = scored_sentences[:top_n_sentences]
-            doc_results.append({
-                "document_name": doc["doc_id"],
-                "type": "code" if doc["source"] == "txt" else "project_details",
-                "cosine_sentence_score": [
-                    {"score": round(score, 4), "sentence": sent} for sent, score in top_sentences
-                ],
-                "full_document_content": doc["content"]
-            })
-    
-    doc_results.sort(key=lambda x: x["cosine_sentence_score"][0]["score"], reverse=True)
-    return doc_results[:top_k]
+    return search_embedding(query_embedding, top_k, threshold, top_n_sentences,
+                            query_text=query, **options)
+
+def search_embedding(query_embedding, top_k=2, threshold=0.5, top_n_sentences=3,
+                     mode=None, nprobe=None, rescore=None, index=None, query_text=None,
+                     lexical_weight=None, prefilter=None, coarse_docs=None, stats=None):
+    """
+    Run search() for an already computed query embedding. The sentences and
+    documents scored are written to stats when given.
+    """
+    index = index or get_index()
+    return index.search(
+        query_embedding, top_k=top_k, threshold=threshold, top_n_sentences=top_n_sentences,
+        mode=mode or RETRIEVAL_MODE, nprobe=nprobe or IVF_NPROBE,
+        rescore=rescore or RESCORE_CANDIDATES, query_text=query_text,
+        lexical_weight=LEXICAL_WEIGHT if lexical_weight is None else lexical_weight,
+        prefilter=LEXICAL_PREFILTER if prefilter is None else prefilter,
+        coarse_docs=COARSE_DOCS if coarse_docs is None else coarse_docs, stats=stats,
+    )
+
+def retrieval_options(retrieval):
+    """
+    Validated search() settings from the optional "retrieval" object of a
+    request, with the server defaults filled in. Raises ValueError when invalid.
+    """
+    if not isinstance(retrieval, dict):
+        raise ValueError("'retrieval' must be an object")
+    mode = retrieval.get("mode") or RETRIEVAL_MODE
+    if mode not in RETRIEVAL_MODES:
+        raise ValueError(f"Unknown retrieval mode '{mode}'")
+    lexical_weight = float(retrieval.get("lexical_weight", LEXICAL_WEIGHT))
+    if not 0 <= lexical_weight <= 1:
+        raise ValueError("lexical_weight must be in [0, 1]")
+    return {
+        "mode": mode,
+        "nprobe": int(retrieval.get("nprobe") or IVF_NPROBE),
+        "rescore": int(retrieval.get("rescore") or RESCORE_CANDIDATES),
+        "lexical_weight": lexical_weight,
+        "prefilter": int(retrieval.get("prefilter", LEXICAL_PREFILTER)),
+        "coarse_docs": int(retrieval.get("coarse_docs", COARSE_DOCS)),
+    }
 
-def prepare_prompt(query, retrieval_results, max_content_length=1000):
+def prepare_prompt(query, retrieval_results, token_budget=PROMPT_CONTEXT_TOKENS):
     """
     Constructs a prompt string for the LLM, embedding the user query and the retrieval JSON.
-    Truncates each document's full content to max_content_length.
+    The retrieval context is packed into token_budget tokens (see context_packer.pack_context).
+    Returns (prompt, stats) where stats reports the tokens used.
     """
-    for doc in retrieval_results:
-        if len(doc["full_document_content"]) > max_content_length:
-            doc["full_document_content"] = doc["full_document_content"][:max_content_length] + "..."
-    
-    formatted_retrieval = json.dumps(retrieval_results, indent=2)
+    packed_results, stats = pack_context(query, retrieval_results, token_budget)
+    formatted_retrieval = compact_json(packed_results)
     
     prompt = f"""
 You are an ai assistant impersonating Francois Huppe-Marcoux, the AI/ML and software engineer.
@@ -140,27 +455,15 @@ I want you to use relevant information only if it serves to answer the question.
 Otherwise, if you feel the question doesn't need specific information, ignore the following retrieval context.
 Make sure you mention the project where the information was found!
 
-This is the retrieval JSON schema:
-[
-  {{
-    "document_name": "<document_filename>",
-    "type": "<project_details or code>",
-    "cosine_sentence_score": [
-      {{ "score": <the_score:int>, "sentence": "<the sentence:string>" }},
-      ... (top 3)
-    ],
-    "full_document_content": "<full text/json content>"
-  }},
-  ... (other documents)
-]
-Keep only the top 2 documents.
-
-Here is the result of the cosine similarity search:
+Each retrieved document has its document_name, its type (project_details or code),
+its best matching sentences with their cosine score, and excerpts of its content:
 <retrieval>
 {formatted_retrieval}
 </retrieval>
 """
-    return prompt.strip()
+    prompt = prompt.strip()
+    stats["prompt_tokens"] = count_tokens(prompt)
+    return prompt, stats
 
 @app.route('/rag', methods=['POST'])
 def rag_endpoint():
@@ -178,22 +481,125 @@ def rag_endpoint():
             query:
               type: "string"
               description: "The user query for the RAG process."
+            retrieval:
+              type: "object"
+              description: "Optional retrieval settings."
+              properties:
+                mode:
+                  type: "string"
+                  enum: ["exact", "ivf", "int8", "float16", "coarse"]
+                  description: "Exact scan, approximate IVF search, quantized scan with exact rescoring or coarse-to-fine search pruned by document bounds (defaults to RETRIEVAL_MODE)."
+                nprobe:
+                  type: "integer"
+                  description: "IVF lists probed per query; higher is slower with better recall."
+                rescore:
+                  type: "integer"
+                  description: "Sentences rescored at full precision in the int8/float16 modes."
+                lexical_weight:
+                  type: "number"
+                  description: "Weight of the normalized BM25 score added to the document score, in [0, 1] (defaults to LEXICAL_WEIGHT)."
+                prefilter:
+                  type: "integer"
+                  description: "Only score the sentences of this many best BM25 documents, instead of the mode; 0 scores all."
+                coarse_docs:
+                  type: "integer"
+                  description: "Coarse mode: only consider this many documents closest by document embedding; 0 is exact."
+            stream:
+              type: "string"
+              enum: ["sse", "ndjson"]
+              description: "Structured stream (also selected by Accept: text/event-stream or application/x-ndjson): a retrieval event with the document names and scores and the retrieval mode that ran, token events, then a done event with the stage timings. Plain text when omitted."
     responses:
       200:
-        description: "Streamed response from the LLM."
+        description: "Streamed response from the LLM (plain text, or SSE/NDJSON events)."
         schema:
           type: "string"
     """
     data = request.get_json()
-    if not data or "query" not in data:
+    if not isinstance(data, dict) or "query" not in data:
         return Response("Missing 'query' in JSON payload", status=400)
-    
     query = data["query"]
-    retrieval_results = search(query, top_k=2, threshold=0.5, top_n_sentences=3)
-    prompt_text = prepare_prompt(query, retrieval_results)
-    
-    def generate():
-        stream = client.chat.completions.create(
+    if not isinstance(query, str) or not query.strip():
+        return Response("'query' must be a non-empty string", status=400)
+    try:
+        options = retrieval_options(data.get("retrieval") or {})
+        fmt = stream_format(data)
+    except (TypeError, ValueError) as e:
+        return Response(str(e), status=400)
+    # Identical concurrent requests (same normalized query and retrieval settings)
+    # share one embedding, search and LLM completion.
+    key = compact_json([normalize_query(query), options])
+    flight, joined = flights.join(key, lambda flight: answer_query(flight, query, options))
+    if joined:
+        COALESCED_REQUESTS.inc()
+    result = flight.wait_ready(flights.timeout)
+    tokens = flight.stream(flights.timeout)
+    if fmt is None:
+        return Response(tokens, mimetype="text/plain", headers=result["headers"])
+    # Proxies (nginx) must not buffer the events, or the retrieval event waits for the answer.
+    headers = {**result["headers"], "Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return Response(
+        structured_stream(fmt, result["retrieval"], tokens, result["timer"],
+                          coalesced=joined, **result["details"]),
+        mimetype=STREAM_FORMATS[fmt], headers=headers,
+    )
+
+def answer_query(flight, query, options):
+    """
+    Produce the /rag answer for query into flight: the retrieval results first
+    (flight.ready), then the answer chunks, replayed from the response cache or
+    streamed from the LLM. Runs once per group of coalesced identical requests.
+    """
+    timer = StageTimer()
+    index = get_index()
+    with timer.stage("query_embedding"):
+        query_embedding = get_query_embedding(query)
+    search_stats = {}
+    with timer.stage("search"):
+        retrieval_results = search_embedding(
+            query_embedding, top_k=2, threshold=0.5, top_n_sentences=3,
+            index=index, query_text=query, stats=search_stats, **options,
+        )
+    SENTENCES_SCORED.observe(search_stats.get("sentences_scored", 0))
+    doc_names = [doc["document_name"] for doc in retrieval_results]
+    retrieval = {
+        "documents": [
+            {
+                "document_name": doc["document_name"],
+                "type": doc["type"],
+                "score": doc["cosine_sentence_score"][0]["score"] if doc["cosine_sentence_score"] else None,
+            }
+            for doc in retrieval_results
+        ],
+        "index_version": index.version,
+        "mode": search_stats.get("mode"),
+        "timings_ms": timer.breakdown(),
+    }
+    cached_answer = response_cache.lookup(query, query_embedding, doc_names, index.version)
+    if cached_answer is not None:
+        CACHED_ANSWERS.inc()
+        flight.ready({"retrieval": retrieval, "timer": timer, "headers": {}, "details": {"cached": True}})
+        for chunk in cached_answer:
+            flight.publish(chunk)
+        record_request(query, timer, tokens=len(cached_answer), cached=True)
+        return
+    with timer.stage("prepare_prompt"):
+        prompt_text, prompt_stats = prepare_prompt(query, retrieval_results)
+    PROMPT_TOKENS.observe(prompt_stats["prompt_tokens"])
+    app.logger.info("Prompt for %r: %s", query, prompt_stats)
+    flight.ready({
+        "retrieval": retrieval,
+        "timer": timer,
+        "headers": {
+            "X-Prompt-Tokens": str(prompt_stats["prompt_tokens"]),
+            "X-Context-Tokens": str(prompt_stats["context_tokens"]),
+        },
+        "details": {"cached": False, "prompt_tokens": prompt_stats["prompt_tokens"]},
+    })
+
+    answer = []
+    stream_start = time.perf_counter()
+    try:
+        stream = get_client().chat.completions.create(
             model="gpt-4o",
             messages=[{"role": "user", "content": prompt_text}],
             stream=True,
@@ -201,9 +607,286 @@ def rag_endpoint():
         for chunk in stream:
             delta = chunk.choices[0].delta.content
             if delta:
-                yield delta
-    
-    return Response(generate(), mimetype="text/plain")
+                if not answer:
+                    timer.record("first_token", time.perf_counter() - stream_start)
+                answer.append(delta)
+                flight.publish(delta)
+        # Only answers that streamed to completion are cached.
+        response_cache.store(query, query_embedding, doc_names, answer, index.version)
+    finally:
+        timer.record("stream", time.perf_counter() - stream_start)
+        record_request(query, timer, tokens=len(answer), prompt_tokens=prompt_stats["prompt_tokens"])
+
+def stream_format(data):
+    """
+    Structured stream format of a /rag request: the "stream" field of the body,
+    else the Accept header, else None (plain text). Raises ValueError when unknown.
+    """
+    fmt = data.get("stream")
+    if fmt is None:
+        accept = request.headers.get("Accept", "")
+        fmt = next((name for name, mimetype in STREAM_FORMATS.items() if mimetype in accept), None)
+    if fmt is not None and fmt not in STREAM_FORMATS:
+        raise ValueError(f"Unknown stream format '{fmt}', expected one of {sorted(STREAM_FORMATS)}")
+    return fmt
+
+def format_event(fmt, event, payload):
+    """One event of a structured stream: an SSE message or an NDJSON line."""
+    if fmt == "sse":
+        return f"event: {event}\ndata: {compact_json(payload)}\n\n"
+    return compact_json({"event": event, **payload}) + "\n"
+
+def structured_stream(fmt, retrieval, tokens, timer, **details):
+    """
+    Events of a structured /rag response: the retrieval event, one token event
+    per answer chunk, then a done event with the stage timings (or an error event
+    when the LLM stream fails).
+    """
+    yield format_event(fmt, "retrieval", retrieval)
+    count = 0
+    try:
+        for token in tokens:
+            count += 1
+            yield format_event(fmt, "token", {"text": token})
+    except Exception as e:
+        app.logger.exception("LLM stream failed")
+        yield format_event(fmt, "error", {"message": str(e)})
+        return
+    yield format_event(fmt, "done", {
+        "tokens": count,
+        "timings_ms": timer.breakdown(),
+        "total_ms": round(timer.elapsed() * 1000, 1),
+        **details,
+    })
+
+def record_request(query, timer, tokens, **details):
+    """Feed one finished /rag request into the metrics and log it if it was slow."""
+    for name, seconds in timer.stages.items():
+        STAGE_HISTOGRAMS[name].observe(seconds)
+    total = timer.elapsed()
+    REQUEST_SECONDS.observe(total)
+    TOKENS_STREAMED.observe(tokens)
+    if total >= SLOW_REQUEST_SECONDS:
+        app.logger.warning(
+            "Slow /rag request (%.2fs) for %r: stages_ms=%s tokens=%d %s",
+            total, query, timer.breakdown(), tokens, details,
+        )
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """
+    Prometheus metrics: per-stage /rag latency histograms and cache counters.
+    ---
+    responses:
+      200:
+        description: "Metrics in the Prometheus text exposition format."
+    """
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
+
+# Upper bound on the number of queries accepted by /search/batch.
+BATCH_MAX_QUERIES = int(os.getenv("BATCH_MAX_QUERIES", "256"))
+
+@app.route('/search/batch', methods=['POST'])
+def search_batch_endpoint():
+    """
+    Retrieval only (no LLM call) for a batch of queries.
+    The queries are embedded in one embeddings API call and scored together.
+    ---
+    parameters:
+      - in: "body"
+        name: "body"
+        required: true
+        schema:
+          type: "object"
+          properties:
+            queries:
+              type: "array"
+              items:
+                type: "string"
+              description: "The queries to search for."
+            top_k:
+              type: "integer"
+              default: 2
+            threshold:
+              type: "number"
+              default: 0.5
+            top_n_sentences:
+              type: "integer"
+              default: 3
+            retrieval:
+              type: "object"
+              description: "Optional retrieval settings, as for /rag."
+    responses:
+      200:
+        description: "One list of results per query, in the search() retrieval schema."
+    """
+    data = request.get_json()
+    if not isinstance(data, dict) or not isinstance(data.get("queries"), list) or not data["queries"]:
+        return Response("Missing 'queries' list in JSON payload", status=400)
+    queries = data["queries"]
+    if len(queries) > BATCH_MAX_QUERIES:
+        return Response(f"At most {BATCH_MAX_QUERIES} queries per batch", status=400)
+    if not all(isinstance(query, str) and query.strip() for query in queries):
+        return Response("Every query must be a non-empty string", status=400)
+    try:
+        options = retrieval_options(data.get("retrieval") or {})
+        top_k = int(data.get("top_k", 2))
+        threshold = float(data.get("threshold", 0.5))
+        top_n_sentences = int(data.get("top_n_sentences", 3))
+        if top_k < 1 or top_n_sentences < 1:
+            raise ValueError("top_k and top_n_sentences must be at least 1")
+    except (TypeError, ValueError) as e:
+        return Response(str(e), status=400)
+
+    results = get_index().search_batch(
+        get_query_embeddings(queries),
+        top_k=top_k,
+        threshold=threshold,
+        top_n_sentences=top_n_sentences,
+        query_texts=queries,
+        **options,
+    )
+    return jsonify({"results": [
+        {"query": query, "results": query_results}
+        for query, query_results in zip(queries, results)
+    ]})
+
+@app.route('/admin/index', methods=['GET'])
+def index_status_endpoint():
+    """
+    Report the live sentence index, the background indexer and bundle hot reload.
+    ---
+    responses:
+      200:
+        description: "Index version, build time, size, vector memory, sentences scored per query, indexing and reload statistics."
+    """
+    index = get_index()
+    return jsonify({
+        "version": index.version,
+        "documents": len(index.docs),
+        "sentences": len(index),
+        "embedding": {"provider": embedder.provider, "model": EMBEDDING_MODEL, "index_model": index.model},
+        "memory": index.memory_stats(),
+        "scoring": index.scoring_stats(),
+        "build_seconds": index_build_seconds,
+        "loaded_at": index_loaded_at,
+        "loaded_by_pid": index_loaded_by,
+        "worker_pid": os.getpid(),
+        "shared_with_workers": index_loaded_by != os.getpid(),
+        "indexing": indexer.stats() if indexer is not None else None,
+        "reload": bundle_watcher.stats() if bundle_watcher is not None else None,
+    })
+
+@app.route('/admin/cache', methods=['GET'])
+def cache_stats_endpoint():
+    """
+    Report hit/miss counters of the backend caches and of request coalescing.
+    ---
+    responses:
+      200:
+        description: "Cache statistics."
+    """
+    return jsonify({
+        "query_embeddings": query_embedding_cache.stats(),
+        "responses": response_cache.stats(),
+        "coalescing": flights.stats(),
+    })
+
+# ----------------------------
+# Startup: warm-up, readiness and lazy Swagger docs
+# ----------------------------
+ready = threading.Event()
+warmup_thread = None
+warmup_lock = threading.Lock()
+
+def warm_up():
+    """Load the index, the OpenAI client, the embedding model and the tokenizer, then mark the worker ready."""
+    with startup_timer.stage("index_load"):
+        get_index()
+    with startup_timer.stage("openai_client"):
+        get_client()
+    if embedder.provider != "openai":
+        with startup_timer.stage("embedding_model"):
+            embedder.warm()
+    with startup_timer.stage("tokenizer"):
+        count_tokens("warm up")
+    ready.set()
+    total = time.perf_counter() - STARTUP_STARTED
+    log = app.logger.warning if total > STARTUP_BUDGET_SECONDS else app.logger.info
+    log("Startup took %.3fs (budget %.1fs): stages_ms=%s",
+        total, STARTUP_BUDGET_SECONDS, startup_timer.breakdown())
+
+def start_warmup():
+    """Start warm_up() in the background once per process."""
+    global warmup_thread
+    with warmup_lock:
+        if warmup_thread is None:
+            warmup_thread = threading.Thread(target=warm_up, name="warm-up", daemon=True)
+            warmup_thread.start()
+
+@app.before_request
+def ensure_warmup():
+    start_warmup()
+
+@app.route('/ready', methods=['GET'])
+def ready_endpoint():
+    """
+    Readiness probe: 200 once the index, client and tokenizer are warm, 503 before.
+    ---
+    responses:
+      200:
+        description: "The worker is warm."
+      503:
+        description: "The worker is still warming up."
+    """
+    status = {
+        "ready": ready.is_set(),
+        "startup_ms": startup_timer.breakdown(),
+        "index_version": sentence_index.version if sentence_index is not None else None,
+    }
+    return jsonify(status), 200 if ready.is_set() else 503
+
+class LazyDocsMiddleware:
+    """
+    Serve the Swagger UI and spec from a separate Flask app that is only built
+    (importing flasgger) on the first docs request. The docs app registers the
+    same view functions as app, so the generated spec is unchanged.
+    """
+    DOCS_PREFIXES = ("/apidocs", "/apispec", "/flasgger_static")
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+        self.docs_app = None
+        self.lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        if environ.get("PATH_INFO", "").startswith(self.DOCS_PREFIXES):
+            return self.get_docs_app()(environ, start_response)
+        return self.wsgi_app(environ, start_response)
+
+    def get_docs_app(self):
+        with self.lock:
+            if self.docs_app is None:
+                self.docs_app = build_docs_app()
+        return self.docs_app
+
+def build_docs_app():
+    from flasgger import Swagger
+    docs_app = Flask(__name__)
+    for rule in app.url_map.iter_rules():
+        if rule.endpoint != "static":
+            docs_app.add_url_rule(rule.rule, rule.endpoint, app.view_functions[rule.endpoint],
+                                  methods=rule.methods)
+    Swagger(docs_app)
+    CORS(docs_app)
+    return docs_app
+
+if SWAGGER_MODE == "eager":
+    from flasgger import Swagger
+    swagger = Swagger(app)
+elif SWAGGER_MODE == "lazy":
+    app.wsgi_app = LazyDocsMiddleware(app.wsgi_app)
+startup_timer.record("app_setup", time.perf_counter() - STARTUP_STARTED - startup_timer.stages["imports"])
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=8080, debug=True)
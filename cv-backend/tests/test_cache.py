@@ -0,0 +1,77 @@
+"""
+Tests of the query embedding and semantic response caches (run with: python -m pytest cv-backend/tests).
+"""
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cache import EmbeddingCache, SemanticResponseCache, content_words
+
+REACT = [1.0, 0.0, 0.0]
+REACT_AGAIN = [0.999, 0.01, 0.0]
+
+
+def test_paraphrase_hits_and_other_names_miss():
+    cache = SemanticResponseCache(max_entries=4, max_distance=0.03)
+    cache.lookup("Which projects use React?", REACT, ["a.txt"], version=1)
+    cache.store("Which projects use React?", REACT, ["a.txt"], ["React: a."], version=1)
+
+    assert cache.lookup("what project uses react", REACT_AGAIN, ["a.txt"], version=1) == ["React: a."]
+    assert cache.lookup("Which projects use Vue?", REACT_AGAIN, ["a.txt"], version=1) is None
+    assert cache.lookup("Which projects use React?", REACT, ["b.txt"], version=1) is None
+    assert cache.lookup("Which projects use React?", [0.0, 1.0, 0.0], ["a.txt"], version=1) is None
+
+
+def test_new_index_version_drops_cached_answers():
+    cache = SemanticResponseCache()
+    cache.lookup("Which projects use React?", REACT, ["a.txt"], version=1)
+    cache.store("Which projects use React?", REACT, ["a.txt"], ["old"], version=1)
+
+    assert cache.lookup("Which projects use React?", REACT, ["a.txt"], version=2) is None
+    assert cache.stats()["invalidations"] == 1
+
+
+def test_answer_from_before_a_reload_is_not_stored():
+    cache = SemanticResponseCache()
+    cache.lookup("Which projects use React?", REACT, ["a.txt"], version=2)
+    cache.store("Which projects use React?", REACT, ["a.txt"], ["new"], version=2)
+    # A request that retrieved from version 1 finishes after the reload.
+    cache.store("Tell me about podcastfy", [0.0, 1.0, 0.0], ["p.txt"], ["stale"], version=1)
+
+    assert cache.lookup("Which projects use React?", REACT, ["a.txt"], version=2) == ["new"]
+    assert cache.lookup("Tell me about podcastfy", [0.0, 1.0, 0.0], ["p.txt"], version=2) is None
+    assert cache.stats()["invalidations"] == 0
+
+
+def test_least_recently_used_answer_is_evicted():
+    cache = SemanticResponseCache(max_entries=2)
+    vectors = {"react": [1.0, 0.0, 0.0], "flask": [0.0, 1.0, 0.0], "docker": [0.0, 0.0, 1.0]}
+    for word in ("react", "flask"):
+        cache.store(word, vectors[word], ["a.txt"], [word], version=1)
+    cache.lookup("react", vectors["react"], ["a.txt"], version=1)
+    cache.store("docker", vectors["docker"], ["a.txt"], ["docker"], version=1)
+
+    assert cache.lookup("flask", vectors["flask"], ["a.txt"], version=1) is None
+    assert cache.lookup("react", vectors["react"], ["a.txt"], version=1) == ["react"]
+    assert cache.stats()["evictions"] == 1
+
+
+def test_content_words_ignore_stopwords_and_plurals():
+    assert content_words("Which projects use React?") == content_words("what project uses react")
+
+
+def test_embedding_cache_expires_and_survives_restarts(tmp_path):
+    path = str(tmp_path / "embeddings.sqlite")
+    cache = EmbeddingCache(max_entries=1, path=path)
+    cache.put("model:react", [1.0, 2.0])
+    cache.put("model:flask", [3.0, 4.0])  # evicts react from memory, not from disk
+
+    assert np.array_equal(EmbeddingCache(path=path).get("model:react"), [1.0, 2.0])
+    assert cache.get("model:react") is not None and cache.stats()["disk_hits"] == 1
+    expired = EmbeddingCache(ttl=1e-9)
+    expired.put("model:react", [1.0, 2.0])
+    assert expired.get("model:react") is None
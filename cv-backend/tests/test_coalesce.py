@@ -0,0 +1,83 @@
+"""
+Tests of the coalescing of identical in-flight /rag requests (run with: python -m pytest cv-backend/tests).
+"""
+
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from coalesce import SingleFlight
+
+
+def test_identical_requests_share_one_flight():
+    flights = SingleFlight(window=5.0, timeout=5.0)
+    release = threading.Event()
+    calls = []
+
+    def produce(flight):
+        calls.append(flight.key)
+        flight.ready({"documents": ["a.txt"]})
+        release.wait(5)
+        for chunk in ("Hello", " world"):
+            flight.publish(chunk)
+
+    first, joined_first = flights.join("query", produce)
+    second, joined_second = flights.join("query", produce)
+    other, joined_other = flights.join("other query", produce)
+    release.set()
+
+    assert first is second and other is not first
+    assert (joined_first, joined_second, joined_other) == (False, True, False)
+    assert first.wait_ready(5) == {"documents": ["a.txt"]}
+    # A subscriber joining late replays the whole answer.
+    assert list(first.stream(5)) == ["Hello", " world"]
+    assert list(second.stream(5)) == ["Hello", " world"]
+    assert sorted(calls) == ["other query", "query"]
+    assert flights.stats()["requests_merged"] == 1
+
+
+def test_finished_flights_are_not_joined():
+    flights = SingleFlight(window=5.0, timeout=5.0)
+    first, _ = flights.join("query", lambda flight: flight.ready({}))
+    list(first.stream(5))
+    second, joined = flights.join("query", lambda flight: flight.ready({}))
+    assert not joined and second is not first
+
+
+def test_producer_errors_reach_every_subscriber():
+    flights = SingleFlight(window=5.0, timeout=5.0)
+
+    def produce(flight):
+        flight.ready({})
+        flight.publish("partial")
+        raise RuntimeError("LLM unavailable")
+
+    flight, _ = flights.join("query", produce)
+    stream = flight.stream(5)
+    assert next(stream) == "partial"
+    with pytest.raises(RuntimeError, match="LLM unavailable"):
+        next(stream)
+
+
+def test_error_before_retrieval_is_raised_by_wait_ready():
+    flights = SingleFlight(timeout=5.0)
+
+    def produce(flight):
+        raise ValueError("no index")
+
+    flight, _ = flights.join("query", produce)
+    with pytest.raises(ValueError, match="no index"):
+        flight.wait_ready(5)
+
+
+def test_silent_producer_times_out():
+    flights = SingleFlight(timeout=0.05)
+    release = threading.Event()
+    flight, _ = flights.join("query", lambda flight: release.wait(5))
+    with pytest.raises(TimeoutError):
+        flight.wait_ready(0.05)
+    release.set()
@@ -0,0 +1,64 @@
+"""
+Tests of the prompt context packer (run with: python -m pytest cv-backend/tests).
+"""
+
+import os
+import sys
+import random
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from context_packer import compact_json, count_tokens, pack_context, terms
+
+# Words with JSON escapes (quotes, backslashes, tabs, newlines) and non-ASCII text.
+WORDS = ['react', 'flask', 'docker', 'query', 'index', 'vector', '"quoted"', 'back\\slash',
+         'tab\there', 'café', '数据', 'end.', 'new\nline']
+
+
+def random_text(rng, words):
+    parts = []
+    for _ in range(words):
+        parts.append(rng.choice(WORDS))
+        if rng.random() < 0.08:
+            parts.append("\n\n")
+    return " ".join(parts)
+
+
+def random_results(rng):
+    return [
+        {
+            "document_name": f"doc{i}.txt",
+            "type": "txt",
+            "cosine_sentence_score": [
+                {"sentence": random_text(rng, rng.randint(3, 30)), "score": rng.random()} for _ in range(3)
+            ],
+            "full_document_content": random_text(rng, rng.randint(50, 2000)),
+        }
+        for i in range(rng.randint(1, 5))
+    ]
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_packed_context_never_exceeds_the_budget(seed):
+    rng = random.Random(seed)
+    budget = rng.choice([200, 500, 1500])
+    packed, stats = pack_context("react flask query", random_results(rng), budget)
+    assert count_tokens(compact_json(packed)) <= budget
+    assert stats["context_tokens"] <= budget
+
+
+def test_only_spans_sharing_terms_are_packed():
+    content = "\n\n".join(["The weather was nice that day."] * 20 + ["Flask serves the React frontend."])
+    results = [{"document_name": "notes.txt", "type": "txt",
+                "cosine_sentence_score": [{"sentence": "A project.", "score": 0.9}],
+                "full_document_content": content}]
+    packed, stats = pack_context("Which projects use Flask?", results, 80)
+    assert "Flask serves the React frontend." in packed[0]["full_document_content"]
+    assert "weather" not in packed[0]["full_document_content"]
+    assert stats["spans_packed"] == stats["spans_available"] == 1
+
+
+def test_query_stopwords_are_not_terms():
+    assert terms("What did you build with Flask?") == {"build", "flask"}
@@ -0,0 +1,99 @@
+"""
+Tests of the retrieval modes of SentenceIndex (run with: python -m pytest cv-backend/tests).
+"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bundle import write_serving_bundle
+from index import SentenceIndex, normalize_rows
+
+DIM = 16
+WORDS = ["react", "flask", "docker", "kubernetes", "postgres", "redis", "numpy", "pandas"]
+
+
+def make_documents(seed=0, docs=24, sentences=8):
+    rng = np.random.default_rng(seed)
+    documents = []
+    for i in range(docs):
+        # Documents around their own direction, so each has a clear nearest neighbourhood.
+        center = rng.normal(size=DIM)
+        vectors = normalize_rows((center + 0.3 * rng.normal(size=(sentences, DIM))).astype(np.float32))
+        word = WORDS[i % len(WORDS)]
+        items = [{"sentence": f"{word} sentence {j} of doc {i}.", "embedding": vector.tolist()}
+                 for j, vector in enumerate(vectors)]
+        documents.append({
+            "doc_id": f"doc{i}.txt", "source": "txt",
+            "content": " ".join(item["sentence"] for item in items),
+            "sentence_embeddings": items,
+            "embedding": vectors.mean(axis=0).tolist(),
+            "embedding_model": "model",
+        })
+    return documents
+
+
+@pytest.fixture(scope="module")
+def documents():
+    return make_documents()
+
+
+@pytest.fixture(scope="module")
+def bundle_index(documents, tmp_path_factory):
+    bundle_dir = str(tmp_path_factory.mktemp("rag_index"))
+    write_serving_bundle(documents, bundle_dir, ivf_lists=4, quantize=("int8", "float16"))
+    return SentenceIndex.from_bundle(bundle_dir)
+
+
+def names(results):
+    return [doc["document_name"] for doc in results]
+
+
+@pytest.mark.parametrize("mode", ["exact", "ivf", "int8", "float16", "coarse"])
+def test_every_mode_finds_the_document_of_a_stored_sentence(documents, bundle_index, mode):
+    for i in (0, 7, 19):
+        query = documents[i]["sentence_embeddings"][3]["embedding"]
+        results = bundle_index.search(query, top_k=2, threshold=0.0, mode=mode, nprobe=2)
+        assert names(results)[0] == f"doc{i}.txt"
+        assert results[0]["cosine_sentence_score"][0]["sentence"] == f"{WORDS[i % len(WORDS)]} sentence 3 of doc {i}."
+
+
+def test_coarse_search_matches_exact_while_scoring_less(bundle_index):
+    rng = np.random.default_rng(1)
+    for query in rng.normal(size=(10, DIM)):
+        exact, coarse = {}, {}
+        expected = bundle_index.search(query, top_k=3, threshold=0.2, mode="exact", stats=exact)
+        results = bundle_index.search(query, top_k=3, threshold=0.2, mode="coarse", stats=coarse)
+        assert names(results) == names(expected)
+        assert coarse["sentences_scored"] <= exact["sentences_scored"]
+
+
+def test_bundle_and_json_index_agree(documents, bundle_index):
+    json_index = SentenceIndex.from_documents(documents)
+    query = np.random.default_rng(2).normal(size=DIM)
+    expected = names(bundle_index.search(query, top_k=5, threshold=0.0))
+    assert names(json_index.search(query, top_k=5, threshold=0.0)) == expected
+
+
+def test_prefilter_reports_the_mode_that_ran(documents):
+    index = SentenceIndex.from_documents(documents)
+    query = documents[2]["sentence_embeddings"][0]["embedding"]
+    stats = {}
+    results = index.search(query, top_k=2, threshold=0.0, mode="int8", query_text="docker",
+                           prefilter=3, stats=stats)
+
+    assert stats["mode"] == "prefilter"
+    assert all(name in {"doc2.txt", "doc10.txt", "doc18.txt"} for name in names(results))
+    assert set(index.scoring_stats()) == {"prefilter"}
+
+
+def test_ivf_without_lists_reports_exact(documents):
+    index = SentenceIndex.from_documents(documents)
+    stats = {}
+    index.search(documents[0]["sentence_embeddings"][0]["embedding"], mode="ivf", stats=stats)
+    assert stats["mode"] == "exact"
+    assert set(index.scoring_stats()) == {"exact"}
@@ -0,0 +1,161 @@
+"""
+Tests of the background indexer (run with: python -m pytest cv-backend/tests).
+"""
+
+import os
+import re
+import sys
+import json
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import indexer
+import embeddings
+import code_chunker
+from bundle import read_manifest
+from code_chunker import text_units
+from index import SentenceIndex
+
+DUMP = """### Directory Structure ###
+app.py
+
+================================================
+File: app.py
+================================================
+import os
+
+
+def load(path):
+    return open(path).read()
+
+
+class Store:
+    def get(self, key):
+        return key
+"""
+
+
+def fake_embed(texts):
+    return [[1.0, float(len(text)), 0.5] for text in texts]
+
+
+def split_sentences(text):
+    # Stands in for NLTK's punkt model, which may not be downloaded.
+    return [sentence for sentence in re.split(r"(?<=[.!?])\s+", text) if sentence]
+
+
+def write_source(path, documents):
+    with open(path, "w", encoding="utf8") as f:
+        json.dump(documents, f)
+    return str(path)
+
+
+def embedded_doc(doc_id, content):
+    doc = {"doc_id": doc_id, "source": "json", "content": content}
+    indexer.embed_document(doc, fake_embed, "model")
+    return doc
+
+
+def test_code_dumps_are_cut_like_prepare_data_rag():
+    doc = {"doc_id": "repo.txt", "source": "txt", "content": DUMP}
+    sentences, calls = indexer.embed_document(doc, fake_embed, "model")
+
+    units = [item["sentence"] for item in doc["sentence_embeddings"]]
+    assert units == text_units({"doc_id": "repo.txt", "source": "txt", "content": DUMP}, "code")
+    assert any(unit.startswith("File: app.py") for unit in units)
+    assert doc["chunking"] == "code"
+    assert sentences == len(units) and calls == 1
+
+
+def test_indexed_bundle_keeps_document_embeddings(tmp_path, monkeypatch):
+    monkeypatch.setattr(code_chunker, "split_sentences", split_sentences)
+    source = write_source(tmp_path / "rag_data.json", [
+        embedded_doc("done.json", "Red fish. Blue fish."),
+        {"doc_id": "new.json", "source": "json", "content": "One fish. Two fish."},
+    ])
+    stats = indexer.index_file(source, fake_embed, "model", str(tmp_path / "rag_index"))
+
+    assert stats["documents_indexed"] == 1
+    with open(source, "r", encoding="utf8") as f:
+        assert len(json.load(f)[1]["embedding"]) == 3
+    assert "doc_embeddings" in read_manifest(str(tmp_path / "rag_index"))["files"]
+    index = SentenceIndex.from_bundle(str(tmp_path / "rag_index"))
+    assert index.doc_embeddings.shape == (2, 3)
+
+
+def test_inputs_over_the_token_limit_are_split_and_averaged(monkeypatch):
+    # One unit with no sentence boundary, far over the embedding models' input limit.
+    text = " ".join(f"w{i}" for i in range(20000))
+    monkeypatch.setattr(indexer, "text_units", lambda doc: [text])
+    inputs = []
+
+    def embed(texts):
+        inputs.extend(texts)
+        return [[1.0, float(len(inputs) - len(texts) + i)] for i in range(len(texts))]
+
+    doc = {"doc_id": "data.json", "source": "json", "content": text}
+    indexer.embed_document(doc, embed, "model")
+
+    assert len(inputs) > 1 and "".join(inputs) == text
+    assert all(len(embeddings.token_pieces(piece)) == 1 for piece in inputs)
+    [item] = doc["sentence_embeddings"]
+    assert item["sentence"] == text
+    assert item["embedding"] == [1.0, (len(inputs) - 1) / 2]
+
+
+def test_failing_documents_back_off_until_their_content_changes(tmp_path, monkeypatch):
+    monkeypatch.setattr(code_chunker, "split_sentences", split_sentences)
+    source = write_source(tmp_path / "rag_data.json", [
+        {"doc_id": "bad.json", "source": "json", "content": "Always fails."},
+    ])
+    calls = []
+
+    def failing_embed(texts):
+        calls.append(texts)
+        raise RuntimeError("rejected")
+
+    stats = indexer.index_file(source, failing_embed, "model")
+    assert stats["documents_failed"] == 1 and len(calls) == 1
+    assert not indexer.retry_due(source, ["bad.json"])
+
+    # Not due yet: skipped without an embedding call.
+    stats = indexer.index_file(source, failing_embed, "model")
+    assert stats["documents_skipped"] == 1 and stats["documents_failed"] == 0 and len(calls) == 1
+
+    # Retried once its backoff has passed, it is given up after MAX_ATTEMPTS.
+    for _ in range(indexer.MAX_ATTEMPTS - 1):
+        retry_at = indexer.read_failures(source)["documents"]["bad.json"]["retry_at"]
+        monkeypatch.setattr(indexer.time, "time", lambda: retry_at)
+        assert indexer.retry_due(source, ["bad.json"])
+        indexer.index_file(source, failing_embed, "model")
+    assert len(calls) == indexer.MAX_ATTEMPTS
+    assert indexer.read_failures(source)["documents"]["bad.json"]["retry_at"] is None
+    assert not indexer.retry_due(source, ["bad.json"])
+    indexer.index_file(source, failing_embed, "model")
+    assert len(calls) == indexer.MAX_ATTEMPTS
+
+    # New content is tried again.
+    write_source(tmp_path / "rag_data.json", [
+        {"doc_id": "bad.json", "source": "json", "content": "Fixed now."},
+    ])
+    assert indexer.retry_due(source, ["bad.json"])
+    stats = indexer.index_file(source, fake_embed, "model")
+    assert stats["documents_indexed"] == 1
+    assert indexer.read_failures(source)["documents"] == {}
+
+
+def test_backed_off_documents_leave_the_bundle_alone(tmp_path, monkeypatch):
+    monkeypatch.setattr(code_chunker, "split_sentences", split_sentences)
+    bundle_dir = str(tmp_path / "rag_index")
+    source = write_source(tmp_path / "rag_data.json", [
+        embedded_doc("done.json", "Red fish. Blue fish."),
+        {"doc_id": "bad.json", "source": "json", "content": "Always fails."},
+    ])
+
+    def failing_embed(texts):
+        raise RuntimeError("rejected")
+
+    stats = indexer.index_file(source, failing_embed, "model", bundle_dir)
+    assert stats["bundle"] is not None
+    assert read_manifest(bundle_dir)["pending"] == ["bad.json"]
+    assert not indexer.bundle_needs_indexing(bundle_dir, source)
@@ -0,0 +1,52 @@
+"""
+Tests of the BM25 index (run with: python -m pytest cv-backend/tests).
+"""
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lexical import BM25Index, lexical_terms, tokenize
+
+DOCUMENTS = [
+    "A Flask API that serves the React frontend.",
+    "vectors /= np.linalg.norm(vectors) before get_query_embedding returns",
+    "Docker images for the Flask and Postgres services.",
+    "Notes about a hiking trip.",
+]
+
+
+def build():
+    return BM25Index.from_token_lists([tokenize(text) for text in DOCUMENTS])
+
+
+def test_identifiers_are_indexed_whole_and_in_parts():
+    terms = lexical_terms(tokenize("call np.linalg.norm and get_query_embedding"))
+    assert {"np.linalg.norm", "linalg", "norm", "get_query_embedding", "query"} <= set(terms)
+
+
+def test_documents_with_the_query_terms_score_higher():
+    scores = build().score("Which Flask projects use React?")
+    assert np.argmax(scores) == 0
+    assert scores[2] > 0 and scores[3] == 0
+
+
+def test_identifier_parts_match():
+    scores = build().score("where is get_query_embedding")
+    assert np.flatnonzero(scores).tolist() == [1]
+    assert build().score("linalg")[1] > 0
+
+
+def test_stopwords_alone_match_nothing():
+    assert not build().score("what about the and").any()
+
+
+def test_normalized_scores_are_absolute():
+    index = build()
+    scores = index.normalized_scores("flask react")
+    assert 0 < scores.max() <= 1
+    # An unmatched rare term lowers every score instead of being ignored.
+    assert index.normalized_scores("flask react zeppelin").max() < scores.max()
@@ -0,0 +1,42 @@
+"""
+Tests of the HTTP endpoints' request validation (run with: python -m pytest cv-backend/tests).
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "test")
+
+import main
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(main, "warmup_thread", object())  # no index load or OpenAI client
+
+    def join(key, start):
+        raise AssertionError("an invalid request reached the LLM")
+
+    monkeypatch.setattr(main.flights, "join", join)
+    return main.app.test_client()
+
+
+@pytest.mark.parametrize("query", [5, None, ["Which projects use React?"], {"text": "hi"}])
+def test_rag_rejects_a_query_that_is_not_a_string(client, query):
+    response = client.post("/rag", json={"query": query})
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize("query", ["", "   ", "\n\t"])
+def test_rag_rejects_an_empty_query(client, query):
+    response = client.post("/rag", json={"query": query})
+    assert response.status_code == 400
+    assert b"non-empty string" in response.data
+
+
+def test_rag_rejects_a_missing_query(client):
+    assert client.post("/rag", json={"retrieval": {}}).status_code == 400
+    assert client.post("/rag", json=["query"]).status_code == 400
@@ -2,6 +2,12 @@ import { useState, useRef, useEffect } from "react";
 
 const apiUrl = import.meta.env.VITE_API_URL as string;
 
+interface RetrievedDocument {
+  document_name: string;
+  type: string;
+  score: number | null;
+}
+
 interface ChatWindowProps {
   onClose: () => void;
   onResponseChange: (response: string) => void;
@@ -14,6 +20,7 @@ const ChatWindow = ({
   onStreamingChange,
 }: ChatWindowProps) => {
   const [input, setInput] = useState("");
+  const [sources, setSources] = useState<RetrievedDocument[]>([]);
   const textareaRef = useRef<HTMLTextAreaElement>(null);
 
   useEffect(() => {
@@ -56,6 +63,7 @@ const ChatWindow = ({
     }
     // Clear previous AI response.
     onResponseChange("");
+    setSources([]);
     onStreamingChange(true);
     const currentInput = input;
     setInput("");
@@ -66,7 +74,8 @@ const ChatWindow = ({
       const res = await fetch(apiUrl, {
         method: "POST",
         headers: { "Content-Type": "application/json" },
-        body: JSON.stringify({ query: currentInput }),
+        // NDJSON events: the retrieved documents arrive before the first token.
+        body: JSON.stringify({ query: currentInput, stream: "ndjson" }),
       });
 
       if (!res.body) {
@@ -77,14 +86,28 @@ const ChatWindow = ({
 
       const reader = res.body.getReader();
       const decoder = new TextDecoder("utf-8");
+      let buffered = "";
       let done = false;
       while (!done) {
         const { value, done: doneReading } = await reader.read();
         done = doneReading;
         if (value) {
-          const chunk = decoder.decode(value, { stream: true });
-          newResponse += chunk;
-          onResponseChange(newResponse); // Update AI response in parent
+          buffered += decoder.decode(value, { stream: true });
+        }
+        // Handle every complete line; a partial one waits for the next chunk.
+        const lines = buffered.split("\n");
+        buffered = done ? "" : lines.pop() ?? "";
+        for (const line of lines) {
+          if (!line.trim()) continue;
+          const event = JSON.parse(line);
+          if (event.event === "retrieval") {
+            setSources(event.documents);
+          } else if (event.event === "token") {
+            newResponse += event.text;
+            onResponseChange(newResponse); // Update AI response in parent
+          } else if (event.event === "error") {
+            console.error("Error during generation:", event.message);
+          }
         }
       }
     } catch (err: unknown) {
@@ -102,6 +125,19 @@ const ChatWindow = ({
       className="absolute bottom-9 left-1/2 transform -translate-x-1/2 w-2/3 p-3 flex items-center"
       onKeyDown={(e) => e.stopPropagation()}
     >
+      {sources.length > 0 && (
+        <div className="absolute bottom-full left-16 flex gap-2 text-xs text-gray-300">
+          {sources.map((source) => (
+            <span
+              key={source.document_name}
+              className="px-2 py-1 rounded-xl bg-white/10"
+              title={source.score !== null ? `score ${source.score}` : undefined}
+            >
+              {source.document_name}
+            </span>
+          ))}
+        </div>
+      )}
       <div className="flex w-full">
         <button onClick={onClose} className="!bg-transparent w-10 h-10 !p-2">
           ✖
@@ -0,0 +1,273 @@
+"""
+Batched, concurrent embedding requests for prepare_data_rag.py.
+
+Texts are packed into requests of at most MAX_INPUTS_PER_REQUEST inputs and
+MAX_TOKENS_PER_REQUEST tokens, sent by a bounded pool of threads and retried
+with exponential backoff. A rate-limit response pauses every thread for the
+delay the API asked for, so the pool backs off as a whole. EmbeddingCache
+keeps the embeddings of earlier runs on disk.
+"""
+
+import time
+import random
+import sqlite3
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+from tqdm import tqdm
+
+# ----------------------------
+# Configuration
+# ----------------------------
+# Limits of one OpenAI embeddings request.
+MAX_INPUTS_PER_REQUEST = 2048
+MAX_TOKENS_PER_REQUEST = 300000
+# Retry delays: BACKOFF_BASE * 2**attempt seconds (with jitter), at most BACKOFF_MAX.
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+
+_encoding = None
+_encoding_loaded = False
+_encoding_lock = threading.Lock()
+
+
+# ----------------------------
+# Tokens and request packing
+# ----------------------------
+def get_encoding():
+    """The cl100k_base tiktoken encoding of the embedding models, or None without tiktoken."""
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        with _encoding_lock:
+            if not _encoding_loaded:
+                try:
+                    import tiktoken
+                    _encoding = tiktoken.get_encoding("cl100k_base")
+                except Exception:
+                    _encoding = None
+                _encoding_loaded = True
+    return _encoding
+
+
+def count_tokens(text):
+    """Number of tokens in text (estimated at ~4 chars/token without tiktoken)."""
+    encoding = get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text, disallowed_special=()))
+    return (len(text) + 3) // 4
+
+
+def pack_batches(texts, max_inputs=MAX_INPUTS_PER_REQUEST, max_tokens=MAX_TOKENS_PER_REQUEST):
+    """
+    Cut texts into consecutive requests of at most max_inputs texts and
+    max_tokens tokens (a longer text gets a request of its own).
+    Returns a list of (start, end, tokens).
+    """
+    batches = []
+    start, tokens = 0, 0
+    for i, text in enumerate(texts):
+        n = count_tokens(text)
+        if i > start and (i - start >= max_inputs or tokens + n > max_tokens):
+            batches.append((start, i, tokens))
+            start, tokens = i, 0
+        tokens += n
+    if start < len(texts):
+        batches.append((start, len(texts), tokens))
+    return batches
+
+
+# ----------------------------
+# Retries
+# ----------------------------
+def is_retryable(error):
+    """Rate limits, timeouts, connection errors and 5xx responses are retried."""
+    import openai
+    return isinstance(error, (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError))
+
+
+def is_rate_limit(error):
+    return getattr(error, "status_code", None) == 429
+
+
+def retry_after(error):
+    """Delay in seconds asked for by the response of error (Retry-After headers), or None."""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    for name, scale in (("retry-after-ms", 0.001), ("retry-after", 1.0)):
+        try:
+            return float(headers[name]) * scale
+        except (KeyError, TypeError, ValueError):
+            continue
+    return None
+
+
+# ----------------------------
+# Batched embedding
+# ----------------------------
+class BatchEmbedder:
+    """
+    Embeds texts with embed_batch (list of texts -> list of embeddings, in
+    order) in packed requests, concurrency requests at a time. A failed
+    request is retried up to max_retries times when retryable(error); after a
+    rate-limit error no thread sends again before the Retry-After delay (or
+    the backoff) has passed.
+    """
+
+    def __init__(self, embed_batch, concurrency=4, max_inputs=MAX_INPUTS_PER_REQUEST,
+                 max_tokens=MAX_TOKENS_PER_REQUEST, max_retries=6, retryable=is_retryable):
+        self.embed_batch = embed_batch
+        self.concurrency = max(1, concurrency)
+        self.max_inputs = max_inputs
+        self.max_tokens = max_tokens
+        self.max_retries = max_retries
+        self.retryable = retryable
+        self.lock = threading.Lock()
+        self.paused_until = 0.0
+        self.requests = 0
+        self.retries = 0
+        self.rate_limited = 0
+
+    def embed(self, texts, desc="Embedding", on_batch=None):
+        """
+        Embeddings of texts, in order; the texts of requests that still failed
+        after their retries get None. on_batch(start, end, embeddings) is called
+        in the calling thread as each request completes. Shows progress with the
+        input and token throughput, and returns (embeddings, stats).
+        """
+        embeddings = [None] * len(texts)
+        batches = pack_batches(texts, self.max_inputs, self.max_tokens)
+        started = time.perf_counter()
+        inputs_done = tokens_done = failed = 0
+        with ThreadPoolExecutor(self.concurrency) as pool, \
+                tqdm(total=len(texts), desc=desc, unit="input") as progress:
+            futures = {pool.submit(self.send, texts[start:end]): (start, end, tokens)
+                       for start, end, tokens in batches}
+            for future in as_completed(futures):
+                start, end, tokens = futures[future]
+                try:
+                    embeddings[start:end] = future.result()
+                    inputs_done += end - start
+                    tokens_done += tokens
+                except Exception as e:
+                    print(f"Error embedding inputs {start}-{end}: {e}")
+                    failed += end - start
+                else:
+                    if on_batch is not None:
+                        on_batch(start, end, embeddings[start:end])
+                elapsed = max(time.perf_counter() - started, 1e-9)
+                progress.set_postfix(tokens_per_s=round(tokens_done / elapsed), refresh=False)
+                progress.update(end - start)
+        elapsed = time.perf_counter() - started
+        stats = {
+            "inputs": inputs_done,
+            "failed_inputs": failed,
+            "tokens": tokens_done,
+            "requests": self.requests,
+            "batches": len(batches),
+            "retries": self.retries,
+            "rate_limited": self.rate_limited,
+            "seconds": round(elapsed, 2),
+            "inputs_per_s": round(inputs_done / elapsed, 1) if elapsed else 0.0,
+            "tokens_per_s": round(tokens_done / elapsed, 1) if elapsed else 0.0,
+        }
+        return embeddings, stats
+
+    def send(self, texts):
+        """One packed request, retried with backoff."""
+        attempt = 0
+        while True:
+            self.wait_for_rate_limit()
+            with self.lock:
+                self.requests += 1
+            try:
+                embeddings = self.embed_batch(texts)
+                if len(embeddings) != len(texts):
+                    raise ValueError(f"Got {len(embeddings)} embeddings for {len(texts)} inputs")
+                return embeddings
+            except Exception as e:
+                if attempt >= self.max_retries or not self.retryable(e):
+                    raise
+                delay = retry_after(e)
+                if delay is None:
+                    delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.0)
+                with self.lock:
+                    self.retries += 1
+                    if is_rate_limit(e):
+                        self.rate_limited += 1
+                        self.paused_until = max(self.paused_until, time.monotonic() + delay)
+                attempt += 1
+                time.sleep(delay)
+
+    def wait_for_rate_limit(self):
+        while True:
+            with self.lock:
+                remaining = self.paused_until - time.monotonic()
+            if remaining <= 0:
+                return
+            time.sleep(remaining)
+
+
+# ----------------------------
+# Embedding cache
+# ----------------------------
+class EmbeddingCache:
+    """
+    Persistent cache of embeddings keyed by (model, SHA-256 of the input text),
+    stored as float32 blobs in a local SQLite file, so a re-run only embeds the
+    inputs that changed. Used from one thread.
+    """
+
+    # SQLite host parameters per lookup query.
+    LOOKUP_CHUNK = 500
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, vector BLOB)")
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    @staticmethod
+    def key(model, text):
+        return hashlib.sha256(f"{model}\0{text}".encode("utf8")).digest()
+
+    def get_many(self, model, texts):
+        """Cached embeddings (float32 arrays) of texts, in order, None where missing."""
+        keys = [self.key(model, text) for text in texts]
+        found = {}
+        for start in range(0, len(keys), self.LOOKUP_CHUNK):
+            chunk = keys[start : start + self.LOOKUP_CHUNK]
+            found.update(self.db.execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk
+            ))
+        embeddings = [np.frombuffer(found[key], dtype=np.float32) if key in found else None for key in keys]
+        hits = sum(embedding is not None for embedding in embeddings)
+        self.hits += hits
+        self.misses += len(keys) - hits
+        return embeddings
+
+    def put_many(self, model, texts, embeddings):
+        """Store the embeddings of texts (None entries are skipped) in one transaction."""
+        rows = [
+            (self.key(model, text), np.asarray(embedding, dtype=np.float32).tobytes())
+            for text, embedding in zip(texts, embeddings)
+            if embedding is not None
+        ]
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?)", rows)
+        self.stores += len(rows)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "cache_hits": self.hits,
+            "cache_misses": self.misses,
+            "cache_hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "cache_stores": self.stores,
+        }
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,127 @@
+"""
+Append-only JSONL store of finished documents for prepare_data_rag.py.
+
+Every embedded document is appended as one JSON line and flushed to disk as
+soon as its batch is done, so a crash loses at most the batch in flight and a
+restarted run skips the documents already stored. rag_data.json and the
+serving bundle are assembled from the store one document at a time.
+"""
+
+import os
+import json
+
+
+class DocumentStore:
+    """
+    Documents stored one per line in path. A document stored again (its
+    content changed) supersedes its earlier line; only the byte offset of each
+    document's latest line is kept in memory. A document only counts as done
+    when embed_documents marked every one of its inputs embedded
+    (embedding_complete); lines without the mark are embedded again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.offsets = {}    # doc_id -> byte offset of its latest line
+        self.completed = {}  # doc_id -> (content_hash, chunking) of its latest line, when fully embedded
+        self.superseded = 0
+        self.recover()
+
+    def recover(self):
+        """Index the stored lines; a truncated last line (interrupted write) is cut off."""
+        if not os.path.exists(self.path):
+            return
+        offset = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    doc = json.loads(line)
+                except ValueError:
+                    break
+                self.index(doc, offset)
+                offset += len(line)
+        if offset < os.path.getsize(self.path):
+            print(f"Dropping an incomplete record at byte {offset} of {self.path}")
+            os.truncate(self.path, offset)
+
+    def index(self, doc, offset):
+        if doc["doc_id"] in self.offsets:
+            self.superseded += 1
+        self.offsets[doc["doc_id"]] = offset
+        if doc.get("embedding_complete") and doc.get("content_hash"):
+            self.completed[doc["doc_id"]] = (doc["content_hash"], doc.get("chunking"))
+        else:
+            self.completed.pop(doc["doc_id"], None)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def is_done(self, doc_id, digest, chunking=None):
+        """True when doc_id is stored with its embeddings for content of hash digest, split by chunking."""
+        return self.completed.get(doc_id) == (digest, chunking)
+
+    def append(self, docs):
+        """Append finished documents and flush them to disk."""
+        with open(self.path, "ab") as f:
+            for doc in docs:
+                offset = f.tell()
+                f.write(json.dumps(doc, ensure_ascii=False).encode("utf8") + b"\n")
+                self.index(doc, offset)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def iter_documents(self, doc_ids=None):
+        """Latest stored version of each document of doc_ids (default: all), in that order."""
+        doc_ids = list(self.offsets) if doc_ids is None else doc_ids
+        with open(self.path, "rb") as f:
+            for doc_id in doc_ids:
+                if doc_id in self.offsets:
+                    f.seek(self.offsets[doc_id])
+                    yield json.loads(f.readline())
+
+    def view(self, doc_ids=None):
+        """Re-iterable view of iter_documents(doc_ids), for writers that make several passes."""
+        store = self
+
+        class View:
+            def __iter__(self):
+                return store.iter_documents(doc_ids)
+
+        return View()
+
+    def assemble(self, output_path, doc_ids=None):
+        """
+        Write the documents of doc_ids as the JSON array of rag_data.json, one
+        document at a time, and replace output_path atomically.
+        """
+        tmp_path = output_path + ".tmp"
+        count = 0
+        with open(tmp_path, "w", encoding="utf8") as out:
+            out.write("[")
+            for doc in self.iter_documents(doc_ids):
+                out.write(",\n" if count else "\n")
+                json.dump(doc, out, ensure_ascii=False)
+                count += 1
+            out.write("\n]\n")
+        os.replace(tmp_path, output_path)
+        return count
+
+    def compact(self, doc_ids=None):
+        """Rewrite the store without superseded lines and documents outside doc_ids."""
+        keep = list(self.offsets) if doc_ids is None else [d for d in doc_ids if d in self.offsets]
+        if not self.superseded and len(keep) == len(self.offsets):
+            return
+        tmp_path = self.path + ".tmp"
+        offsets = {}
+        with open(tmp_path, "wb") as out:
+            for doc in self.iter_documents(keep):
+                offsets[doc["doc_id"]] = out.tell()
+                out.write(json.dumps(doc, ensure_ascii=False).encode("utf8") + b"\n")
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(tmp_path, self.path)
+        self.offsets = offsets
+        self.completed = {d: h for d, h in self.completed.items() if d in offsets}
+        self.superseded = 0
@@ -1,18 +1,24 @@
 import os
+import sys
 import glob
 import json
-from tqdm import tqdm
-from nltk.tokenize import word_tokenize, sent_tokenize
+import hashlib
+import argparse
+import numpy as np
+from nltk.tokenize import word_tokenize
 import openai
 import nltk
 
-# Download NLTK data if not already present.
-nltk.download('punkt')
+# The serving bundle format and the chunking are defined by the backend, which writes
+# and embeds documents too (background indexer).
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "cv-backend")
+sys.path.append(BACKEND_DIR)
 
-# Set your OpenAI API key from the environment.
-openai.api_key = os.getenv("OPENAI_API_KEY")
-if not openai.api_key:
-    raise ValueError("OPENAI_API_KEY environment variable not set")
+from bundle import write_serving_bundle
+from batch_embeddings import BatchEmbedder, EmbeddingCache, MAX_INPUTS_PER_REQUEST, MAX_TOKENS_PER_REQUEST
+from document_store import DocumentStore
+from code_chunker import TARGET_CHARS, chunking_of, text_units
+from embeddings import average, pool_document_embedding
 
 # Directories for your data.
 TXT_DIR = "./dataset"  # Folder containing .txt files (your code)
@@ -20,8 +26,28 @@ JSON_DIR = "./extracted-information"  # Folder containing JSON files (project de
 
 # Output file for prepared data.
 OUTPUT_FILE = "rag_data.json"
+# Finished documents, appended one JSON line at a time; a restarted run resumes from it.
+STORE_FILE = "rag_data.jsonl"
 
-documents = []
+# Serving bundle for cv-backend: memory-mappable float32 embeddings plus compact side files
+# (written by cv-backend/bundle.py).
+BUNDLE_DIR = "rag_index"
+# Embedding provider: "openai" (API) or "local" (sentence-transformers on the CPU, batched).
+# Set from the command line; cv-backend must embed queries with the same model.
+EMBEDDING_PROVIDER = "openai"
+EMBEDDING_MODEL = "text-embedding-ada-002"
+DEFAULT_MODELS = {"openai": "text-embedding-ada-002", "local": "all-MiniLM-L6-v2"}
+EMBED_BATCH_SIZE = 64
+# Embeddings of earlier runs, keyed by (model, text hash); only changed inputs are re-embedded.
+EMBEDDING_CACHE_FILE = "embedding_cache.sqlite"
+# Embeddings API endpoint (None is api.openai.com); point it at stub_embeddings_server.py to test.
+EMBEDDINGS_BASE_URL = os.getenv("OPENAI_BASE_URL")
+local_model = None
+client = None
+
+def content_hash(text):
+    """Fingerprint of a document's content (the backend indexer re-embeds documents whose hash changed)."""
+    return hashlib.sha256(text.encode("utf8")).hexdigest()[:16]
 
 def flatten_json(y):
     """Recursively extract all string values from a nested JSON object."""
@@ -38,23 +64,17 @@ def flatten_json(y):
         out.append(str(y))
     return out
 
-def process_txt_files():
-    txt_files = glob.glob(os.path.join(TXT_DIR, "*.txt"))
-    for file_path in txt_files:
-        with open(file_path, "r", encoding="utf8") as f:
-            content = f.read()
-        doc = {
-            "doc_id": os.path.basename(file_path),
-            "source": "txt",
-            "content": content,
-            "tokens": word_tokenize(content.lower())
-        }
-        documents.append(doc)
+def source_files():
+    """(path, source) of every input document: the code .txt files, then the project JSON files."""
+    return ([(path, "txt") for path in sorted(glob.glob(os.path.join(TXT_DIR, "*.txt")))]
+            + [(path, "json") for path in sorted(glob.glob(os.path.join(JSON_DIR, "*.json")))])
 
-def process_json_files():
-    json_files = glob.glob(os.path.join(JSON_DIR, "*.json"))
-    for file_path in json_files:
-        with open(file_path, "r", encoding="utf8") as f:
+def load_document(file_path, source):
+    """Read one input document (its tokens are added once it needs embedding)."""
+    with open(file_path, "r", encoding="utf8") as f:
+        if source == "txt":
+            content = f.read()
+        else:
             try:
                 data = json.load(f)
                 parts = flatten_json(data)
@@ -62,127 +82,323 @@ def process_json_files():
             except Exception as e:
                 print(f"Error processing {file_path}: {e}")
                 content = ""
-        doc = {
-            "doc_id": os.path.basename(file_path),
-            "source": "json",
-            "content": content,
-            "tokens": word_tokenize(content.lower())
-        }
-        documents.append(doc)
+    return {
+        "doc_id": os.path.basename(file_path),
+        "source": source,
+        "content": content,
+    }
 
-print("Processing .txt files...")
-process_txt_files()
-print("Processing JSON files...")
-process_json_files()
-print(f"Total documents loaded: {len(documents)}")
+def get_client():
+    """OpenAI client for the embeddings API (BatchEmbedder does the retrying)."""
+    global client
+    if client is None:
+        client = openai.OpenAI(api_key=openai.api_key, base_url=EMBEDDINGS_BASE_URL, max_retries=0)
+    return client
 
-def get_embedding_with_chunking(text, max_words=500):
-    """
-    Compute an embedding for text using OpenAI's text-embedding-ada-002.
-    If the text exceeds max_words, split it into chunks and average the embeddings.
-    """
+def embed_texts(texts):
+    """Embed a list of texts with EMBEDDING_PROVIDER in one request, in input order."""
+    global local_model
+    if EMBEDDING_PROVIDER == "local":
+        if local_model is None:
+            from sentence_transformers import SentenceTransformer
+            local_model = SentenceTransformer(EMBEDDING_MODEL, device="cpu")
+        vectors = local_model.encode(texts, batch_size=EMBED_BATCH_SIZE, convert_to_numpy=True,
+                                     normalize_embeddings=True, show_progress_bar=False)
+        return [vector.tolist() for vector in vectors]
+    response = get_client().embeddings.create(input=texts, model=EMBEDDING_MODEL)
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+def split_words(text, max_words):
+    """text cut into pieces of at most max_words words."""
     words = text.split()
-    if len(words) <= max_words:
-        try:
-            response = openai.embeddings.create(
-                input=text,
-                model="text-embedding-ada-002"
-            )
-            return response.data[0].embedding
-        except Exception as e:
-            print(f"Error embedding text: {e}")
-            return None
-    else:
-        # Split text into chunks of at most max_words.
-        chunks = []
-        for i in range(0, len(words), max_words):
-            chunk = " ".join(words[i : i + max_words])
-            chunks.append(chunk)
-        embeddings = []
-        for chunk in chunks:
-            try:
-                response = openai.embeddings.create(
-                    input=chunk,
-                    model="text-embedding-ada-002"
-                )
-                embeddings.append(response.data[0].embedding)
-            except Exception as e:
-                print(f"Error embedding chunk: {e}")
-        if not embeddings:
-            return None
-        # Average the embeddings element-wise.
-        avg_embedding = [0] * len(embeddings[0])
-        for emb in embeddings:
-            for i, val in enumerate(emb):
-                avg_embedding[i] += val
-        avg_embedding = [val / len(embeddings) for val in avg_embedding]
-        return avg_embedding
-
-def get_document_embedding(text, chunk_size=1000):
+    return [" ".join(words[i : i + max_words]) for i in range(0, len(words), max_words)]
+
+def unit_rows(matrix):
+    matrix = np.asarray(matrix, dtype=np.float32)
+    return matrix / np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+
+class DocEmbeddingComparison:
     """
-    Compute an embedding for the given text using OpenAI's text-embedding-ada-002.
-    If the text is longer than chunk_size words, split it into chunks,
-    compute an embedding for each chunk using get_embedding_with_chunking, and then average them.
+    Collects the embedded and pooled embedding of every document (--doc-embeddings
+    compare) and measures how well each finds a document from a sample of its
+    own sentences, the way the backend's coarse_docs pre-selection uses them.
     """
-    words = text.split()
-    if len(words) <= chunk_size:
-        return get_embedding_with_chunking(text)
-    else:
-        chunks = []
-        for i in range(0, len(words), chunk_size):
-            chunk = " ".join(words[i : i + chunk_size])
-            chunks.append(chunk)
-        embeddings = []
-        for chunk in chunks:
-            emb = get_embedding_with_chunking(chunk)
-            if emb is not None:
-                embeddings.append(emb)
-        if not embeddings:
+
+    def __init__(self, queries_per_doc=10, seed=0):
+        self.queries_per_doc = queries_per_doc
+        self.rng = np.random.default_rng(seed)
+        self.embedded = []
+        self.pooled = []
+        self.queries = []
+        self.query_docs = []
+
+    def add(self, embedded, pooled, sentence_vectors):
+        doc = len(self.embedded)
+        self.embedded.append(np.asarray(embedded, dtype=np.float32))
+        self.pooled.append(np.asarray(pooled, dtype=np.float32))
+        n = min(self.queries_per_doc, len(sentence_vectors))
+        for i in self.rng.choice(len(sentence_vectors), n, replace=False):
+            self.queries.append(np.asarray(sentence_vectors[i], dtype=np.float32))
+            self.query_docs.append(doc)
+
+    def report(self, ks=(1, 5)):
+        """Cosine agreement of the two embeddings, and recall@k of the source document for each."""
+        if not self.queries:
             return None
-        avg_embedding = [0] * len(embeddings[0])
-        for emb in embeddings:
-            for i, val in enumerate(emb):
-                avg_embedding[i] += val
-        avg_embedding = [val / len(embeddings) for val in avg_embedding]
-        return avg_embedding
-
-def compute_sentence_embeddings(text):
+        embedded, pooled, queries = unit_rows(self.embedded), unit_rows(self.pooled), unit_rows(self.queries)
+        query_docs = np.asarray(self.query_docs)
+        agreement = np.sum(embedded * pooled, axis=1)
+        report = {
+            "documents": len(embedded),
+            "queries": len(queries),
+            "cosine_mean": round(float(agreement.mean()), 4),
+            "cosine_min": round(float(agreement.min()), 4),
+        }
+        for name, matrix in (("embedded", embedded), ("pooled", pooled)):
+            scores = queries @ matrix.T
+            ranks = np.sum(scores > scores[np.arange(len(queries)), query_docs][:, None], axis=1)
+            for k in ks:
+                report[f"{name}_recall@{k}"] = round(float(np.mean(ranks < k)), 4)
+        return report
+
+def embed_documents(docs, embedder, cache=None, chunk_size=1000, max_words=500,
+                    doc_mode="embed", comparison=None, chunker="code"):
     """
-    Split the text into sentences, and for each sentence compute an embedding using get_embedding_with_chunking.
-    Returns a list of dictionaries with each sentence and its embedding.
+    Compute the document and sentence embeddings of docs in one batched pass
+    over all their texts (see BatchEmbedder). The "sentences" are the
+    text_units of each document: with chunker "code" the code dumps are cut at
+    function and class boundaries instead of into NLTK sentences. Texts found
+    in cache are not sent, and each distinct missing text is embedded once.
+    Sentences longer than max_words are averaged over their max_words-word
+    pieces. With doc_mode "embed" a document embedding averages its
+    chunk_size-word chunks, each the average of its pieces; "pooled" derives it
+    from the sentence embeddings (pool_document_embedding) without embedding
+    the text twice; "compare" embeds both, stores the embedded one and adds the
+    pair to comparison.
+    Documents with any input whose embedding failed are left without
+    embeddings or content_hash (the backend's background indexer and the next
+    run embed them again) and listed in stats["failed_documents"]. Returns the
+    throughput stats.
     """
-    sentences = sent_tokenize(text)
-    sentence_embeddings = []
-    for sentence in sentences:
-        if sentence.strip():  # skip empty sentences
-            emb = get_embedding_with_chunking(sentence)
-            if emb is not None:
-                sentence_embeddings.append({
-                    "sentence": sentence,
-                    "embedding": emb
-                })
-    return sentence_embeddings
-
-# Main processing: compute embeddings for each document.
-print("Computing embeddings using OpenAI API...")
-# We'll save progress periodically.
-for i, doc in enumerate(tqdm(documents)):
-    try:
-        doc_embedding = get_document_embedding(doc["content"])
+    texts = []
+
+    def add(pieces):
+        texts.extend(pieces)
+        return range(len(texts) - len(pieces), len(texts))
+
+    plans = []
+    for doc in docs:
+        chunks = []
+        if doc_mode != "pooled":
+            chunks = [add(split_words(chunk, max_words)) for chunk in split_words(doc["content"], chunk_size)]
+        sentences = [(sentence, add(split_words(sentence, max_words)))
+                     for sentence in text_units(doc, chunker)]
+        plans.append((chunks, sentences))
+
+    embeddings = cache.get_many(EMBEDDING_MODEL, texts) if cache is not None else [None] * len(texts)
+    missing = {}
+    for i, embedding in enumerate(embeddings):
+        if embedding is None:
+            missing.setdefault(texts[i], []).append(i)
+    unique = list(missing)
+
+    def store(start, end, batch):
+        # Cache each completed request, so an interrupted run keeps its progress.
+        if cache is not None:
+            cache.put_many(EMBEDDING_MODEL, unique[start:end], batch)
+
+    fresh, stats = embedder.embed(unique, on_batch=store)
+    for text, embedding in zip(unique, fresh):
+        for i in missing[text]:
+            embeddings[i] = embedding
+    stats["texts"] = len(texts)
+    stats["duplicates"] = sum(len(ids) - 1 for ids in missing.values())
+    if cache is not None:
+        stats.update(cache.stats())
+
+    def combine(ids):
+        return average([embeddings[i] for i in ids if embeddings[i] is not None])
+
+    failed = []
+    for doc, (chunks, sentences) in zip(docs, plans):
+        # A request that failed after its retries can span several documents: a document
+        # missing any of its inputs is left unembedded rather than stored with holes.
+        if any(embeddings[i] is None for ids in chunks + [ids for _, ids in sentences] for i in ids):
+            print(f"Warning: Some inputs of document {doc['doc_id']} failed to embed; leaving it unembedded")
+            failed.append(doc["doc_id"])
+            continue
+        sentence_embeddings = [
+            {"sentence": sentence, "embedding": emb}
+            for sentence, emb in ((sentence, combine(ids)) for sentence, ids in sentences)
+            if emb is not None
+        ]
+        embedded = pooled = None
+        if doc_mode != "pooled":
+            embedded = average([emb for emb in map(combine, chunks) if emb is not None])
+        if doc_mode != "embed":
+            pooled = pool_document_embedding(
+                [item["sentence"] for item in sentence_embeddings],
+                [item["embedding"] for item in sentence_embeddings],
+                chunk_size,
+            )
+        doc_embedding = pooled if doc_mode == "pooled" else embedded
         if doc_embedding is None:
             print(f"Warning: Could not compute embedding for document {doc['doc_id']}")
             continue
+        if comparison is not None and pooled is not None:
+            comparison.add(embedded, pooled, [item["embedding"] for item in sentence_embeddings])
         doc["embedding"] = doc_embedding
-        doc["sentence_embeddings"] = compute_sentence_embeddings(doc["content"])
-    except Exception as e:
-        print(f"Error processing document {doc['doc_id']}: {e}")
-        # Save progress so far.
-        with open(OUTPUT_FILE, "w", encoding="utf8") as f:
-            json.dump(documents, f, indent=2)
-        raise e  # Optionally exit or continue
-
-# Save final output.
-with open(OUTPUT_FILE, "w", encoding="utf8") as f:
-    json.dump(documents, f, indent=2)
-
-print(f"Data preparation complete. Prepared data saved to {OUTPUT_FILE}.")
+        doc["sentence_embeddings"] = sentence_embeddings
+        doc["content_hash"] = content_hash(doc["content"])
+        doc["chunking"] = chunking_of(doc, chunker)
+        doc["embedding_model"] = EMBEDDING_MODEL
+        doc["embedding_complete"] = True
+    stats["failed_documents"] = failed
+    return stats
+
+def main():
+    global EMBEDDING_PROVIDER, EMBEDDING_MODEL, EMBEDDINGS_BASE_URL
+    parser = argparse.ArgumentParser(description="Prepare the RAG data and serving bundle.")
+    parser.add_argument("--bundle-dir", default=BUNDLE_DIR,
+                        help="Directory of the serving bundle loaded by cv-backend.")
+    parser.add_argument("--no-bundle", action="store_true",
+                        help="Only write the JSON output, not the serving bundle.")
+    parser.add_argument("--bundle-only", action="store_true",
+                        help=f"Build the serving bundle from an existing {OUTPUT_FILE} without calling the API.")
+    parser.add_argument("--ivf-lists", type=int, default=0,
+                        help="Also train k-means IVF lists for approximate search "
+                             "(about sqrt(n_sentences) is a good start; 0 disables).")
+    parser.add_argument("--quantize", nargs="*", default=[], choices=["int8", "float16"],
+                        help="Also store int8 and/or float16 copies of the embeddings for the "
+                             "backend's quantized retrieval modes (otherwise built at load time).")
+    parser.add_argument("--embedding-provider", choices=sorted(DEFAULT_MODELS), default="openai",
+                        help="Embed with the OpenAI API or a local sentence-transformers model "
+                             "(set EMBEDDING_PROVIDER to the same value in cv-backend).")
+    parser.add_argument("--embedding-model", default=None,
+                        help="Model name (default: text-embedding-ada-002 / all-MiniLM-L6-v2).")
+    parser.add_argument("--base-url", default=EMBEDDINGS_BASE_URL,
+                        help="Embeddings API base URL, e.g. http://127.0.0.1:8099/v1 for "
+                             "stub_embeddings_server.py (default: OPENAI_BASE_URL or the OpenAI API).")
+    parser.add_argument("--concurrency", type=int, default=4,
+                        help="Embeddings requests in flight at once (the local provider uses 1).")
+    parser.add_argument("--max-inputs-per-request", type=int, default=MAX_INPUTS_PER_REQUEST,
+                        help="Inputs packed into one embeddings request.")
+    parser.add_argument("--max-tokens-per-request", type=int, default=MAX_TOKENS_PER_REQUEST,
+                        help="Tokens packed into one embeddings request.")
+    parser.add_argument("--max-retries", type=int, default=6,
+                        help="Retries of a rate-limited or failed request, with exponential backoff.")
+    parser.add_argument("--embedding-cache", default=EMBEDDING_CACHE_FILE,
+                        help="SQLite file caching embeddings by (model, text hash); '' disables it.")
+    parser.add_argument("--store", default=STORE_FILE,
+                        help=f"JSONL store of finished documents; {OUTPUT_FILE} is assembled from it and "
+                             "a restarted run skips the documents it already holds.")
+    parser.add_argument("--fresh", action="store_true",
+                        help="Discard the store and embed every document again.")
+    parser.add_argument("--docs-per-batch", type=int, default=32,
+                        help="Documents embedded together and appended to the store at once.")
+    parser.add_argument("--doc-embeddings", choices=["embed", "pooled", "compare"], default="embed",
+                        help="Embed the document text in chunks (embed), pool the document embedding "
+                             "from its sentence embeddings, which about halves the API volume (pooled), "
+                             "or compute both and report how they compare for the documents embedded in "
+                             "this run (compare, stores embed; use --fresh for the whole corpus).")
+    parser.add_argument("--chunker", choices=["code", "sentences"], default="code",
+                        help="Cut the code dumps at function/class boundaries into chunks of about "
+                             f"{TARGET_CHARS} characters (code), or into NLTK sentences like the "
+                             "project JSON files (sentences). Documents stored with the other "
+                             "chunking are embedded again.")
+    args = parser.parse_args()
+
+    EMBEDDING_PROVIDER = args.embedding_provider
+    EMBEDDING_MODEL = args.embedding_model or DEFAULT_MODELS[EMBEDDING_PROVIDER]
+    EMBEDDINGS_BASE_URL = args.base_url
+
+    if args.bundle_only:
+        with open(OUTPUT_FILE, "r", encoding="utf8") as f:
+            write_serving_bundle(json.load(f), args.bundle_dir, args.ivf_lists, args.quantize, EMBEDDING_MODEL)
+        return
+
+    # Download NLTK data if not already present.
+    nltk.download('punkt')
+
+    if args.fresh and os.path.exists(args.store):
+        os.remove(args.store)
+
+    # Set your OpenAI API key from the environment.
+    openai.api_key = os.getenv("OPENAI_API_KEY")
+    if EMBEDDING_PROVIDER == "openai" and not openai.api_key:
+        raise ValueError("OPENAI_API_KEY environment variable not set")
+
+    files = source_files()
+    doc_ids = [os.path.basename(path) for path, _ in files]
+    store = DocumentStore(args.store)
+    print(f"Total documents found: {len(files)} ({len(store)} already in {args.store})")
+
+    # Main processing: embed the texts of docs_per_batch documents at a time in packed,
+    # concurrent requests, and append every finished batch to the store.
+    print(f"Computing embeddings using {EMBEDDING_PROVIDER} ({EMBEDDING_MODEL})...")
+    embedder = BatchEmbedder(
+        embed_texts,
+        concurrency=args.concurrency if EMBEDDING_PROVIDER == "openai" else 1,
+        max_inputs=args.max_inputs_per_request,
+        max_tokens=args.max_tokens_per_request,
+        max_retries=args.max_retries,
+    )
+    cache = EmbeddingCache(args.embedding_cache) if args.embedding_cache else None
+    comparison = DocEmbeddingComparison() if args.doc_embeddings == "compare" else None
+    totals = dict.fromkeys(("texts", "inputs", "failed_inputs", "tokens", "duplicates", "seconds"), 0)
+    skipped = 0
+    failed_documents = []
+    batch = []
+
+    def flush():
+        stats = embed_documents(batch, embedder, cache, doc_mode=args.doc_embeddings,
+                                comparison=comparison, chunker=args.chunker)
+        store.append(batch)
+        for key in totals:
+            totals[key] += stats[key]
+        failed_documents.extend(stats["failed_documents"])
+        batch.clear()
+
+    try:
+        for path, source in files:
+            doc = load_document(path, source)
+            if store.is_done(doc["doc_id"], content_hash(doc["content"]), chunking_of(doc, args.chunker)):
+                skipped += 1
+                continue
+            doc["tokens"] = word_tokenize(doc["content"].lower())
+            batch.append(doc)
+            if len(batch) >= args.docs_per_batch:
+                flush()
+        if batch:
+            flush()
+    finally:
+        if cache is not None:
+            cache.close()
+
+    seconds = totals["seconds"]
+    print(f"Skipped {skipped} unchanged documents already in {args.store}.")
+    if cache is not None:
+        print(f"Embedding cache {args.embedding_cache}: {cache.hits}/{totals['texts']} texts cached "
+              f"({cache.stats()['cache_hit_rate']:.1%} hit rate), {totals['duplicates']} duplicates embedded once")
+    print(f"Embedded {totals['inputs']} inputs ({totals['tokens']} tokens) in {seconds:.2f}s "
+          f"with {embedder.requests} requests ({embedder.retries} retries, {embedder.rate_limited} rate-limited): "
+          f"{totals['inputs'] / seconds if seconds else 0:.1f} inputs/s, "
+          f"{totals['tokens'] / seconds if seconds else 0:.1f} tokens/s"
+          + (f"; {totals['failed_inputs']} inputs failed" if totals["failed_inputs"] else ""))
+    if failed_documents:
+        print(f"{len(failed_documents)} documents failed to embed and are stored without embeddings "
+              f"(the next run retries them): {', '.join(failed_documents)}")
+    if comparison is not None:
+        print(f"Embedded vs pooled document embeddings: {comparison.report()}")
+
+    # Assemble the final output from the store, one document at a time.
+    count = store.assemble(OUTPUT_FILE, doc_ids)
+    store.compact(doc_ids)
+    print(f"Data preparation complete. {count} documents saved to {OUTPUT_FILE}.")
+
+    if not args.no_bundle:
+        write_serving_bundle(store.view(doc_ids), args.bundle_dir, args.ivf_lists, args.quantize,
+                             EMBEDDING_MODEL)
+
+if __name__ == "__main__":
+    main()
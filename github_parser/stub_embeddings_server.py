@@ -0,0 +1,120 @@
+"""
+Local stand-in for the OpenAI embeddings API, to exercise prepare_data_rag.py
+without network access or cost:
+
+    python stub_embeddings_server.py --port 8099 --latency 0.2 --rate-limit-every 10
+    OPENAI_API_KEY=stub python prepare_data_rag.py --base-url http://127.0.0.1:8099/v1
+
+Embeddings are deterministic bag-of-words unit vectors of the input text. The
+server enforces the per-request input and token limits, and can add latency
+and answer every Nth request with a 429 and a Retry-After header.
+"""
+
+import json
+import time
+import functools
+import base64
+import hashlib
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from batch_embeddings import MAX_INPUTS_PER_REQUEST, MAX_TOKENS_PER_REQUEST, count_tokens
+
+
+@functools.lru_cache(maxsize=65536)
+def word_vector(word, dim):
+    seed = int(hashlib.sha256(word.encode("utf8")).hexdigest()[:8], 16)
+    return np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+
+
+def stub_embedding(text, dim):
+    """Normalized sum of per-word random vectors: texts sharing words get similar embeddings."""
+    vector = np.zeros(dim, dtype=np.float32)
+    for word in text.lower().split() or [""]:
+        vector += word_vector(word, dim)
+    return vector / max(np.linalg.norm(vector), 1e-12)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # Set by main(): the parsed options and the shared request counter.
+    options = None
+    counter = {"requests": 0, "inputs": 0, "rate_limited": 0}
+    lock = threading.Lock()
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/embeddings"):
+            return self.reply(404, {"error": {"message": f"Unknown path {self.path}"}})
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        inputs = body.get("input", [])
+        inputs = [inputs] if isinstance(inputs, str) else inputs
+        with self.lock:
+            self.counter["requests"] += 1
+            n = self.counter["requests"]
+        if self.options.latency:
+            time.sleep(self.options.latency)
+        if self.options.rate_limit_every and n % self.options.rate_limit_every == 0:
+            with self.lock:
+                self.counter["rate_limited"] += 1
+            return self.reply(429, {"error": {"message": "Rate limit reached (stub)", "type": "requests"}},
+                              {"Retry-After": str(self.options.retry_after)})
+        tokens = sum(count_tokens(text) for text in inputs)
+        if not inputs or len(inputs) > MAX_INPUTS_PER_REQUEST or tokens > MAX_TOKENS_PER_REQUEST:
+            return self.reply(400, {"error": {"message": f"{len(inputs)} inputs, {tokens} tokens: over the limits"}})
+        with self.lock:
+            self.counter["inputs"] += len(inputs)
+        data = []
+        for i, text in enumerate(inputs):
+            vector = stub_embedding(text, self.options.dim)
+            if body.get("encoding_format") == "base64":
+                embedding = base64.b64encode(vector.astype("<f4").tobytes()).decode("ascii")
+            else:
+                embedding = vector.tolist()
+            data.append({"object": "embedding", "index": i, "embedding": embedding})
+        self.reply(200, {
+            "object": "list",
+            "data": data,
+            "model": body.get("model"),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        })
+
+    def reply(self, status, payload, headers=None):
+        raw = json.dumps(payload).encode("utf8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the OpenAI embeddings API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--dim", type=int, default=1536, help="Embedding dimension.")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every request.")
+    parser.add_argument("--rate-limit-every", type=int, default=0,
+                        help="Answer every Nth request with 429 (0 never).")
+    parser.add_argument("--retry-after", type=float, default=1.0,
+                        help="Retry-After seconds sent with a 429.")
+    args = parser.parse_args()
+    StubHandler.options = args
+    server = ThreadingHTTPServer((args.host, args.port), StubHandler)
+    print(f"Stub embeddings API on http://{args.host}:{args.port}/v1 (dim {args.dim})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(f"Served {StubHandler.counter}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Tests of the embedding pass of prepare_data_rag.py (run with: python -m pytest github_parser).
+"""
+
+import os
+import re
+import sys
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import prepare_data_rag
+import code_chunker  # cv-backend, put on the path by prepare_data_rag
+from batch_embeddings import BatchEmbedder
+from document_store import DocumentStore
+
+
+def split_sentences(text):
+    # Stands in for NLTK's punkt model, which may not be downloaded.
+    return [sentence for sentence in re.split(r"(?<=[.!?])\s+", text) if sentence]
+
+
+def failing_embedder(fail_request):
+    """BatchEmbedder of one input per request whose fail_request-th request (1-based) always fails."""
+    lock = threading.Lock()
+    calls = {}
+
+    def embed_batch(texts):
+        with lock:
+            n = calls.setdefault(texts[0], len(calls) + 1)
+        if n == fail_request:
+            raise RuntimeError("embedding request failed")
+        return [[1.0, float(len(text))] for text in texts]
+
+    return BatchEmbedder(embed_batch, concurrency=1, max_inputs=1, max_retries=0,
+                         retryable=lambda error: False)
+
+
+def test_documents_missing_inputs_are_not_stored_as_embedded(tmp_path, monkeypatch):
+    monkeypatch.setattr(code_chunker, "split_sentences", split_sentences)
+    docs = [
+        {"doc_id": "a.json", "source": "json", "content": "One fish. Two fish. Red fish."},
+        {"doc_id": "b.json", "source": "json", "content": "Blue fish. Old fish."},
+    ]
+    # Pooled mode embeds only the sentences: a.json's second sentence fails.
+    stats = prepare_data_rag.embed_documents(docs, failing_embedder(2), doc_mode="pooled")
+
+    assert stats["failed_documents"] == ["a.json"]
+    assert "sentence_embeddings" not in docs[0] and "content_hash" not in docs[0]
+    assert len(docs[1]["sentence_embeddings"]) == 2
+
+    store = DocumentStore(str(tmp_path / "store.jsonl"))
+    store.append(docs)
+    digests = [prepare_data_rag.content_hash(doc["content"]) for doc in docs]
+    assert not store.is_done("a.json", digests[0], "sentences")
+    assert store.is_done("b.json", digests[1], "sentences")
+    # A restarted run sees the same.
+    store = DocumentStore(store.path)
+    assert [store.is_done(doc["doc_id"], digest, "sentences") for doc, digest in zip(docs, digests)] == [False, True]
+
+
+def test_failed_request_spanning_documents_fails_each_of_them(monkeypatch):
+    monkeypatch.setattr(code_chunker, "split_sentences", split_sentences)
+    docs = [
+        {"doc_id": "a.json", "source": "json", "content": "Same words here."},
+        {"doc_id": "b.json", "source": "json", "content": "Same words here. Other words."},
+    ]
+    # Both documents share the first (deduplicated) input, sent in the first request.
+    stats = prepare_data_rag.embed_documents(docs, failing_embedder(1), doc_mode="pooled")
+
+    assert stats["failed_documents"] == ["a.json", "b.json"]
+    assert not any("sentence_embeddings" in doc for doc in docs)
+
+
+def test_store_only_counts_documents_marked_complete(tmp_path):
+    digest = prepare_data_rag.content_hash("One fish.")
+    store = DocumentStore(str(tmp_path / "store.jsonl"))
+    # A line written before documents were marked complete may be missing sentences.
+    store.append([
+        {"doc_id": "old.json", "content": "One fish.", "content_hash": digest, "chunking": "sentences",
+         "sentence_embeddings": [], "embedding": [1.0]},
+        {"doc_id": "new.json", "content": "One fish.", "content_hash": digest, "chunking": "sentences",
+         "sentence_embeddings": [], "embedding": [1.0], "embedding_complete": True},
+    ])
+    store = DocumentStore(store.path)
+    assert not store.is_done("old.json", digest, "sentences")
+    assert store.is_done("new.json", digest, "sentences")